@@ -0,0 +1,295 @@
+"""
+Shared HTTP client for the KOA, telescope schedule and proposals APIs.
+
+- Keep-alive connections, one per host per thread, reused across calls.  Connections
+  inherited by a forked process (ie DQA pool workers) are dropped, never shared
+- Per-call timeout, bounded retries with exponential backoff (connection errors and 5xx)
+- Request count / error / latency metrics
+- get_many() runs a batch of GETs on a persistent thread pool
+- StubServer serves canned responses locally so API calls can be tested offline:
+
+    python apiclient.py stub_responses.json 8123
+
+  where stub_responses.json maps a url substring (ie "cmd=getTelnr") to the response body
+  (a string, or any JSON value which is sent json encoded).  Point KOAAPI/TELAPI in
+  config.live.ini at http://localhost:8123/... to use it.
+"""
+
+import os
+import sys
+import time
+import json
+import threading
+import http.client
+from urllib.parse import urlsplit, urljoin
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ApiError(Exception):
+    pass
+
+
+class ApiClient:
+
+    def __init__(self, timeout=30, retries=2, backoff=0.5, numWorkers=8):
+        '''
+        @param timeout: seconds per request attempt
+        @type timeout: float
+        @param retries: extra attempts after a connection error or 5xx response
+        @type retries: int
+        @param backoff: seconds before first retry (doubles each retry)
+        @type backoff: float
+        @param numWorkers: threads used by get_many
+        @type numWorkers: int
+        '''
+
+        self.timeout     = timeout
+        self.retries     = retries
+        self.backoff     = backoff
+        self.numWorkers  = numWorkers
+        self.local       = threading.local()
+        self.pid         = os.getpid()
+        self.lock        = threading.Lock()
+        self.executor    = None
+        self.executorKey = None
+        self.metrics     = {'requests': 0, 'errors': 0, 'retries': 0, 'totalTime': 0.0, 'maxTime': 0.0}
+
+
+    def get(self, url):
+        '''
+        Returns response body (str) for url.  Raises ApiError if all attempts fail.
+        '''
+
+        start = time.time()
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.add_metric('retries', 1)
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                status, body = self.request(url)
+                if status >= 500:
+                    error = ApiError('HTTP {} for {}'.format(status, url))
+                    continue
+                if status >= 400:
+                    error = ApiError('HTTP {} for {}'.format(status, url))
+                    break
+                self.add_time(time.time() - start)
+                return body
+            except (OSError, http.client.HTTPException) as e:
+                error = ApiError('{} for {}'.format(e, url))
+
+        self.add_time(time.time() - start)
+        self.add_metric('errors', 1)
+        raise error
+
+
+    def get_many(self, urls):
+        '''
+        GETs all urls concurrently.  Returns list of bodies (None for failures) in url order.
+        Runs on one executor kept for the life of the client; the worker threads' connections
+        are closed when the batch finishes.
+        '''
+
+        batchConns = {}
+        def get_or_none(url):
+            conns = self.get_thread_connections()
+            batchConns[id(conns)] = conns
+            try:
+                return self.get(url)
+            except ApiError:
+                return None
+
+        try:
+            return list(self.get_executor().map(get_or_none, urls))
+        finally:
+            for conns in batchConns.values():
+                while conns:
+                    conns.popitem()[1].close()
+
+
+    def get_executor(self):
+        '''
+        Returns the get_many thread pool, creating it on first use (or after numWorkers
+        changed or the process forked).
+        '''
+        with self.lock:
+            if not self.executor or self.executorKey != (os.getpid(), self.numWorkers):
+                #threads of an executor inherited through fork do not exist in this process
+                if self.executor and self.executorKey[0] == os.getpid(): self.executor.shutdown(wait=False)
+                self.executor = ThreadPoolExecutor(max_workers=self.numWorkers)
+                self.executorKey = (os.getpid(), self.numWorkers)
+            return self.executor
+
+
+    def request(self, url, redirects=5):
+        '''
+        One GET on this thread's connection for the url host.  Follows redirects.
+        Returns (status, body).
+        '''
+
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query: path += '?' + parts.query
+
+        conn = self.get_connection(parts.scheme, parts.netloc)
+        try:
+            conn.request('GET', path, headers={'Connection': 'keep-alive'})
+            resp = conn.getresponse()
+            body = resp.read()
+        except Exception:
+            #drop broken connection so the next attempt reconnects
+            self.close_connection(parts.scheme, parts.netloc)
+            raise
+
+        if resp.will_close:
+            self.close_connection(parts.scheme, parts.netloc)
+
+        if resp.status in (301, 302, 303, 307, 308) and redirects > 0:
+            location = resp.getheader('Location')
+            if location:
+                return self.request(urljoin(url, location), redirects - 1)
+
+        charset = resp.headers.get_content_charset() or 'utf8'
+        return resp.status, body.decode(charset)
+
+
+    def get_connection(self, scheme, netloc):
+        conns = self.get_thread_connections()
+        key = (scheme, netloc)
+        if key not in conns:
+            if scheme == 'https': conns[key] = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else                : conns[key] = http.client.HTTPConnection (netloc, timeout=self.timeout)
+        return conns[key]
+
+
+    def close_connection(self, scheme, netloc):
+        conn = self.get_thread_connections().pop((scheme, netloc), None)
+        if conn: conn.close()
+
+
+    def get_thread_connections(self):
+        #a forked child must not use sockets it shares with the parent
+        if self.pid != os.getpid(): self.reset()
+        if not hasattr(self.local, 'conns'): self.local.conns = {}
+        return self.local.conns
+
+
+    def reset(self):
+        '''
+        Forgets all connections without closing them, for use in a forked child where the
+        sockets are still shared with the parent (closing could end the parent's TLS session).
+        '''
+        self.local = threading.local()
+        self.pid = os.getpid()
+
+
+    def add_metric(self, key, val):
+        with self.lock:
+            self.metrics[key] += val
+
+
+    def add_time(self, secs):
+        with self.lock:
+            self.metrics['requests']  += 1
+            self.metrics['totalTime'] += secs
+            self.metrics['maxTime']    = max(self.metrics['maxTime'], secs)
+
+
+    def get_metrics(self):
+        '''
+        Returns copy of metrics with average latency added.
+        '''
+        with self.lock:
+            metrics = dict(self.metrics)
+        num = metrics['requests']
+        metrics['avgTime'] = metrics['totalTime'] / num if num else 0.0
+        return metrics
+
+
+    def log_metrics(self, log):
+        m = self.get_metrics()
+        log.info('apiclient: {} requests, {} errors, {} retries, avg {:.3f}s, max {:.3f}s, total {:.1f}s'.format(
+                 m['requests'], m['errors'], m['retries'], m['avgTime'], m['maxTime'], m['totalTime']))
+
+
+#shared client used by common.get_api_data
+apiClient = ApiClient()
+if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=apiClient.reset)
+
+
+def get_api_client():
+    return apiClient
+
+
+def configure_api_client(config):
+    '''
+    Applies optional [API] TIMEOUT, RETRIES, BACKOFF, WORKERS config values to the shared client.
+    '''
+    api = config['API'] if 'API' in config else {}
+    if 'TIMEOUT' in api: apiClient.timeout    = float(api['TIMEOUT'])
+    if 'RETRIES' in api: apiClient.retries    = int(api['RETRIES'])
+    if 'BACKOFF' in api: apiClient.backoff    = float(api['BACKOFF'])
+    if 'WORKERS' in api: apiClient.numWorkers = int(api['WORKERS'])
+
+
+class StubServer:
+    '''
+    Local HTTP server returning canned responses, for testing API code offline.
+    Each request is answered with the first response whose key is a substring of the
+    request path+query (404 if none).  Requests received are kept in self.requests.
+    '''
+
+    def __init__(self, responses, port=0):
+        self.responses = responses
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                stub.requests.append(self.path)
+                body = None
+                for key, val in stub.responses.items():
+                    if key in self.path:
+                        body = val if isinstance(val, str) else json.dumps(val)
+                        break
+                status = 200 if body != None else 404
+                data = (body if body != None else 'not found').encode('utf8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('localhost', port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.url = 'http://localhost:' + str(self.port) + '/'
+        self.thread = None
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python apiclient.py stub_responses.json [port]')
+        sys.exit(1)
+    with open(sys.argv[1], 'r') as fp:
+        responses = json.load(fp)
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8123
+    stub = StubServer(responses, port)
+    print('apiclient: stub server at ' + stub.url)
+    stub.server.serve_forever()
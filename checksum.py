@@ -0,0 +1,149 @@
+"""
+MD5 checksums for the md5sum tables, read in fixed size chunks so memory use does not
+depend on file size.
+
+Writers that go through HashingFile (lev0 FITS, jpg previews, metadata and extension tables)
+get the md5 of the bytes as they are written.  The digest is remembered with the file's
+size and mtime, and md5_files() uses it instead of reading the file again while both are
+unchanged.  Files without a known digest are hashed on a thread pool (hashlib releases the
+GIL on large updates).
+"""
+
+import io
+import os
+import hashlib
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+#read size for hashing files
+CHUNK_SIZE = 1024 * 1024
+
+#digests computed while writing: abs path -> (size, mtime_ns, md5)
+_digests = {}
+_digestsLock = threading.Lock()
+
+
+def md5_file(path, chunkSize=CHUNK_SIZE):
+    '''
+    Returns md5 hex of a file, read in chunks into one reused buffer.
+    '''
+    md5 = hashlib.md5()
+    buf = bytearray(chunkSize)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as fp:
+        while True:
+            num = fp.readinto(buf)
+            if not num: break
+            md5.update(view[:num])
+    return md5.hexdigest()
+
+
+def add_digest(path, md5):
+    '''
+    Remembers md5 for path as it is now (size and mtime).
+    '''
+    st = os.stat(path)
+    with _digestsLock:
+        _digests[os.path.abspath(path)] = (st.st_size, st.st_mtime_ns, md5)
+
+
+def get_digest(path):
+    '''
+    Returns the remembered md5 for path if the file has not changed since (else None).
+    '''
+    with _digestsLock:
+        entry = _digests.get(os.path.abspath(path))
+    if not entry: return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if (st.st_size, st.st_mtime_ns) != entry[:2]: return None
+    return entry[2]
+
+
+def md5_files(paths, numWorkers=4):
+    '''
+    Returns {path: md5 hex} using remembered digests where possible and hashing the
+    other files numWorkers at a time.
+    '''
+    md5s = {}
+    toHash = []
+    for path in paths:
+        md5 = get_digest(path)
+        if md5: md5s[path] = md5
+        else  : toHash.append(path)
+
+    if len(toHash) > 1 and numWorkers > 1:
+        with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+            md5s.update(zip(toHash, executor.map(md5_file, toHash)))
+    else:
+        for path in toHash:
+            md5s[path] = md5_file(path)
+    return md5s
+
+
+@contextlib.contextmanager
+def open_text(path, bufferSize=io.DEFAULT_BUFFER_SIZE):
+    '''
+    Same as open(path, 'w') but written through a HashingFile.
+    '''
+    with HashingFile(path) as raw:
+        with io.TextIOWrapper(io.BufferedWriter(raw, bufferSize)) as fp:
+            yield fp
+
+
+class HashingFile(io.RawIOBase):
+    '''
+    Binary file for writing that computes the md5 of everything written to it.  As a context
+    manager the digest is remembered (add_digest) once the file is closed, and the file is
+    removed if the block raises.  There is no fileno(), so writers like astropy and PIL go
+    through write() instead of writing to the file descriptor directly.
+    '''
+
+    def __init__(self, path, mode='wb'):
+        '''
+        @param mode: 'wb' or 'xb' (fail if path exists)
+        '''
+        super().__init__()
+        self.name = path
+        self.mode = mode
+        self.md5  = hashlib.md5()
+        self.fp   = open(path, mode)
+
+
+    def writable(self):
+        return True
+
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.fp.write(data)
+
+
+    def tell(self):
+        return self.fp.tell()
+
+
+    def flush(self):
+        if not self.fp.closed: self.fp.flush()
+
+
+    def close(self):
+        if not self.fp.closed: self.fp.close()
+        super().close()
+
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        if excType:
+            if os.path.isfile(self.name): os.remove(self.name)
+        else:
+            add_digest(self.name, self.hexdigest())
+        return False
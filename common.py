@@ -1,12 +1,24 @@
 from datetime import datetime
 import os
 import hashlib
-from urllib.request import urlopen
 import json
 from send_email import send_email
 import configparser
 import glob
 import re
+import time
+import threading
+import functools
+import contextlib
+import fcntl
+from apiclient import get_api_client, ApiError
+from checksum import md5_files
+
+
+#per-run cache of API results (see get_cached_api_data)
+API_CACHE_TTL = 86400
+apiCache = {}
+apiCacheLock = threading.Lock()
 
 
 def get_root_dirs(rootDir, instr, utDate):
@@ -40,7 +52,11 @@ def get_root_dirs(rootDir, instr, utDate):
 
 
 
-def make_dir_md5_table(readDir, endswith, outfile, fileList=None, regex=None):
+def make_dir_md5_table(readDir, endswith, outfile, fileList=None, regex=None, numWorkers=4):
+    '''
+    Writes md5sum table of files in readDir.  Files are hashed in chunks numWorkers at a time,
+    using the md5 computed while writing where known (see checksum.py).
+    '''
 
     #ensure path ends in slash since we rely on that later here
     if not readDir.endswith('/'): readDir += '/'
@@ -61,9 +77,10 @@ def make_dir_md5_table(readDir, endswith, outfile, fileList=None, regex=None):
         files.sort()
         
     #write out table
+    md5s = md5_files(files, numWorkers)
     with open(outfile, 'w') as fp:
         for file in files:
-            md5 = hashlib.md5(open(file, 'rb').read()).hexdigest()
+            md5 = md5s[file]
             bName = file.replace(readDir, '')
             fp.write(md5 + '  ' + bName + '\n')
 
@@ -78,13 +95,13 @@ def removeFilesByWildcard(wildcardPath):
 def get_api_data(url, getOne=False, isJson=True):
     '''
     Gets data for common calls to url API requests.
+    Uses the shared keep-alive ApiClient (timeout and retries).  Returns None on any failure.
 
     #todo: add some better validation checks and maybe some options (ie getOne, typeCast)
     '''
     
     try:
-        data = urlopen(url)
-        data = data.read().decode('utf8')
+        data = get_api_client().get(url)
         if isJson: data = json.loads(data)
 
         if getOne and len(data) > 0: 
@@ -97,6 +114,85 @@ def get_api_data(url, getOne=False, isJson=True):
 
 
 
+def get_api_data_many(urls, getOne=False, isJson=True):
+    '''
+    Batch version of get_api_data.  Requests run concurrently, results (None for failures)
+    are returned in url order.
+    '''
+
+    results = []
+    for data in get_api_client().get_many(urls):
+        try:
+            if isJson: data = json.loads(data)
+            if getOne and len(data) > 0:
+                data = data[0]
+            results.append(data)
+        except Exception as e:
+            results.append(None)
+    return results
+
+
+def get_cached_api_data(url, getOne=False, isJson=True, cacheFile=None, ttl=API_CACHE_TTL):
+    '''
+    Same as get_api_data but for static or slow-changing data (telnr, sun times, night staff).
+    Results are kept for the rest of the run and, if cacheFile is given, saved there as JSON
+    for ttl seconds so re-runs of a step reuse them.  Failed calls (None) are not cached.
+    '''
+
+    key = ' '.join((url, str(getOne), str(isJson)))
+    now = time.time()
+
+    with apiCacheLock:
+        #in memory
+        if key in apiCache:
+            return apiCache[key]
+
+        #on disk
+        if cacheFile and ttl:
+            entry = read_api_cache_file(cacheFile).get(key)
+            if entry and now - entry['time'] < ttl:
+                apiCache[key] = entry['data']
+                return entry['data']
+
+    data = get_api_data(url, getOne=getOne, isJson=isJson)
+    if data == None:
+        return None
+
+    with apiCacheLock:
+        apiCache[key] = data
+        if cacheFile and ttl:
+            try:
+                cache = read_api_cache_file(cacheFile)
+                cache[key] = {'time': now, 'data': data}
+                tmpFile = cacheFile + '.' + str(os.getpid()) + '.tmp'
+                with open(tmpFile, 'w') as fp:
+                    json.dump(cache, fp)
+                os.replace(tmpFile, cacheFile)
+            except Exception as e:
+                pass
+
+    return data
+
+
+def read_api_cache_file(cacheFile):
+    '''
+    Returns contents of an API cache file (empty if it does not exist or is unreadable).
+    '''
+    try:
+        with open(cacheFile, 'r') as fp:
+            return json.load(fp)
+    except Exception as e:
+        return {}
+
+
+def get_api_cache_file(stageDir):
+    '''
+    On-disk API cache file for a night.
+    '''
+    return stageDir + '/api_cache.json'
+
+
+
 def do_fatal_error(msg, instr=None, utDate=None, failStage=None, log=None):
 
     #read config vars
@@ -134,21 +230,11 @@ def update_koatpx(instr, utDate, column, value, log=''):
     @type value: string
     """
 
-    import configparser
-    config = configparser.ConfigParser()
-    config.read('config.live.ini')
-
-    user = os.getlogin()
-    import hashlib
-    myHash = hashlib.md5(user.encode('utf-8')).hexdigest()
+    koaApi, user, myHash = get_koatpx_settings()
 
     # Create database access URL
 
-    sendUrl = config['API']['koaapi']
-    sendUrl += 'cmd=updateTPX&instr=' + instr.upper()
-    sendUrl += '&utdate=' + utDate.replace('/', '-') + '&'
-    sendUrl += 'column=' + column + '&value=' + value.replace(' ', '+')
-    sendUrl += '&hash=' + myHash
+    sendUrl = get_koatpx_url(instr, utDate, column, value)
     if log: log.info('update_koatpx {} - {}'.format(user, sendUrl))
 
     # Call URL and check result 
@@ -159,6 +245,142 @@ def update_koatpx(instr, utDate, column, value, log=''):
     return True
 
 
+def get_koatpx_url(instr, utDate, column, value):
+    '''
+    KOA API url to set one koa.koatpx column.
+    '''
+
+    koaApi, user, myHash = get_koatpx_settings()
+
+    sendUrl = koaApi
+    sendUrl += 'cmd=updateTPX&instr=' + instr.upper()
+    sendUrl += '&utdate=' + utDate.replace('/', '-') + '&'
+    sendUrl += 'column=' + column + '&value=' + str(value).replace(' ', '+')
+    sendUrl += '&hash=' + myHash
+    return sendUrl
+
+
+class TpxUpdater:
+    '''
+    Collects koa.koatpx column updates for a step and sends them together (in parallel since
+    the API takes one column per call).  Updates that fail are saved to a journal file and
+    sent again, before anything newer, the next time any TpxUpdater for the instrument flushes.
+    The journal is shared by all runs (UT dates) of the instrument, so each flush holds an
+    exclusive lock on it from reading it until the failed updates are written back.
+    '''
+
+    def __init__(self, instr, utDate, journalDir=None, log=None):
+        '''
+        @param journalDir: where koatpx_journal.json is kept (ie instrObj.dirs['process'])
+        @type journalDir: string
+        '''
+        self.instr   = instr.upper()
+        self.utDate  = utDate.replace('/', '-')
+        self.log     = log
+        self.pending = []
+        self.journalFile = journalDir + '/koatpx_journal.json' if journalDir else None
+
+
+    def add(self, column, value):
+        '''
+        Queues column = value (a later add of the same column replaces it).
+        '''
+        self.pending = [u for u in self.pending if u['column'] != column]
+        self.pending.append({'instr': self.instr, 'utDate': self.utDate, 'column': column, 'value': str(value)})
+
+
+    def flush(self):
+        '''
+        Sends journaled and queued updates.  Returns True if all succeeded.
+        '''
+
+        with self.lock_journal():
+            return self.send()
+
+
+    def send(self):
+
+        #journaled updates first; a queued update for the same column supersedes a journaled one
+        updates = {}
+        for u in self.read_journal() + self.pending:
+            updates[(u['instr'], u['utDate'], u['column'])] = u
+        self.pending = []
+        if not updates: return True
+
+        updates = list(updates.values())
+        urls = [get_koatpx_url(u['instr'], u['utDate'], u['column'], u['value']) for u in updates]
+        koaApi, user, myHash = get_koatpx_settings()
+        for url in urls:
+            if self.log: self.log.info('update_koatpx {} - {}'.format(user, url))
+
+        failed = []
+        for u, url, data in zip(updates, urls, get_api_data_many(urls)):
+            if not data:
+                if self.log: self.log.error('update_koatpx failed! URL: ' + url)
+                failed.append(u)
+
+        self.write_journal(failed)
+        return len(failed) == 0
+
+
+    @contextlib.contextmanager
+    def lock_journal(self):
+        '''
+        Holds an exclusive flock on <journal>.lock (no-op without a journal).
+        '''
+        if not self.journalFile:
+            yield
+            return
+        with open(self.journalFile + '.lock', 'a') as lockFp:
+            fcntl.flock(lockFp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFp, fcntl.LOCK_UN)
+
+
+    def read_journal(self):
+        if not self.journalFile or not os.path.isfile(self.journalFile): return []
+        try:
+            with open(self.journalFile, 'r') as fp:
+                updates = json.load(fp)
+            if updates and self.log:
+                self.log.info('update_koatpx: replaying {} journaled updates'.format(len(updates)))
+            return updates
+        except Exception as e:
+            if self.log: self.log.error('update_koatpx: could not read journal ' + self.journalFile)
+            return []
+
+
+    def write_journal(self, failed):
+        if not self.journalFile: return
+        try:
+            if not failed:
+                if os.path.isfile(self.journalFile): os.remove(self.journalFile)
+                return
+            tmpFile = self.journalFile + '.' + str(os.getpid()) + '.tmp'
+            with open(tmpFile, 'w') as fp:
+                json.dump(failed, fp, indent=1)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmpFile, self.journalFile)
+        except Exception as e:
+            if self.log: self.log.error('update_koatpx: could not write journal ' + self.journalFile)
+
+
+@functools.lru_cache(maxsize=None)
+def get_koatpx_settings():
+    '''
+    KOA API url, user and user hash for update_koatpx (read once per run).
+    '''
+    config = configparser.ConfigParser()
+    config.read('config.live.ini')
+
+    user = os.getlogin()
+    myHash = hashlib.md5(user.encode('utf-8')).hexdigest()
+    return config['API']['koaapi'], user, myHash
+
+
 def get_directory_size(dir):
     """
     Returns the directory size in MB
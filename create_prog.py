@@ -2,6 +2,7 @@ from astropy.io import fits
 from urllib.request import urlopen
 from dep_obtain import get_obtain_data
 from common import *
+from dep_locate import read_locate_manifest, get_locate_manifest_file, get_record_header
 
 
 def create_prog(instrObj):
@@ -47,102 +48,111 @@ def create_prog(instrObj):
     if len(obData) >= 1: oa = obData[0]['OA']
 
 
-    # Get all files
-    fileList = []
-    locateFile = stageDir + '/dep_locate' + instr + '.txt'
-    with open(locateFile, 'r') as loc:
-        for item in loc:
-            fileList.append(item.strip())
+    # Get all files (with headers read by dep_locate)
+    records = read_locate_manifest(get_locate_manifest_file(stageDir, instr))
 
 
-    # loop through files and add data to createprog.txt
-    outfile = stageDir + '/createprog.txt'
-    with open(outfile, 'w') as ofile:
-        for filename in fileList:
+    # loop through files and gather data for createprog.txt
+    # NOTE: program info is looked up after this loop so each semid is only queried once
+    progCache = instrObj.get_prog_cache()
+    rows = []
+    semids = []
+    for record in records:
+        filename = record['file']
+
+        #skip OSIRIS files that end in 'x'
+        if instr == 'OSIRIS':
+            if filename[-1] == 'x':
+                log.info(filename + ': file ends with x')
+                continue
+
+        #load fits header into instrObj (pixel data only read if a step needs it)
+        #todo: Move all keyword fixes as standard steps done upfront?
+        instrObj.set_fits_file(filename, lazy=True, header=get_record_header(record))
+
+        # Temp fix for bad file times (NIRSPEC legacy)
+        instrObj.fix_datetime(filename)
+
+        #get image type
+        instrObj.set_koaimtyp()
+        imagetyp = instrObj.get_keyword('KOAIMTYP')
 
-            #skip blank lines
-            if filename.strip() == '': continue
+        #get date-obs
+        instrObj.set_dateObs()
+        dateObs = instrObj.get_keyword('DATE-OBS')
 
-            #skip OSIRIS files that end in 'x'
-            if instr == 'OSIRIS':
-                if filename[-1] == 'x':
-                    log.info(filename + ': file ends with x')
-                    continue
+        #get utc
+        instrObj.set_utc()
+        utc = instrObj.get_keyword('UTC')
 
-            #load fits into instrObj
-            #todo: Move all keyword fixes as standard steps done upfront?
-            instrObj.set_fits_file(filename)
+        #get observer
+        observer = instrObj.get_keyword('OBSERVER')
+        if observer == None: observer = 'None'
+        observer = observer.strip()
 
-            # Temp fix for bad file times (NIRSPEC legacy)
-            instrObj.fix_datetime(filename)
+        #get fileno
+        fileno = instrObj.get_fileno()
 
-            #get image type
-            instrObj.set_koaimtyp()
-            imagetyp = instrObj.get_keyword('KOAIMTYP')
+        #get outdir
+        outdir = instrObj.get_outdir()
 
-            #get date-obs
-            instrObj.set_dateObs()
-            dateObs = instrObj.get_keyword('DATE-OBS')
+        #lop off everything before /sdata
+        # fileparts = filename.split('/sdata')
+        # if len(fileparts) > 1: newFile = '/sdata' + fileparts[-1]
+        # else                 : newFile = filename
+        #TODO: NOTE: removing this string split since is causing problems with new code and I don't think it is necessary
+        newFile = filename
 
-            #get utc
-            instrObj.set_utc()
-            utc = instrObj.get_keyword('UTC')
+        # Get the semester
+        instrObj.set_semester()
+        sem = instrObj.get_keyword('SEMESTER')
+        sem = sem.strip()
 
-            #get observer
-            observer = instrObj.get_keyword('OBSERVER')
-            if observer == None: observer = 'None'
-            observer = observer.strip()
+        #if PROGNAME exists, use that to populate the PROG* values
+        progname = instrObj.get_keyword('PROGNAME')
+        if progname != None: progname = progname.replace('ToO_', '')
+        isProgValid = is_progid_valid(progname)
+        if progname and not isProgValid:
+            if log: log.error('create_prog: Invalid PROGNAME: ' + str(progname))
 
-            #get fileno
-            fileno = instrObj.get_fileno()
+        progid = 'PROGID'
+        semid  = None
+        if isProgValid:
+            progname = progname.strip().upper()
+            if progname == 'ENG':
+                progid = 'ENG'
+            else:
+                semid  = sem + '_' + progname
+                progid = progname
+                semids.append(semid)
 
-            #get outdir
-            outdir = instrObj.get_outdir()
+        newFile = newFile.replace('//','/')
+        rows.append((newFile, dateObs, utc, outdir, observer, str(fileno), imagetyp, progid, semid))
 
-            #lop off everything before /sdata
-            # fileparts = filename.split('/sdata')
-            # if len(fileparts) > 1: newFile = '/sdata' + fileparts[-1]
-            # else                 : newFile = filename
-            #TODO: NOTE: removing this string split since is causing problems with new code and I don't think it is necessary
-            newFile = filename
 
-            # Get the semester
-            instrObj.set_semester()
-            sem = instrObj.get_keyword('SEMESTER')
-            sem = sem.strip()
+    # fetch program info for all distinct semids at once
+    progCache.prefetch(semids)
 
-            #write out vars to file, one line each var
-            newFile = newFile.replace('//','/')
+
+    # write out vars to file, one line each var
+    outfile = stageDir + '/createprog.txt'
+    with open(outfile, 'w') as ofile:
+        for newFile, dateObs, utc, outdir, observer, fileno, imagetyp, progid, semid in rows:
             ofile.write(newFile+'\n')
             ofile.write(dateObs+'\n')
             ofile.write(utc+'\n')
             ofile.write(outdir+'\n')
             ofile.write(observer+'\n')
-            ofile.write(str(fileno)+'\n')
+            ofile.write(fileno+'\n')
             ofile.write(imagetyp+'\n')
 
-
-            #if PROGNAME exists, use that to populate the PROG* values
-            progname = instrObj.get_keyword('PROGNAME')
-            if progname != None: progname = progname.replace('ToO_', '')
-            isProgValid = is_progid_valid(progname)
-            if progname and not isProgValid:
-                if log: log.error('create_prog: Invalid PROGNAME: ' + str(progname))
-
-            progid   = 'PROGID'
             progpi   = 'PROGPI'
             proginst = 'PROGINST'
             progtitl = 'PROGTITL'
-            if isProgValid:
-                progname = progname.strip().upper()
-                if progname == 'ENG':
-                    progid = 'ENG'
-                else:
-                    semid = sem + '_' + progname
-                    progid   = progname
-                    progpi   = get_prog_pi   (semid, 'PROGPI'  , log)
-                    proginst = get_prog_inst (semid, 'PROGINST', log)
-                    progtitl = get_prog_title(semid, 'PROGTITL', log)
+            if semid:
+                progpi   = progCache.get_pi   (semid, 'PROGPI')
+                proginst = progCache.get_inst (semid, 'PROGINST')
+                progtitl = progCache.get_title(semid, 'PROGTITL')
 
             ofile.write(progid + '\n')
             ofile.write(progpi   + '\n')
@@ -13,7 +13,8 @@ import sys
 import importlib
 import configparser
 from dep_obtain import dep_obtain
-from dep_locate import dep_locate
+from dep_locate import dep_locate, get_locate_manifest_file
+from locate_watch import dep_locate_watch
 from dep_add import dep_add
 from dep_dqa import dep_dqa
 from dep_drp import dep_drp
@@ -21,6 +22,7 @@ from dep_tar import dep_tar
 from koaxfr import koaxfr
 from send_email import send_email
 from common import *
+from apiclient import configure_api_client, get_api_client
 import re
 import datetime as dt
 from dateutil import parser
@@ -55,6 +57,9 @@ class Dep:
             val     = c['val']
             self.config[section][key] = val
 
+        #api timeouts/retries
+        configure_api_client(self.config)
+
         # Create instrument object
         className = self.instr.capitalize()
         module = importlib.import_module('instr_' + self.instr.lower())
@@ -88,29 +93,34 @@ class Dep:
         #check if full run.  Prompt if not full run and doing tpx updates
         fullRun = True if (processStart == 'obtain' and processStop == 'koaxfr') else False
         isReprocess = int(self.instrObj.config['MISC']['REPROCESS']) if 'REPROCESS' in self.instrObj.config['MISC'] else 0
+        isWatch = int(self.instrObj.config['LOCATE']['WATCH']) if 'WATCH' in self.instrObj.config['LOCATE'] else 0
         if (fullRun == False and self.tpx and not isReprocess): 
             self.prompt_confirm_tpx()
 
 
         # Init DEP process (verify inputs, create the logger and create directories)
         # NOTE: A full run assert fails if dirs exist, otherwise assumes you know what you are doing.
-        self.instrObj.dep_init(fullRun)
+        # (except a watch mode run resumed after it stopped during locate)
+        self.instrObj.dep_init(fullRun, resume=isWatch)
+        isResume = self.instrObj.isResume
 
 
-        #check koa for existing entry
-        if fullRun and self.tpx:
+        #check koa for existing entry (a resumed run made it)
+        if fullRun and self.tpx and not isResume:
             if not self.check_koa_db_entry(): return False
 
 
-        #check 24 time window vs runtime
-        if fullRun:
+        #check 24 time window vs runtime (watch mode starts inside the window on purpose)
+        if fullRun and not isWatch:
             if not self.check_runtime_vs_window(): return False
 
 
         #write to tpx at dep start
-        if fullRun and self.tpx:
+        if fullRun and self.tpx and not isResume:
             utcTimestamp = dt.datetime.utcnow().strftime("%Y%m%d %H:%M")
-            update_koatpx(self.instrObj.instr, self.instrObj.utDate, 'start_time', utcTimestamp, self.instrObj.log)
+            tpxUpdater = TpxUpdater(self.instrObj.instr, self.instrObj.utDate, self.instrObj.dirs['process'], self.instrObj.log)
+            tpxUpdater.add('start_time', utcTimestamp)
+            tpxUpdater.flush()
 
 
         #run each step in order
@@ -118,7 +128,10 @@ class Dep:
             self.instrObj.log.info('*** RUNNING DEP PROCESS STEP: ' + step + ' ***')
 
             if   step == 'obtain': dep_obtain(self.instrObj)
-            elif step == 'locate': dep_locate(self.instrObj, self.tpx)
+            elif step == 'locate':
+                #watch mode locates files as they are written until the window ends
+                if isWatch: dep_locate_watch(self.instrObj)
+                dep_locate(self.instrObj, self.tpx)
             elif step == 'add'   : dep_add(self.instrObj)
             elif step == 'dqa'   : dep_dqa(self.instrObj, self.tpx)
             elif step == 'lev1'  : dep_drp(self.instrObj, step, self.tpx)
@@ -137,6 +150,10 @@ class Dep:
         if fullRun: self.do_process_report_email()
 
 
+        #api request stats
+        get_api_client().log_metrics(self.instrObj.log)
+
+
         #complete
         self.instrObj.log.info('*** DEP PROCESSSING COMPLETE! ***')
         print ('*** DEP PROCESSSING COMPLETE! ***')
@@ -215,7 +232,7 @@ class Dep:
         if   step == 'obtain':
             checkFiles.append(dirs['stage'] + '/dep_obtain' + instr + '.txt')
         elif step == 'locate':
-            checkFiles.append(dirs['stage'] + '/dep_locate' + instr + '.txt')
+            checkFiles.append(get_locate_manifest_file(dirs['stage'], instr))
         elif step == 'add':
             #note: dep_add should not exit if weather files are not found
             pass
@@ -332,8 +349,10 @@ class Dep:
         if self.tpx:
             self.instrObj.log.info('Updating KOA database with error status.')
             utcTimestamp = dt.datetime.utcnow().strftime("%Y%m%d %H:%M")
-            update_koatpx(instr, utDate, 'arch_stat', "ERROR", log)
-            update_koatpx(instr, utDate, 'arch_time', utcTimestamp, log)
+            tpxUpdater = TpxUpdater(self.instrObj.instr, self.instrObj.utDate, self.instrObj.dirs['process'], self.instrObj.log)
+            tpxUpdater.add('arch_stat', 'ERROR')
+            tpxUpdater.add('arch_time', utcTimestamp)
+            tpxUpdater.flush()
 
         #exit program
         self.instrObj.log.info('EXITING DEP!')
@@ -17,10 +17,21 @@ import shutil
 from common import *
 from datetime import datetime as dt
 import metadata
+import checksum
 import re
 import hashlib
 import configparser
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits
+from dep_locate import read_locate_manifest, get_locate_manifest_file, get_record_header
+from dqa_cache import DqaCache, get_prog_row, get_header_delta
+from apiclient import get_api_client
+
+
+#per-process instrument object and program data used by parallel DQA workers
+workerInstrObj = None
+workerProgData = None
 
 
 def dep_dqa(instrObj, tpx=0):
@@ -57,18 +68,16 @@ def dep_dqa(instrObj, tpx=0):
     #todo: check for existing output files and error out with warning?
 
 
-    # Error if locate file does not exist (required input file)
-    locateFile = dirs['stage'] + '/dep_locate' + instr + '.txt'
-    if not os.path.exists(locateFile):
+    # Error if locate manifest does not exist (required input file)
+    manifestFile = get_locate_manifest_file(dirs['stage'], instr)
+    if not os.path.exists(manifestFile):
         raise Exception('dep_dqa.py: locate input file does not exist.  EXITING.')
         return
         
 
-    # Read the list of FITS files
-    files = []
-    with open(locateFile, 'r') as locatelist:
-        for line in locatelist:
-            files.append(line.strip())
+    # Read the list of FITS files (accepted dep_locate records, with their primary headers)
+    records = read_locate_manifest(manifestFile)
+    files = [record['file'] for record in records]
 
 
     #if no files, then exit out
@@ -79,22 +88,87 @@ def dep_dqa(instrObj, tpx=0):
 
     #determine program info
     create_prog(instrObj)
-    progData = gpi.getProgInfo(utDate, instr, dirs['stage'], useHdrProg, splitTime, log)
+    progData = gpi.getProgInfo(utDate, instr, dirs['stage'], useHdrProg, splitTime, log,
+                               progCache=instrObj.get_prog_cache(), apiCacheTtl=instrObj.get_api_cache_ttl())
+
+
+    # Files whose cached DQA result is still valid (same raw file, version, config, program
+    # info and lev0 output still there) are not processed again (see dqa_cache.py)
+    useCache = int(instrObj.config['MISC']['DQA_CACHE']) if 'DQA_CACHE' in instrObj.config['MISC'] else 1
+    cache = DqaCache(dirs['stage'] + '/dqa_cache', instrObj, log) if useCache else None
+    cacheKeys = [None] * len(records)
+    cached = {}
+    if cache:
+        for i, record in enumerate(records):
+            cacheKeys[i] = cache.get_key(record, get_prog_row(progData, record['file']))
+            entry = cache.get(cacheKeys[i])
+            if entry: cached[i] = entry['result']
+        cache.log_stats()
 
 
     # Loop through each entry in input_list
-    log.info('dep_dqa.py: Processing {} files'.format(len(files)))
-    for filename in files:
+    # NOTE: With DQA_WORKERS > 1, the per-file checks run in a process pool and results are merged
+    # here in input order so duplicate KOAID handling and output tables match a serial run.
+    log.info('dep_dqa.py: Processing {} files'.format(len(files) - len(cached)))
+    numWorkers = int(instrObj.config['MISC']['DQA_WORKERS']) if 'DQA_WORKERS' in instrObj.config['MISC'] else 1
+    pool = None
+    if numWorkers > 1:
+        log.info('dep_dqa.py: Running DQA checks with {} worker processes'.format(numWorkers))
+        tmpDir = dirs['stage'] + '/dqa_tmp'
+        os.makedirs(tmpDir, exist_ok=True)
+        jobs = [(i, record['file'], record['header'], tmpDir) for i, record in enumerate(records) if i not in cached]
+        pool = multiprocessing.Pool(numWorkers, init_dqa_worker, (instrObj, progData))
+        results = dict(zip([job[0] for job in jobs], pool.map(run_dqa_worker, jobs, chunksize=1)))
+
+    #jpgs are rendered in the background from the lev0 files as they are written
+    numJpgWorkers = int(instrObj.config['MISC']['JPG_WORKERS']) if 'JPG_WORKERS' in instrObj.config['MISC'] else 4
+    jpgQueue = JpgQueue(instrObj, numJpgWorkers)
+
+    #lev0 headers as written, for the metadata table
+    metaHeaders = metadata.MetadataAccumulator()
+
+    passed = []
+    for i, filename in enumerate(files):
 
         log.info('dep_dqa.py input file is {}'.format(filename))
 
         #Set current file to work on and run dqa checks, etc
-        ok = True
-        if ok: ok = instrObj.set_fits_file(filename)
-        if ok: ok = instrObj.run_dqa_checks(progData)
-        if ok: ok = check_koaid(instrObj, outFiles, log)
-        if ok: ok = instrObj.write_lev0_fits_file()
-        if ok: instrObj.make_jpg()
+        lev0File = None
+        if i in cached:
+            result = cached[i]
+            ok = check_koaid(instrObj, outFiles, log, result['koaid'], filename)
+            if ok:
+                log.info('dep_dqa.py: using cached DQA result for ' + filename)
+                cachedFile = instrObj.get_lev0_filepath(result['koaid'])
+                jpgQueue.add(cachedFile)
+                metaHeaders.add(cachedFile)
+        elif pool:
+            #worker-only fields are not part of the result (or its cache entry)
+            result = results[i]
+            ok = result.pop('ok')
+            tmpFile = result.pop('tmpFile')
+            md5 = result.pop('md5', None)
+            if ok: ok = check_koaid(instrObj, outFiles, log, result['koaid'], filename)
+            if ok:
+                lev0File = instrObj.get_lev0_filepath(result['koaid'])
+                os.replace(tmpFile, lev0File)
+                if md5: checksum.add_digest(lev0File, md5)
+                log.info('write_lev0_fits_file: output file is ' + lev0File)
+                jpgQueue.add(lev0File)
+                metaHeaders.add(lev0File, values=result.pop('metaValues'))
+            elif tmpFile and os.path.isfile(tmpFile):
+                os.remove(tmpFile)
+        else:
+            ok = True
+            if ok: ok = instrObj.set_fits_file(filename, lazy=True, header=get_record_header(records[i]))
+            if ok: ok = instrObj.run_dqa_checks(progData)
+            if ok: ok = check_koaid(instrObj, outFiles, log)
+            if ok: ok = instrObj.write_lev0_fits_file()
+            if ok: lev0File = instrObj.get_lev0_filepath(instrObj.fitsHeader.get('KOAID'))
+            if ok: jpgQueue.add(lev0File)
+            if ok: metaHeaders.add(lev0File, instrObj.fitsHdu[0].header)
+            if ok: result = get_dqa_result(instrObj)
+            if ok: result['delta'] = get_header_delta(get_record_header(records[i]), instrObj.fitsHeader)
 
  
         #If any of these steps return false then copy to udf and skip
@@ -103,26 +177,37 @@ def dep_dqa(instrObj, tpx=0):
             shutil.copy2(filename, dirs['udf']);
             continue
 
+        #save result for reruns
+        if cache and lev0File:
+            delta = result.pop('delta', None)
+            cache.put(cacheKeys[i], result, delta, [lev0File])
+
         #keep list of good fits filenames
-        procFiles.append(instrObj.fitsFilepath)
-        inFiles.append(os.path.basename(instrObj.fitsFilepath))
-        koaid = instrObj.fitsHeader.get('KOAID')
+        passed.append(result)
+        koaid = result['koaid']
         if koaid.startswith('NC'): koaid = '/'.join(('scam', koaid))
         elif koaid.startswith('NS'): koaid = '/'.join(('spec', koaid))
         outFiles.append(koaid)
-#        outFiles.append(instrObj.fitsHeader.get('KOAID'))
-        semids.append(instrObj.get_semid())
 
-        #stats
-        if instrObj.is_science(): sciFiles += 1
 
-        #deal with extra metadata
-        koaid = instrObj.fitsHeader.get('KOAID')
-        extraMeta[koaid] = instrObj.extraMeta
+    if pool:
+        pool.close()
+        pool.join()
+        shutil.rmtree(tmpDir)
+
+
+    #gather lists and stats from passed files
+    for result in passed:
+        procFiles.append(result['file'])
+        inFiles.append(os.path.basename(result['file']))
+        semids.append(result['semid'])
+        if result['isScience']: sciFiles += 1
+        extraMeta[result['koaid']] = result['extraMeta']
 
 
     #if no files passed DQA, then exit out
     if len(outFiles) == 0 :
+        jpgQueue.drain()
         notify_zero_files(instrObj, dqaFile, tpx, log)
         return
 
@@ -150,7 +235,8 @@ def dep_dqa(instrObj, tpx=0):
     keywordsDefFile = tablesDir + '/keywords.format.' + instr
     metadata.make_metadata( keywordsDefFile, metaOutFile, dirs['lev0'], extraMeta, log, 
                             dev=isDev,
-                            instrKeywordSkips=instrObj.keywordSkips)    
+                            instrKeywordSkips=instrObj.keywordSkips,
+                            headers=metaHeaders)    
 
 
     #Create the extension files
@@ -163,7 +249,8 @@ def dep_dqa(instrObj, tpx=0):
     make_dir_md5_table(dirs['lev0'], ".fits", md5Outfile)
 
 
-    #Create yyyymmdd.JPEG.md5sum.table
+    #Create yyyymmdd.JPEG.md5sum.table (once all jpgs are written)
+    jpgQueue.drain()
     md5Outfile = dirs['lev0'] + '/' + utDateDir + '.JPEG.md5sum.table'
     log.info('dep_dqa.py creating {}'.format(md5Outfile))
     make_dir_md5_table(dirs['lev0'], ".jpg", md5Outfile)
@@ -178,11 +265,12 @@ def dep_dqa(instrObj, tpx=0):
     #NOTE: dep_tar will mark as archive ready once all is zipped, etc
     if tpx:
         log.info('dep_dqa.py: updating tpx DB records')
-        utcTimestamp = dt.utcnow().strftime("%Y%m%d %H:%M")
-        update_koatpx(instr, utDate, 'files_arch', str(len(procFiles)), log)
-        update_koatpx(instr, utDate, 'pi', piList, log)
-        update_koatpx(instr, utDate, 'sdata', sdataList, log)
-        update_koatpx(instr, utDate, 'sci_files', str(sciFiles), log)
+        tpxUpdater = TpxUpdater(instr, utDate, dirs['process'], log)
+        tpxUpdater.add('files_arch', str(len(procFiles)))
+        tpxUpdater.add('pi', piList)
+        tpxUpdater.add('sdata', sdataList)
+        tpxUpdater.add('sci_files', str(sciFiles))
+        tpxUpdater.flush()
 
 
     #update koapi_send for all unique semids
@@ -270,7 +358,7 @@ def make_fits_extension_metadata_files(inDir='./', outDir=None, endsWith='.fits'
                     outFile = file.replace(endsWith, '.ext' + str(i) + '.' + hdu.name + '.tbl')
                     outFilepath = outDir + outFile
                     extFullList.append(outFilepath)
-                    with open(outFilepath, 'w') as f:
+                    with checksum.open_text(outFilepath) as f:
                         f.write(dataStr)
                 except:
                     if log: log.error(f'Could not create extended header table for ext header index {i} for file {file}!')
@@ -290,14 +378,11 @@ def check_koapi_send(semids, utDate, apiUrl, log):
     for needing an email sent to PI that there data has been archived
     '''
 
-    user = os.getlogin()
-    myHash = hashlib.md5(user.encode('utf-8')).hexdigest()
-
-    #loops thru semids, skipping duplicates
-    processed = []
-    for semid in semids:
+    myHash = get_koatpx_settings()[2]
 
-        if semid in processed: continue
+    #loops thru unique semids
+    urls = []
+    for semid in sorted(set(semid for semid in semids if semid)):
 
         #check if we should update koapi_send
         semester, progid = semid.upper().split('_')
@@ -312,28 +397,142 @@ def check_koapi_send(semids, utDate, apiUrl, log):
         url += '&utdate=' + utDate
         url += '&semid='  + semid
         url += '&hash='   + myHash
+        urls.append(url)
 
-        #call and check results
-        log.info('check_koapi_send: calling koa api url: {}'.format(url))
-        result = get_api_data(url)
+    #call (in parallel) and check results
+    for url, result in zip(urls, get_api_data_many(urls)):
+        log.info('check_koapi_send: called koa api url: {}'.format(url))
         if result == None or result == 'false':
-            log.error('check_koapi_send failed')
+            log.error('check_koapi_send failed: ' + url)
 
-        processed.append(semid)
 
 
+def init_dqa_worker(instrObj, progData):
+    '''
+    Process pool initializer for parallel DQA.  Each worker process gets its own
+    instrument object so no FITS file state is shared, and drops any API connections
+    inherited from the parent so workers never read each other's responses.
+    '''
+    global workerInstrObj, workerProgData
+    workerInstrObj = instrObj.clone()
+    workerProgData = progData
+    get_api_client().reset()
 
-def check_koaid(instrObj, koaidList, log):
 
-    #sanity check
+def run_dqa_worker(job):
+    '''
+    Runs the DQA checks for one FITS file in a worker process and writes the lev0 FITS
+    to a temp file.  The parent moves it into lev0 once duplicate KOAID checks pass.
+    '''
+
+    index, filename, headerStr, tmpDir = job
+    instrObj = workerInstrObj
+    result = {'file': filename, 'ok': False, 'koaid': None, 'tmpFile': None}
+
+    ok = True
+    if ok: ok = instrObj.set_fits_file(filename, lazy=True, header=get_record_header({'header': headerStr}))
+    if ok: ok = instrObj.run_dqa_checks(workerProgData)
+    if not ok: return result
+
+    #no KOAID is reported by check_koaid in parent
+    result['ok'] = True
     koaid = instrObj.fitsHeader.get('KOAID')
+    if not koaid: return result
+
+    tmpFile = tmpDir + '/' + str(index) + '.fits'
+    if not instrObj.write_lev0_fits_file(tmpFile):
+        result['ok'] = False
+        return result
+
+    result.update(get_dqa_result(instrObj))
+    result['metaValues'] = metadata.get_header_values(instrObj.fitsHdu[0].header)
+    result['delta'] = get_header_delta(get_record_header({'header': headerStr}), instrObj.fitsHeader)
+    result['tmpFile'] = tmpFile
+    result['md5'] = checksum.get_digest(tmpFile)
+    return result
+
+
+class JpgQueue:
+    '''
+    Background queue that renders jpg previews for lev0 FITS files on a thread pool so
+    DQA does not wait on image rendering.  Call drain() before using the jpg files.
+    '''
+
+    def __init__(self, instrObj, numWorkers=4):
+        self.instrObj = instrObj
+        self.log = instrObj.log
+        self.executor = ThreadPoolExecutor(max_workers=max(1, numWorkers))
+        self.futures = []
+
+
+    def add(self, lev0File):
+        '''
+        Queues jpg creation for a lev0 FITS file.
+        '''
+        self.futures.append(self.executor.submit(render_lev0_jpg, self.instrObj, lev0File))
+
+
+    def drain(self):
+        '''
+        Waits for all queued jpgs to finish.  Returns number that failed.
+        '''
+        numFailed = 0
+        for future in self.futures:
+            try:
+                if not future.result(): numFailed += 1
+            except Exception as e:
+                self.log.error('dep_dqa.py: jpg worker error: ' + str(e))
+                numFailed += 1
+        self.executor.shutdown()
+        if self.futures:
+            self.log.info('dep_dqa.py: {} jpg previews done, {} failed'.format(len(self.futures), numFailed))
+        self.futures = []
+        return numFailed
+
+
+def render_lev0_jpg(instrObj, filePath):
+    '''
+    Creates jpg(s) for a lev0 FITS file.  Reads the file itself so no instrument FITS state is used.
+    '''
+
+    #check if already exists? (JPG conversion is time consuming)
+    if os.path.isfile(filePath.replace('.fits', '.jpg')):
+        instrObj.log.warning('make_jpg: file already exists. SKIPPING')
+        return True
+
+    instrObj.log.info('make_jpg: converting {} to jpeg format'.format(filePath))
+    with fits.open(filePath) as hdus:
+        return instrObj.render_jpg(filePath, hdus)
+
+
+def get_dqa_result(instrObj):
+    '''
+    Returns the values DQA needs to keep for the currently loaded FITS file.
+    '''
+    return {'file'      : instrObj.fitsFilepath,
+            'koaid'     : instrObj.fitsHeader.get('KOAID'),
+            'semid'     : instrObj.get_semid(),
+            'isScience' : instrObj.is_science(),
+            'extraMeta' : instrObj.extraMeta}
+
+
+def check_koaid(instrObj, koaidList, log, koaid=None, filepath=None):
+    '''
+    Checks KOAID of current FITS file (or the koaid/filepath given) for duplicates and bad date.
+    '''
+
+    if filepath == None:
+        filepath = instrObj.fitsFilepath
+        koaid = instrObj.fitsHeader.get('KOAID')
+
+    #sanity check
     if (koaid == False or koaid == None):
-        log.error('dep_dqa.py: BAD KOAID "{}" found for {}'.format(koaid, instrObj.fitsFilepath))
+        log.error('dep_dqa.py: BAD KOAID "{}" found for {}'.format(koaid, filepath))
         return False
 
     #check for duplicates
     if (koaid in koaidList):
-        log.error('dep_dqa.py: DUPLICATE KOAID "{}" found for {}'.format(koaid, instrObj.fitsFilepath))
+        log.error('dep_dqa.py: DUPLICATE KOAID "{}" found for {}'.format(koaid, filepath))
         return False
 
     #check that date and time extracted from generated KOAID falls within our 24-hour processing datetime range.
@@ -349,7 +548,7 @@ def check_koaid(instrObj, koaidList, log):
     delta = abs(delta.days)
 
     if (kdate != idate and delta > 1 and float(ktime) < endTimeSec):
-        log.error('dep_dqa.py: KOAID "{}" has bad Date "{}" for file {}'.format(koaid, kdate, instrObj.fitsFilepath))
+        log.error('dep_dqa.py: KOAID "{}" has bad Date "{}" for file {}'.format(koaid, kdate, filepath))
         return False
 
     return True
@@ -368,8 +567,10 @@ def notify_zero_files(instrObj, dqaFile, tpx, log):
     if tpx:
         log.info('dep_dqa.py: updating tpx DB records')
         utcTimestamp = dt.utcnow().strftime("%Y%m%d %H:%M")
-        update_koatpx(instrObj.instr, instrObj.utDate, 'arch_stat', 'DONE', log)
-        update_koatpx(instrObj.instr, instrObj.utDate, 'arch_time', utcTimestamp, log)
+        tpxUpdater = TpxUpdater(instrObj.instr, instrObj.utDate, instrObj.dirs['process'], log)
+        tpxUpdater.add('arch_stat', 'DONE')
+        tpxUpdater.add('arch_time', utcTimestamp)
+        tpxUpdater.flush()
 
 
 
@@ -26,6 +26,8 @@ parser.add_argument('--modtimeOverride' , type=str, nargs='?', const=None,  help
 parser.add_argument('--metaCompareDir'  , type=str, nargs='?', const=None,  help='(OPTIONAL) Directory to use for special metadata compare report for reprocessing old data.')
 parser.add_argument('--useHdrProg'  , type=str, nargs='?', const=None,      help='(OPTIONAL) Set to "force" to force header val if different.  Set to "assist" to use only if indeterminate (useful for processing old data).')
 parser.add_argument('--splitTime'   , type=str, nargs='?', const=None,      help='(OPTIONAL) HH:mm of suntimes midpoint for overriding split night timing.')
+parser.add_argument('--dqaWorkers'  , type=str, nargs='?', const=None,      help='(OPTIONAL) Number of worker processes to run DQA checks in parallel.  Default is 1 (serial).')
+parser.add_argument('--watch'       , type=str, nargs='?', const=None,      help='(OPTIONAL) Set to "1" to watch the search dirs and locate files as they are written until the end of the 24 hour window, then finish processing.')
 
 # Get input params
 
@@ -45,6 +47,8 @@ if args.reprocess      : configArgs.append({'section':'MISC',   'key':'REPROCESS
 if args.metaCompareDir : configArgs.append({'section':'MISC',   'key':'META_COMPARE_DIR',   'val': args.metaCompareDir})
 if args.useHdrProg     : configArgs.append({'section':'MISC',   'key':'USE_HDR_PROG',       'val': args.useHdrProg})
 if args.splitTime      : configArgs.append({'section':'MISC',   'key':'SPLIT_TIME',         'val': args.splitTime})
+if args.dqaWorkers     : configArgs.append({'section':'MISC',   'key':'DQA_WORKERS',        'val': args.dqaWorkers})
+if args.watch          : configArgs.append({'section':'LOCATE', 'key':'WATCH',              'val': args.watch})
 
 # Use the current UT date if none provided
 
@@ -16,23 +16,29 @@
 import calendar as cal               ## Used to convert a time object into a number of seconds
 import time as t                     ## Used to convert a string date into a time object
 from astropy.io import fits          ## Used for everything with fits
-from common import update_koatpx 
+from common import TpxUpdater
 import os
 import shutil
 from sys import argv
 from datetime import datetime as dt, timedelta
 import gzip
-import shutil
-import subprocess
+import zlib
+import json
+import errno
+import fcntl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from locate_index import LocateIndex
+from locate_rules import LocateRules
 
 
 
 def dep_locate(instrObj, tpx=0):
     """
     This function will search the data directories for FITS data written in the last 24hours.
-    Copies FITS file to staging area. Creates the following files in stageDir:
+    Copies FITS file to staging area. Creates the following file in stageDir:
 
-      dep_locate<INSTR>.txt
+      dep_locate<INSTR>.jsonl  (manifest, one JSON record per located file, see check_raw_file)
 
     @param instrObj: the instrument object
     @type instrObj: instrument class
@@ -43,119 +49,335 @@ def dep_locate(instrObj, tpx=0):
     instr  = instrObj.instr
     utDate = instrObj.utDate
     log    = instrObj.log
-    ancDir   = instrObj.dirs['anc']
     stageDir = instrObj.dirs['stage']
 
 
     #Find sdata dirs list. Return if none found.
-    if ('SEARCH_DIR' in instrObj.config['LOCATE']): useDirs = [instrObj.config['LOCATE']['SEARCH_DIR']]
-    else                                          : useDirs = instrObj.get_dir_list()
+    useDirs = get_locate_dirs(instrObj)
     if len(useDirs) == 0:
         log.error('dep_locate: Did not find any directories to search!')
         return
 
 
-    # Create files to store the valid FITS files
-    presort1File = ''.join((stageDir, '/dep_locate', instr, 'pre1.text'))
-    presort2File = ''.join((stageDir, '/dep_locate', instr, 'pre2.text'))
-    locateFile  = ''.join((stageDir, '/dep_locate', instr, '.txt'))
+    # Manifest of located files (only output file)
+    manifestFile = get_locate_manifest_file(stageDir, instr)
 
 
     # Find the files in the last 24 hours
     log.info('Looking for FITS files in {}'.format(useDirs))
     modtimeOverride = int(instrObj.config['LOCATE']['MODTIME_OVERRIDE']) if 'MODTIME_OVERRIDE' in instrObj.config['LOCATE'] else 0
-    filePaths = find_24hr_fits(useDirs, instrObj.utDate, instrObj.endTime, modtimeOverride)
-
-
-    #write filepaths to outfile
-    with open(presort1File, 'w') as f:
-        for path in filePaths:
-            f.write(path + '\n')
-    log.info('Copied fits file names from {} to {}'.format(useDirs, presort1File))
-
-
-    # Read presortFile list and do some more filtering before we do final copy to staging.
-    with open(presort2File, 'w') as f:
-        with open(presort1File, 'r') as pre:
-            fcsConfigs = []
-            for line in pre:
-                if ('.fits' in line 
-                        and '/fcs' not in line 
-                        and 'mira' not in line 
-                        and 'savier-protected' not in line 
-                        and 'SPEC/ORP/' not in line 
-                        and 'idf' not in line):
-
-                    # Copy the files to stageDir and update files 
-                    # to use local copy file list
-                    newFile = ''.join((stageDir, line.strip()))
-                    log.info('copying file {} to {}'.format(line.strip(), newFile))                    
-                    copy_file(line.strip(), newFile)
-                    toFile = ''.join((newFile, '\n'))
-                    f.write(toFile)
-
-                    #special DEIMOS step
-                    #todo: move this to instr class?
-                    if 'DEIMOS' in instr:
-                        try:
-                            fcs = fits.getheader(line.strip())['FCSIMGFI']
-                            if fcs != '' and fcs not in fcsConfigs:
-                                fcsConfigs.append(fcs)
-                                if '/s/' not in fcs:
-                                    fcs = '/s' + fcs
-                                newFile = ''.join((stageDir, fcs))
-                                copy_file(fcs, newFile)
-                                toFile = ''.join((newFile, '\n'))
-                                f.write(toFile)
-                        except:
-                            pass
-            del fcsConfigs
-
-
-    # Verify the files are valid - no corrupt headers, valid KOAID
-    isReprocess = int(instrObj.config['MISC']['REPROCESS']) if 'REPROCESS' in instrObj.config['MISC'] else 0
-    locateFile = stageDir +'/dep_locate' + instr + '.txt'
-    dep_rawfiles(instr, utDate, presort2File, locateFile, ancDir, isReprocess, log)
+    numWorkers      = int(instrObj.config['LOCATE']['WORKERS'])          if 'WORKERS'          in instrObj.config['LOCATE'] else 8
+    pruneSlack      = int(instrObj.config['LOCATE']['PRUNE_SLACK'])      if 'PRUNE_SLACK'      in instrObj.config['LOCATE'] else -1
+    useIndex        = int(instrObj.config['LOCATE']['INDEX'])            if 'INDEX'            in instrObj.config['LOCATE'] else 0
+    locateIndex = LocateIndex(instrObj.dirs['process'] + '/locate_index.sqlite', log) if useIndex else None
+    fileRecords = find_24hr_fits(useDirs, instrObj.utDate, instrObj.endTime, modtimeOverride, numWorkers, pruneSlack, locateIndex)
+    if locateIndex: locateIndex.close()
+    log.info('dep_locate: found {} FITS files in {}'.format(len(fileRecords), useDirs))
+
+
+    # Files already located by watch mode (see locate_watch.py) are not done again,
+    # unless they changed after the watcher located them (those are redone)
+    current = {path: (mtime, size) for path, mtime, size in fileRecords}
+    watchRecords = [r for r in get_watch_records(instrObj) if is_watch_record_current(r, current, log)]
+    seen = set(record['source'] for record in watchRecords)
+    if watchRecords: log.info('dep_locate: {} files already located in watch mode'.format(len(watchRecords)))
+
+
+    # Records are streamed through filter -> validate -> stage (in memory, in mod time order).
+    # NOTE: Files are validated in place.  Only files passing dep_rawfiles are staged.
+    records = (make_record(path, mtime, size) for path, mtime, size in fileRecords if path not in seen)
+    records = locate_records(instrObj, records, seen)
+    if watchRecords:
+        records = sorted(watchRecords + list(records), key=lambda r: r['mtime'] or 0)
+    num = write_locate_manifest(manifestFile, records)
 
 
     #log completion with count
-    num = sum(1 for line in open(locateFile, 'r'))
     log.info('dep_locate: {} {} FITS files passed final checks.'.format(num, instr))
 
 
     #update koatpx
     if tpx:
         utcTimestamp = dt.utcnow().strftime("%Y%m%d %H:%M")
-        update_koatpx(instr, utDate, 'files', str(num), log)
-        update_koatpx(instr, utDate, 'ondisk_stat', 'DONE', log)
-        update_koatpx(instr, utDate, 'ondisk_time', utcTimestamp, log)
+        tpxUpdater = TpxUpdater(instr, utDate, instrObj.dirs['process'], log)
+        tpxUpdater.add('files', str(num))
+        tpxUpdater.add('ondisk_stat', 'DONE')
+        tpxUpdater.add('ondisk_time', utcTimestamp)
+        tpxUpdater.flush()
 
 
 #-----------------------END DEP LOCATE----------------------------------
 
 
-def copy_file(source, destination):
+def get_locate_dirs(instrObj):
+    """
+    Search dirs: LOCATE SEARCH_DIR config or the instrument sdata dirs.
+    """
+    if ('SEARCH_DIR' in instrObj.config['LOCATE']): return [instrObj.config['LOCATE']['SEARCH_DIR']]
+    else                                          : return instrObj.get_dir_list()
+
+
+def locate_records(instrObj, records, seen=None):
+    """
+    Generator running located file records through the instrument filter and dep_rawfiles
+    (validate, stage) with the configured copier.
+    """
+    rules = instrObj.get_locate_rules()
+    isReprocess = int(instrObj.config['MISC']['REPROCESS']) if 'REPROCESS' in instrObj.config['MISC'] else 0
+    records = filter_records(records, rules)
+    return dep_rawfiles(instrObj.instr, records, instrObj.dirs['anc'], isReprocess, instrObj.log,
+                        instrObj.dirs['stage'], get_stage_copier(instrObj), rules,
+                        instrObj.get_locate_companions, seen)
+
+
+def get_stage_copier(instrObj):
+    stageMethod = instrObj.config['LOCATE']['STAGE_METHOD'] if 'STAGE_METHOD' in instrObj.config['LOCATE'] else 'copy'
+    return StageCopier(
+        numWorkers     = int  (instrObj.config['LOCATE']['STAGE_WORKERS'])       if 'STAGE_WORKERS'       in instrObj.config['LOCATE'] else 4,
+        maxMBps        = float(instrObj.config['LOCATE']['STAGE_MAX_MBPS'])      if 'STAGE_MAX_MBPS'      in instrObj.config['LOCATE'] else 0,
+        maxFilesPerSec = float(instrObj.config['LOCATE']['STAGE_MAX_FILES_PS'])  if 'STAGE_MAX_FILES_PS'  in instrObj.config['LOCATE'] else 0,
+        method         = stageMethod,
+        log            = instrObj.log)
+
+
+def get_watch_manifest_file(stageDir, instr):
+    return stageDir + '/dep_locate' + instr + '.watch.jsonl'
+
+
+def get_watch_records(instrObj):
+    """
+    Records written by watch mode, minus accepted ones whose staged file is gone (those are redone).
+    """
+    watchFile = get_watch_manifest_file(instrObj.dirs['stage'], instrObj.instr)
+    if not os.path.isfile(watchFile): return []
+    records = read_locate_manifest(watchFile, acceptedOnly=False)
+    return [r for r in records if r['status'] != 'accept' or os.path.isfile(r['file'])]
+
+
+def is_watch_record_current(record, current, log=None):
+    """
+    False if the record's source was found again with a different mtime or size (its staged
+    copy is then removed so it is staged again).  Sources not found (ie companions) are kept.
+    """
+    found = current.get(record['source'])
+    if found == None or found == (record['mtime'], record['size']): return True
+
+    if log: log.info('dep_locate: {} changed after watch mode located it, redoing'.format(record['source']))
+    if record['status'] == 'accept' and record['file'] != record['source'] and os.path.isfile(record['file']):
+        os.remove(record['file'])
+    return False
+
+
+#ioctl to clone a file's extents (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+#errors that mean "this method doesn't work here", so fall back to a plain copy
+FALLBACK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EBADF)
+
+
+def copy_file(source, destination, method='copy', limiter=None):
     '''
     Copy source file to destination.  If destination directory does nott
     exist, then create it.
 
+    Methods:
+        copy            : shutil.copy2
+        hardlink        : os.link (staged file shares the raw file's inode; nothing writes to staged files)
+        reflink         : copy-on-write clone (FICLONE)
+        copy_file_range : in-kernel copy (os.copy_file_range)
+    Any method falls back to copy if not supported (ie source and destination on
+    different filesystems).  Returns method used (None if destination already exists).
+
     @type source: string
     @param source: The source file path
     @type destination: string
     @param destination: The destination file path
+    @type method: string
+    @param method: staging method
+    @type limiter: IoLimiter
+    @param limiter: optional bandwidth / files per sec limits
     '''
 
     rDir = os.path.dirname(destination)
     if not os.path.exists(rDir):
-        os.makedirs(rDir)
-    if not os.path.exists(destination):
-        shutil.copy2(source, destination)
+        os.makedirs(rDir, exist_ok=True)
+    if os.path.exists(destination):
+        return None
+
+    if limiter: limiter.wait_file()
+    try:
+        if method == 'hardlink':
+            os.link(source, destination)
+            return method
+        elif method == 'reflink':
+            reflink_file(source, destination)
+            return method
+        elif method == 'copy_file_range':
+            copy_file_range(source, destination)
+            return method
+    except OSError as e:
+        if e.errno not in FALLBACK_ERRNOS: raise
+        if os.path.lexists(destination): os.remove(destination)
+
+    copy_file_chunked(source, destination, limiter)
+    return 'copy'
+
+
+def copy_file_chunked(source, destination, limiter=None, chunkSize=1024*1024):
+    '''
+    Same as shutil.copy2 but in chunks, applying the limiter bandwidth cap.
+    '''
+    with open(source, 'rb') as fin, open(destination, 'wb') as fout:
+        while True:
+            chunk = fin.read(chunkSize)
+            if not chunk: break
+            if limiter: limiter.wait_bytes(len(chunk))
+            fout.write(chunk)
+    shutil.copystat(source, destination)
+
+
+def reflink_file(source, destination):
+    '''
+    Copy-on-write clone of source (raises OSError if the filesystem can't).
+    '''
+    with open(source, 'rb') as fin, open(destination, 'wb') as fout:
+        fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+    shutil.copystat(source, destination)
+
+
+def copy_file_range(source, destination):
+    '''
+    In-kernel copy of source (raises OSError if not supported, ie across filesystems on older kernels).
+    '''
+    with open(source, 'rb') as fin, open(destination, 'wb') as fout:
+        remaining = os.fstat(fin.fileno()).st_size
+        while remaining > 0:
+            num = os.copy_file_range(fin.fileno(), fout.fileno(), remaining)
+            if num == 0: break
+            remaining -= num
+    shutil.copystat(source, destination)
+
 
+class TokenBucket:
+    '''
+    Thread-safe rate limit: consume(n) sleeps as needed to keep the average rate <= rate per sec.
+    '''
 
-def dep_rawfiles(instr, utDate, inFile, outFile, ancDir, isReprocess, log):
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst else rate
+        self.tokens = 0
+        self.last = t.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, num):
+        if not self.rate: return
+        with self.lock:
+            now = t.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= num
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0: t.sleep(wait)
+
+
+class IoLimiter:
+    '''
+    Bandwidth (MB/s) and files per second caps shared by all copy threads (0 = no limit).
+    '''
+
+    def __init__(self, maxMBps=0, maxFilesPerSec=0):
+        self.bytesBucket = TokenBucket(maxMBps * 1e6) if maxMBps else None
+        self.filesBucket = TokenBucket(maxFilesPerSec) if maxFilesPerSec else None
+
+    def wait_bytes(self, num):
+        if self.bytesBucket: self.bytesBucket.consume(num)
+
+    def wait_file(self):
+        if self.filesBucket: self.filesBucket.consume(1)
+
+
+class StageCopier:
+    '''
+    Copies files to the stage dir on a bounded thread pool, with optional bandwidth and
+    files per second caps so staging doesn't starve an instrument host still writing data.
+    Progress/throughput is logged.
+    '''
+
+    def __init__(self, numWorkers=4, maxMBps=0, maxFilesPerSec=0, method='copy', log=None, progressSecs=10):
+        self.numWorkers = max(1, numWorkers)
+        self.limiter = IoLimiter(maxMBps, maxFilesPerSec)
+        self.method = method
+        self.log = log
+        self.progressSecs = progressSecs
+        self.lock = threading.Lock()
+
+
+    def copy_all(self, jobs):
+        '''
+        Copies (source, destination, method) jobs concurrently.  Returns list of method used
+        in job order.
+        '''
+        return list(self.map(self.copy_one, jobs))
+
+
+    def map(self, func, items):
+        '''
+        Generator running func(item) on the copy threads, yielding results in item order.
+        func does its copies with copy_one (so they are counted in the progress/summary logs).
+        '''
+
+        self.numDone = 0
+        self.numBytes = 0
+        self.start = t.time()
+        self.lastLog = self.start
+
+        with ThreadPoolExecutor(max_workers=self.numWorkers) as executor:
+            yield from executor.map(func, items)
+
+        secs = max(t.time() - self.start, 1e-6)
+        if self.log and self.numDone:
+            self.log.info('dep_locate: staged {} files, {:.1f} MB in {:.1f}s ({:.1f} MB/s)'.format(
+                          self.numDone, self.numBytes / 1e6, secs, self.numBytes / 1e6 / secs))
+
+
+    def copy_one(self, job):
+        source, destination, method = job
+        if self.log: self.log.info('copying file {} to {}'.format(source, destination))
+        used = copy_file(source, destination, method, self.limiter)
+        if used and used != method and self.log:
+            self.log.info('copy_file: {} not possible, used {}'.format(method, used))
+
+        size = os.path.getsize(destination)
+        with self.lock:
+            self.numDone += 1
+            self.numBytes += size
+            now = t.time()
+            if self.log and now - self.lastLog >= self.progressSecs:
+                self.lastLog = now
+                secs = now - self.start
+                self.log.info('dep_locate: staged {} files so far, {:.1f} MB, {:.1f} MB/s'.format(
+                              self.numDone, self.numBytes / 1e6, self.numBytes / 1e6 / secs))
+        return used
+
+
+def filter_records(records, rules):
     """
-    This function will remove empty, corrupt, and non-raw fits files
-    and create a new outFile list.
+    Generator dropping records whose path is excluded by the instrument rules.
+    """
+    for record in records:
+        if rules.is_located(record['source']): yield record
+
+
+def dep_rawfiles(instr, records, ancDir, isReprocess, log, stageDir=None, copier=None, rules=None, companions=None, seen=None):
+    """
+    Generator that validates located records, removing empty, corrupt, and non-raw fits files
+    (copied to anc/udf), then stages the good ones.  Every record is yielded, in input order,
+    with its status set (see check_raw_file).
+    Files are checked in place and only the good ones are copied to stageDir (record 'file'
+    is then the staged copy).  Staged .fits.gz files are unzipped.
+    Companion files of the good files (ie DEIMOS FCS configs) are checked and staged
+    after all the located files, once each.
 
     Written by Jeff Mader
 
@@ -163,86 +385,229 @@ def dep_rawfiles(instr, utDate, inFile, outFile, ancDir, isReprocess, log):
 
     @type instr: string
     @param instr: The instrument used to make the fits files being looked at
-    @type utDate: datetime
-    @param utDate: The date in UT of the night that the fits tiles were taken
-    @type inFile: string
-    @param inFile: Filepath of text file with list of all FITS files within 24 hours of the given date
-    @type outFile: string
-    @param outFile: Filepath for final output file for all valid FITS passing checks.
+    @type records: iterable
+    @param records: records (see make_record) for the FITS files found within the 24 hour window
     @type ancDir: string
     @param ancDir: The anc directory to store the bad and corrupted fits files
     @type log: Logger Object
     @param log: The log handler for the script. Writes to the logfile
+    @type stageDir: string
+    @param stageDir: stage dir to copy good files to (None if files are already staged)
+    @type copier: StageCopier
+    @param copier: copies good files to stageDir (default is a plain serial copy)
+    @type rules: LocateRules
+    @param rules: instrument locate rules (instrObj.get_locate_rules())
+    @type companions: function
+    @param companions: returns companion file paths from a primary header (instrObj.get_locate_companions)
+    @type seen: set
+    @param seen: source paths already located (companions in it are skipped; updated here
+                 with the records and the companions queued)
     """
-    log.info('dep_locate: starting rawfiles check: {0} {1} {2}'.format(instr, utDate, ancDir))
+    log.info('dep_locate: starting rawfiles check: {0} {1}'.format(instr, ancDir))
 
 
     #NOTE: duplicate KOAID and bad KOAID date/time check moved to DQA
 
-    # read input file list into an array
-    fitsList = []
-    with open(inFile, 'r') as ffiles:
-        for line in ffiles:
-            fitsList.append(line.strip())
-
-    # Check the validity of each fits file (raw[i]=1 means good file)
-    goodFiles = []
-    for i in range(len(fitsList)):
-
-        #only do these checks if not a reprocessing job
-        if not isReprocess:
-
-          # check for empty file
-          if (os.path.getsize(fitsList[i]) == 0):
-              copy_bad_file(instr, fitsList[i], ancDir, 'Empty File', log)
-              continue
-
-          # Get fits header (check for bad header)
-          try:
-              if instr == 'NIRC2':
-                  header0 = fits.getheader(fitsList[i], ignore_missing_end=True)
-                  header0['INSTRUME'] = 'NIRC2'
-              else:
-                  header0 = fits.getheader(fitsList[i])
-          except:
-              copy_bad_file(instr, fitsList[i], ancDir, 'Unreadable Header', log)
-              continue
-
-          # Construct the original file name
-          filename, successful = construct_filename(instr, fitsList[i], ancDir, header0, log)
-          if not successful:
-              copy_bad_file(instr, fitsList[i], ancDir, 'Bad Header', log)
-              continue
-
-          # Make sure constructed filename matches basename.
-          basename = os.path.basename(fitsList[i])
-          basename = basename.replace(".fits.gz", ".fits")
-          if filename != basename:
-              copy_bad_file(instr, fitsList[i], ancDir, 'Mismatched filename', log)
-              continue
-
-        #if we make it here, it is a good good file!
-        goodFiles.append(fitsList[i])
-
-
-    #look for .gz fits to unzip
-    for i in range(len(goodFiles)):
-      filepath = goodFiles[i]
-      targetDir = os.path.dirname(filepath)
-      if filepath.endswith('.fits.gz'):
-            output = subprocess.call(['gunzip', filepath])
-            goodFiles[i] = filepath.replace(".fits.gz", ".fits")
-
-
-    # Create final dqa_<instr>.txt file with only the good lines from dep_locateINSTR.txt
-    with open(outFile, 'w') as fhOut:
-        for line in goodFiles:
-            fhOut.write(line+ '\n')
+    if not rules: rules = LocateRules()
+    if not copier: copier = StageCopier(numWorkers=1, log=log)
+
+    # Check the validity of each fits file (primary header only), then copy good files
+    # to stage dir and unzip.  Runs on the copier threads.
+    # A failed copy or unzip rejects just that file (the partial staged copy is removed).
+    def check_and_stage(record):
+        check_raw_file(record, rules, isReprocess, companions)
+        if record['status'] != 'accept': return record
+        if stageDir:
+            newFile = ''.join((stageDir, record['source']))
+            try:
+                copier.copy_one((record['source'], newFile, copier.method))
+            except OSError as e:
+                log.warning('dep_locate: could not stage {}: {}'.format(record['source'], e))
+                remove_file(newFile)
+                record.update({'status': 'reject', 'reason': 'Copy failed', 'companions': []})
+                return record
+            record['file'] = newFile
+        if record['file'].endswith('.fits.gz'):
+            try:
+                record['file'] = gunzip_file(record['file'])
+            except (OSError, EOFError, zlib.error) as e:
+                log.warning('dep_locate: could not unzip {}: {}'.format(record['file'], e))
+                #never remove the raw file itself
+                if stageDir: remove_file(record['file'])
+                record.update({'status': 'reject', 'reason': 'Bad gzip', 'companions': []})
+        return record
+
+    #all located sources are known before any companion is queued, so a companion that is
+    #also a located file (ie later in the list) is only done once
+    numAccept = 0
+    numReject = 0
+    if seen == None: seen = set()
+    records = list(records)
+    seen.update(record['source'] for record in records)
+    companionRecords = []
+    for batch in (records, companionRecords):
+        for record in copier.map(check_and_stage, batch):
+            if record['status'] == 'reject':
+                #udf copies of rejects are done here so they are logged in input order
+                copy_bad_file(instr, record['source'], ancDir, record['reason'], log, rules)
+                numReject += 1
+            else:
+                numAccept += 1
+            yield record
+
+            #queue companions not already located (first pass only)
+            if batch is companionRecords: continue
+            for path in record['companions']:
+                if path in seen: continue
+                seen.add(path)
+                companionRecords.append(make_record(path))
+
+    log.info('dep_locate: {} files accepted, {} rejected'.format(numAccept, numReject))
 
 #------------------END RAWFILES-----------------------------
 
 
-def copy_bad_file(instr, fitsFile, ancDir, errorCode, log):
+def make_record(path, mtime=None, size=None):
+    """
+    New located file record (see check_raw_file for the fields).
+    """
+    return {'source': path, 'file': path, 'size': size, 'mtime': mtime, 'status': 'accept',
+            'reason': None, 'filename': None, 'header': None, 'companions': []}
+
+
+def check_raw_file(record, rules, isReprocess, companions=None):
+    """
+    Checks one raw FITS file (empty, unreadable primary header, bad or mismatched
+    filename keywords).  Safe to run in a worker thread.  Sets and returns record:
+        source  : raw file path
+        file    : path the file is used from (staged and unzipped copy)
+        size    : raw file size (bytes)
+        mtime   : raw file mod time
+        status  : 'accept' or 'reject'
+        reason  : reject reason (None if accepted)
+        filename: original filename from the header keywords (None if not checked)
+        header  : primary header cards string (None if not checked)
+        companions: companion file paths from the header (see Instrument.get_locate_companions)
+    """
+
+    filepath = record['source']
+    size = record['size']
+    try:
+        if size == None or record['mtime'] == None:
+            st = os.stat(filepath)
+            record['size'] = size = st.st_size
+            record['mtime'] = st.st_mtime
+    except OSError:
+        pass
+
+    #only do these checks if not a reprocessing job
+    if isReprocess: return record
+
+    # check for empty file
+    if not size:
+        record.update({'status': 'reject', 'reason': 'Empty File'})
+        return record
+
+    # Get fits primary header (check for bad header)
+    try:
+        header0 = fits.getheader(filepath, ignore_missing_end=rules.ignoreMissingEnd)
+    except:
+        record.update({'status': 'reject', 'reason': 'Unreadable Header'})
+        return record
+
+    # Construct the original file name
+    filename, reason = rules.construct_filename(header0)
+    if reason:
+        record.update({'status': 'reject', 'reason': reason})
+        return record
+    record['filename'] = filename
+
+    # Make sure constructed filename matches basename.
+    basename = os.path.basename(filepath)
+    basename = basename.replace(".fits.gz", ".fits")
+    if filename != basename:
+        record.update({'status': 'reject', 'reason': 'Mismatched filename'})
+        return record
+
+    #keep header so later steps don't read it again
+    record['header'] = header0.tostring()
+    if companions: record['companions'] = companions(header0)
+    return record
+
+
+def gunzip_file(filepath, chunkSize=1024*1024):
+    """
+    Unzips filepath (.fits.gz) in place like gunzip (keeps mod time, removes the .gz)
+    but streams it in this process.  Returns the unzipped filepath.  On error (ie a
+    truncated .gz) the partial unzipped file is removed and the .gz is left as is.
+    """
+    newFile = filepath[:-3]
+    tmpFile = newFile + '.tmp'
+    try:
+        with gzip.open(filepath, 'rb') as fin, open(tmpFile, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, chunkSize)
+        shutil.copystat(filepath, tmpFile)
+    except BaseException:
+        remove_file(tmpFile)
+        raise
+    os.replace(tmpFile, newFile)
+    os.remove(filepath)
+    return newFile
+
+
+def remove_file(filepath):
+    """
+    Removes filepath if it exists.
+    """
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+
+
+def get_locate_manifest_file(stageDir, instr):
+    return stageDir + '/dep_locate' + instr + '.jsonl'
+
+
+def write_locate_manifest(manifestFile, records, append=False):
+    """
+    Writes records (JSON lines) as they come in.  Returns number of accepted records.
+    File is moved into place when complete (or appended to, line by line).
+    """
+    num = 0
+    tmpFile = manifestFile if append else manifestFile + '.tmp'
+    with open(tmpFile, 'a' if append else 'w') as fp:
+        for record in records:
+            fp.write(json.dumps(record) + '\n')
+            if append: fp.flush()
+            if record['status'] == 'accept': num += 1
+    if not append: os.replace(tmpFile, manifestFile)
+    return num
+
+
+def read_locate_manifest(manifestFile, acceptedOnly=True):
+    """
+    Returns list of dep_locate records (accepted ones only by default).
+    """
+    records = []
+    with open(manifestFile, 'r') as fp:
+        for line in fp:
+            if not line.strip(): continue
+            record = json.loads(line)
+            if acceptedOnly and record['status'] != 'accept': continue
+            records.append(record)
+    return records
+
+
+def get_record_header(record):
+    """
+    Returns a new astropy Header from the record header string (None if there isn't one).
+    """
+    if not record.get('header'): return None
+    return fits.Header.fromstring(record['header'])
+
+
+def copy_bad_file(instr, fitsFile, ancDir, errorCode, log, rules=None):
     """
     This function logs the type of error encountered
     and copies the bad fits file to anc_dir/udf
@@ -257,13 +622,16 @@ def copy_bad_file(instr, fitsFile, ancDir, errorCode, log):
     @param errorCode: How the fits file failed. Used in the logging
     @type log: Logger Object
     @param log: The log handler for the script. Writes to the logfile
+    @type rules: LocateRules
+    @param rules: instrument locate rules (udfSkips)
     """
     if errorCode == 'KOADATE':
         log.warning('rawfiles {}: KOAID not correct date for {}'.format(instr, fitsFile))
     else:
         log.warning('rawfiles {}: {} found for {}'.format(instr, errorCode, fitsFile))
-    # Don't copy OSIRIS SPEC ORP and cal files
-    if '/SPEC/ORP/' in fitsFile or '/SPEC/cal/' in fitsFile or 'mdark.fits' in fitsFile:
+    # Don't copy OSIRIS SPEC ORP and cal files, etc
+    if not rules: rules = LocateRules()
+    if rules.skip_udf(fitsFile):
         log.info('rawfiles {}: Skipping copy of {} to udf'.format(instr, fitsFile))
         return
     log.info('rawfiles {}: Copying {} to {}/udf'.format(instr, fitsFile, ancDir))
@@ -277,108 +645,65 @@ def copy_bad_file(instr, fitsFile, ancDir, errorCode, log):
 #-------------End copy-bad-file()---------------------------
 
 
-def construct_filename(instr, fitsFile, ancDir, keywords, log):
-   """
-    Constructs the original filename from the fits header keywords
 
-    @type instr: string
-    @param instr: The keyword for the instrument
-    @type fitsFile: string
-    @param fitsFile: The current fits file being observed
-    @type ancDir: str
-    @param ancDir: The anc directory to copy bad files
-    @type keywords: dictionary
-    @param keywords: The pairing of all the fits keywords with their values
-    @type log: Logger Object
-    @param log: The log handler for the script. Writes to the logfile
-   """
-
-   #TODO: move this to instrument classes
-
-   if instr in ['MOSFIRE', 'NIRES', 'NIRSPEC', 'OSIRIS']:
-       try:
-           outfile = keywords['DATAFILE']
-           if '.fits' not in outfile:
-               outfile = ''.join((outfile, '.fits'))
-           return outfile, True
-       except KeyError:
-           copy_bad_file(
-                   instr, fitsFile, ancDir, 'Bad Outfile', log)
-           return '', False
-   elif instr in ['KCWI']:
-       try:
-           outfile = keywords['OFNAME']
-           return outfile, True
-       except KeyError:
-           copy_bad_file(
-                   instr, fitsFile, ancDir, 'Bad Outfile', log)
-           return '', False
-   else:
-       try:
-           outfile = keywords['OUTFILE']
-       except KeyError:
-           try:
-               outfile = keywords['ROOTNAME']
-           except KeyError:
-               try:
-                   outfile = keywords['FILENAME']
-               except KeyError:
-                   copy_bad_file(
-                           instr, fitsFile, ancDir, 'Bad Outfile', log)
-                   return '', False
-
-   # Get the frame number of the file
-   if outfile[:2] == 'kf':
-       frameno = keywords['IMGNUM']
-   elif instr == 'MOSFIRE':
-       frameno = keywords['FRAMENUM']
-   # NIRES currently does not have a FRAMENO keyword, use datafile
-   elif instr == 'NIRES':
-       garbage, frameno = keywords['DATAFILE'].split('_')
-   else:
-       try:
-           frameno = keywords['FRAMENO']
-       except KeyError:
-           try:
-               frameno = keywords['FILENUM']
-           except KeyError:
-               try:
-                   frameno = keywords['FILENUM2']
-               except KeyError:
-                   copy_bad_file(
-                           instr, fitsFile, ancDir, 'Bad Frameno', log)
-                   return '', False
-
-   # Determine the amount of 0 padding that must be done
-   zero = ''
-   if float(frameno) < 10:
-       zero = '000'
-   elif float(frameno) >= 10 and float(frameno) < 100:
-       zero = '00'
-   elif float(frameno) >= 100 and float(frameno) < 1000:
-       zero = '0'
-
-   # Construct the original file name from the previous parts
-   filename = ''.join((outfile.strip(), zero, str(frameno).strip(), '.fits'))
-   return filename, True
-
-#---------------------End construct_filename-------------------------
-
-
-def find_24hr_fits(useDirs, utDate, endTime, modtimeOverride=0):
-    """
-    Uses the os.walk function to recurse through a given directory
-    and return all the leaf files which are checked to be
-    fits files.
-
-    @type useDirs: string
-    @param useDirs: The directory that we want to search in
+
+def find_24hr_fits(useDirs, utDate, endTime, modtimeOverride=0, numWorkers=8, pruneSlack=-1, locateIndex=None):
+    """
+    Recurses through the given directories (concurrently, one thread per search root)
+    with os.scandir and returns a (path, mtime, size) record for each FITS file
+    modified within the 24 hour window, sorted by mod time.
+
+    NOTE: With pruneSlack >= 0, files in a directory whose mtime is more than pruneSlack
+    seconds before the window are not stat'ed at all (subdirectories are always searched).
+    A directory's mtime only changes when entries are added/removed, so this misses files
+    rewritten in place in older dirs.  pruneSlack < 0 (default) stats every file.
+
+    @type useDirs: list
+    @param useDirs: The directories that we want to search in
     @type utDate: datetime
     @param utDate: The date of observation of the files we want to search for
-    @type outfile: string
-    @param outfile: Where we want to store the output
-    @type log: Logger Object
-    @param log: The log handler for the script. Writes to the logfile
+    @type endTime: string
+    @param endTime: 24 hour window end time (UT)
+    @type modtimeOverride: int
+    @param modtimeOverride: 1 to return all FITS files regardless of mod time
+    @type numWorkers: int
+    @param numWorkers: max number of search roots walked at once
+    @type pruneSlack: int
+    @param pruneSlack: seconds of slack for skipping stale directories
+    @type locateIndex: LocateIndex
+    @param locateIndex: if given, update this persistent index incrementally and query it instead
+    """
+
+    minTimeSinceMod, maxTimeSinceMod = get_24hr_window(utDate, endTime)
+
+    # Incremental search using the persistent index
+    if locateIndex:
+        locateIndex.update(useDirs, numWorkers)
+        if modtimeOverride == 1: return locateIndex.find(useDirs)
+        return locateIndex.find(useDirs, minTimeSinceMod, maxTimeSinceMod)
+
+    # Directories last changed before this can't hold files created in the window
+    pruneTime = None
+    if modtimeOverride != 1 and pruneSlack >= 0:
+        pruneTime = minTimeSinceMod - pruneSlack
+
+    # Walk each search root in its own thread (results kept in useDirs order)
+    with ThreadPoolExecutor(max_workers=max(1, numWorkers)) as executor:
+        results = executor.map(lambda d: scan_fits_dir(d, minTimeSinceMod, maxTimeSinceMod, modtimeOverride, pruneTime), useDirs)
+        records = [rec for recs in results for rec in recs]
+
+    #sort all files by mod time
+    #NOTE: This is important for getProgInfo to assign programs for split nights
+    #(and ensuring latter duplicates are kicked out instead of first original)
+    records.sort(key=lambda rec: rec[1])
+
+    return records
+
+
+def get_24hr_window(utDate, endTime):
+    """
+    Returns (min, max) mod time (sec since epoch) of the 24 hour window ending at utDate endTime (UT).
+    Files in the window have min < mtime <= max.
     """
 
     # Break utDate into its pieces
@@ -401,31 +726,58 @@ def find_24hr_fits(useDirs, utDate, endTime, modtimeOverride=0):
     # All valid files should fall within these boundaries
     maxTimeSinceMod = cal.timegm(t.strptime(utMaxTime, '%Y%m%d %H:%M:%S'))
     minTimeSinceMod = cal.timegm(t.strptime(utMinTime, '%Y%m%d %H:%M:%S'))
+    return minTimeSinceMod, maxTimeSinceMod
 
-    # Iterate through the list of directories from the locate script to look for fits files
-    filePaths = []
-    for fitsDir in useDirs:
-        for root, dirs, files in os.walk(fitsDir):
-            for item in sorted(files):
-                if not '.fits' in item: continue
-
-                # Create the path to the current file we want to check
-                if root.endswith('/'): root = root[:-1]
-                fullPath = ''.join((root, '/', item))
 
-                # Check to see if the file is a fits file created/modified in the last day. 
-                # st_mtime needs to be greater than the minTimeSinceMod to be within the past 24 hours
-                modTime = os.stat(fullPath).st_mtime
-                if ( (modTime <= maxTimeSinceMod and modTime > minTimeSinceMod) or modtimeOverride == 1):
-                    filePaths.append(fullPath)
-
-    #sort all files by mod time
-    #NOTE: This is important for getProgInfo to assign programs for split nights
-    #(and ensuring latter duplicates are kicked out instead of first original)
-    filePaths.sort(key=lambda p: os.stat(p).st_mtime)
+def scan_fits_dir(fitsDir, minTimeSinceMod, maxTimeSinceMod, modtimeOverride=0, pruneTime=None):
+    """
+    Finds FITS files under fitsDir with minTimeSinceMod < mtime <= maxTimeSinceMod.
+    Returns list of (path, mtime, size) in walk order (dirs and files sorted by name).
+    Like os.walk, symlinked dirs are not followed and unreadable dirs are skipped.
+    """
 
-    return filePaths
+    if fitsDir.endswith('/'): fitsDir = fitsDir[:-1]
+
+    records = []
+    stack = [fitsDir]
+    while stack:
+        root = stack.pop()
+        try:
+            with os.scandir(root) as it:
+                entries = sorted(it, key=lambda e: e.name)
+            checkFiles = True
+            if pruneTime != None:
+                checkFiles = os.stat(root).st_mtime >= pruneTime
+        except OSError:
+            continue
+
+        subdirs = []
+        for entry in entries:
+            try:
+                isDir = entry.is_dir()
+            except OSError:
+                continue
+            if isDir:
+                if not entry.is_symlink(): subdirs.append(entry.path)
+                continue
+
+            if not checkFiles: continue
+            if not '.fits' in entry.name: continue
+
+            # Check to see if the file is a fits file created/modified in the last day. 
+            # st_mtime needs to be greater than the minTimeSinceMod to be within the past 24 hours
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            modTime = st.st_mtime
+            if ( (modTime <= maxTimeSinceMod and modTime > minTimeSinceMod) or modtimeOverride == 1):
+                records.append((entry.path, modTime, st.st_size))
+
+        #depth first in name order
+        stack.extend(reversed(subdirs))
+
+    return records
 
 
 #-----------------------End find_24hr_fits-----------------------------------
-
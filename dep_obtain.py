@@ -42,7 +42,7 @@ def dep_obtain(instrObj):
         telnr = instrObj.get_telnr()
         oaUrl = ''.join((instrObj.telUrl, 'cmd=getNightStaff', '&date=', prevDate, '&telnr=', str(telnr), '&type=oa'))
         log.info('dep_obtain: retrieving night staff info: {}'.format(oaUrl))
-        oaData = get_api_data(oaUrl)
+        oaData = instrObj.get_cached_api_data(oaUrl)
         oa = 'None'
         if oaData:
             if isinstance(oaData, dict):
@@ -2,8 +2,13 @@ import os
 import shutil
 import tarfile
 import gzip
-import hashlib
+import zlib
+import numpy as np
+from astropy.io import fits
+from concurrent.futures import ThreadPoolExecutor
 from common import *
+from checksum import HashingFile, CHUNK_SIZE
+from pgzip import open_gzip
 from datetime import datetime as dt
 
 
@@ -24,11 +29,19 @@ def dep_tar(instrObj, tpx):
     log.info('dep_tar.py started.')
 
 
-    #gzip the fits files
-    log.info(f'dep_tar.py gzipping fits files in {dirs["lev0"]}')
-    gzip_dir_fits(dirs['lev0'])
-    log.info(f'dep_tar.py gzipping fits files in {dirs["lev1"]}')
-    gzip_dir_fits(dirs['lev1'])
+    #gzip (or tile compress) the fits files
+    config = instrObj.config['MISC']
+    numWorkers = int(config['GZIP_WORKERS'])   if 'GZIP_WORKERS'  in config else 4
+    level      = int(config['GZIP_LEVEL'])     if 'GZIP_LEVEL'    in config else 5
+    fmt        = config['FITS_COMPRESS']       if 'FITS_COMPRESS' in config else 'gzip'
+    numFailed = 0
+    for key in ('lev0', 'lev1'):
+        log.info(f'dep_tar.py compressing ({fmt}) fits files in {dirs[key]}')
+        numFailed += gzip_dir_fits(dirs[key], level, numWorkers, fmt, log)
+
+    #don't tar or mark archive ready with uncompressed files left
+    if numFailed > 0:
+        raise Exception('dep_tar.py: {} fits files could not be compressed'.format(numFailed))
 
 
     #tar /anc/ if exists
@@ -38,31 +51,25 @@ def dep_tar(instrObj, tpx):
         log.info(f'dep_tar: tar and zipping {dirs["anc"]}.')
 
         # Tarball name
-        tarFileName = 'anc' + instrObj.utDateDir + '.tar'
+        gzipTarFile = 'anc' + instrObj.utDateDir + '.tar.gz'
 
         # Go to anc directory
         myCwd = os.getcwd()
         os.chdir(dirs['anc'])
 
-        # Create tarball
-        log.info('dep_tar.py creating {}'.format(tarFileName))
-        with tarfile.open(tarFileName, 'w:gz') as tar:
-            tar.add('./')
-
-        # gzip the tarball
-        log.info('dep_tar.py gzipping {}'.format(tarFileName))
-        gzipTarFile = tarFileName + '.gz'
-        with open(tarFileName, 'rb') as fIn:
-            with gzip.open(gzipTarFile, 'wb') as fOut:
-                shutil.copyfileobj(fIn, fOut)
-
-        # Remove the original tar file
-        os.remove(tarFileName)
+        # Create tarball in one pass: tar stream -> gzip (block-parallel) -> file, md5 computed while writing
+        # NOTE: tarfile skips the tarball itself since it is given the same name
+        numWorkers = int(instrObj.config['MISC']['GZIP_WORKERS']) if 'GZIP_WORKERS' in instrObj.config['MISC'] else 4
+        log.info('dep_tar.py creating {} ({} compression threads)'.format(gzipTarFile, numWorkers))
+        with HashingFile(gzipTarFile) as fOut:
+            with open_gzip(fOut, numWorkers=numWorkers) as gzOut:
+                with tarfile.open(gzipTarFile, 'w|', fileobj=gzOut) as tar:
+                    tar.add('./')
 
         # Create md5sum of the tarball
         md5sumFile = gzipTarFile.replace('tar.gz', 'md5sum')
         log.info('dep_tar.py creating {}'.format(md5sumFile))
-        md5 = hashlib.md5(open(gzipTarFile, 'rb').read()).hexdigest()
+        md5 = fOut.hexdigest()
         with open(md5sumFile, 'w') as f:
             md5 = ''.join((md5, '  ', gzipTarFile))
             f.write(md5)
@@ -83,23 +90,126 @@ def dep_tar(instrObj, tpx):
     if tpx:
         log.info('dep_dqa.py: updating tpx DB records')
         utcTimestamp = dt.utcnow().strftime("%Y%m%d %H:%M")
-        update_koatpx(instr, utDate, 'arch_stat', 'DONE', log)
-        update_koatpx(instr, utDate, 'arch_time', utcTimestamp, log)       
-        update_koatpx(instr, utDate, 'size', get_directory_size(dirs['output']), log)
+        tpxUpdater = TpxUpdater(instr, utDate, dirs['process'], log)
+        tpxUpdater.add('arch_stat', 'DONE')
+        tpxUpdater.add('arch_time', utcTimestamp)
+        tpxUpdater.add('size', get_directory_size(dirs['output']))
+        tpxUpdater.flush()
 
 
     log.info('dep_tar.py complete.')
 
 
 
-def gzip_dir_fits(dirPath):
+def gzip_dir_fits(dirPath, level=5, numWorkers=4, fmt='gzip', log=None):
+    '''
+    Compresses all .fits files under dirPath, numWorkers at a time, to .fits.gz (fmt='gzip')
+    or tile compressed .fits.fz (fmt='rice').  Each output is written to a temp file and
+    verified before it replaces the .fits file.  Returns number of files that failed
+    (those are left uncompressed).
+    '''
+
+    if fmt not in ('gzip', 'rice'):
+        raise Exception('dep_tar.py: unknown FITS compression "{}"'.format(fmt))
+    compress = gzip_fits_file if fmt == 'gzip' else tile_compress_fits_file
 
+    paths = []
     for dirpath, dirnames, filenames in os.walk(dirPath):
         for f in filenames:
             if f.endswith('.fits'):
-                in_path = os.path.join(dirpath, f)
-                out_path = in_path + '.gz'
-                with open(in_path, 'rb') as fIn:
-                    with gzip.open(out_path, 'wb', compresslevel=5) as fOut:
-                        shutil.copyfileobj(fIn, fOut)
-                        os.remove(in_path)
+                paths.append(os.path.join(dirpath, f))
+
+    def run(path):
+        try:
+            compress(path, level)
+            return True
+        except Exception as e:
+            if log: log.error('dep_tar.py: could not compress {}: {}'.format(path, e))
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(1, numWorkers)) as executor:
+        numFailed = sum(1 for ok in executor.map(run, paths) if not ok)
+
+    if log and paths:
+        log.info('dep_tar.py: {} fits files compressed, {} failed'.format(len(paths) - numFailed, numFailed))
+    return numFailed
+
+
+def gzip_fits_file(inPath, level=5):
+    '''
+    Gzips inPath to inPath.gz (via a temp file).  The temp file is decompressed again and
+    checked against the input's crc32 and size before the input is removed.
+    '''
+
+    outPath = inPath + '.gz'
+    tmpPath = outPath + '.tmp'
+    try:
+        crc = size = 0
+        with open(inPath, 'rb') as fIn, open(tmpPath, 'wb') as fp:
+            with gzip.GzipFile(outPath, 'wb', level, fp) as fOut:
+                for chunk in iter(lambda: fIn.read(CHUNK_SIZE), b''):
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+                    fOut.write(chunk)
+
+        outCrc = outSize = 0
+        with gzip.open(tmpPath, 'rb') as fIn:
+            for chunk in iter(lambda: fIn.read(CHUNK_SIZE), b''):
+                outCrc = zlib.crc32(chunk, outCrc)
+                outSize += len(chunk)
+        if (outCrc, outSize) != (crc, size):
+            raise Exception('gzip verify failed (crc32/size mismatch)')
+
+        os.replace(tmpPath, outPath)
+    finally:
+        if os.path.isfile(tmpPath): os.remove(tmpPath)
+    os.remove(inPath)
+
+
+def tile_compress_fits_file(inPath, level=None):
+    '''
+    Tile compresses inPath to inPath.fz (fpack layout: empty primary HDU, each image HDU as a
+    compressed image).  Integer images use RICE_1, float images GZIP_2 (both lossless); other
+    HDUs are copied.  The data crc32 of every HDU is checked after reading the output back
+    before the input is removed.  level is not used.
+    '''
+
+    outPath = inPath + '.fz'
+    tmpPath = outPath + '.tmp'
+    try:
+        #NOTE: data is compressed as read (scaled), so ie BZERO unsigned ints stay integers
+        with fits.open(inPath) as hdus:
+            crcs = [get_data_crc(hdu.data) for hdu in hdus]
+            outHdus = fits.HDUList([fits.PrimaryHDU()])
+            for hdu in hdus:
+                if not isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)):
+                    outHdus.append(hdu.copy())
+                elif hdu.data is None:
+                    if not isinstance(hdu, fits.PrimaryHDU): outHdus.append(hdu.copy())
+                else:
+                    if hdu.data.dtype.kind in 'iu': comp = fits.CompImageHDU(hdu.data, hdu.header, compression_type='RICE_1')
+                    else: comp = fits.CompImageHDU(hdu.data, hdu.header, compression_type='GZIP_2', quantize_level=0)
+                    outHdus.append(comp)
+            outHdus.writeto(tmpPath)
+
+            #primary without data was dropped for the empty fpack primary
+            if hdus[0].data is None: crcs = crcs[1:]
+        with fits.open(tmpPath) as check:
+            outCrcs = [get_data_crc(hdu.data) for hdu in check[1:]]
+        if outCrcs != crcs:
+            raise Exception('tile compress verify failed (data crc32 mismatch)')
+
+        os.replace(tmpPath, outPath)
+    finally:
+        if os.path.isfile(tmpPath): os.remove(tmpPath)
+    os.remove(inPath)
+
+
+def get_data_crc(data):
+    '''
+    crc32 of an HDU's data values (native byte order), None if no data.
+    '''
+    if data is None: return None
+    if isinstance(data, np.ndarray) and data.dtype.names == None:
+        return zlib.crc32(np.ascontiguousarray(data, dtype=data.dtype.newbyteorder('=')).tobytes())
+    return zlib.crc32(np.asarray(data).tobytes())
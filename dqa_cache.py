@@ -0,0 +1,150 @@
+"""
+Per-file DQA result cache, so a rerun or resumed DQA only reprocesses files that changed.
+
+Entries are content addressed: the key is a sha1 of the raw file (source path, size, mtime),
+DEP_VERSION, a hash of the instrument/MISC config and the file's program info row.  Each
+entry (<cacheDir>/<key[:2]>/<key>.json) holds the DQA result (koaid, semid, ...), the
+primary header keyword deltas made by DQA and the output files with their size/mtime.
+An entry is only used if all its output files are still there unchanged.
+
+NOTE: Other inputs (ie weather/focus logs added by dep_add) are not part of the key.
+Delete the cache dir (or set MISC DQA_CACHE = 0) to force DQA to redo everything.
+
+NOTE: The cache lives in the stage dir, and a full run stops if the stage/lev0 dirs already
+exist (Instrument.init_dirs).  So it is only used by partial reruns that include dqa (ie
+procStart dqa in dep_go.py) after a crash or a config change.
+"""
+
+import os
+import json
+import hashlib
+
+
+#config values that don't change DQA output
+CONFIG_SKIPS = ('DQA_WORKERS', 'JPG_WORKERS', 'JPG_MAX_SIZE', 'JPG_DOWNSAMPLE', 'API_CACHE_TTL',
+                'DQA_CACHE', 'META_COMPARE_DIR')
+
+
+class DqaCache:
+
+    def __init__(self, cacheDir, instrObj, log=None):
+        '''
+        @param cacheDir: cache directory (ie stage/dqa_cache)
+        @param instrObj: instrument object (config and DEP_VERSION are part of the keys)
+        '''
+
+        self.cacheDir   = cacheDir
+        self.log        = log
+        self.version    = instrObj.config['INFO']['DEP_VERSION']
+        self.configHash = get_config_hash(instrObj.config, instrObj.instr)
+        self.hits       = 0
+        self.misses     = 0
+        os.makedirs(self.cacheDir, exist_ok=True)
+
+
+    def get_key(self, record, progRow=None):
+        '''
+        Cache key for a dep_locate record (see dep_locate.check_raw_file) and its program info row.
+        '''
+        data = [record['source'], record['size'], record['mtime'], self.version, self.configHash, progRow]
+        return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+    def get_file(self, key):
+        return self.cacheDir + '/' + key[:2] + '/' + key + '.json'
+
+
+    def get(self, key):
+        '''
+        Returns cached entry {'result', 'delta', 'outputs'} or None if not cached or outputs changed.
+        '''
+
+        entry = None
+        try:
+            with open(self.get_file(key), 'r') as fp:
+                entry = json.load(fp)
+            for path, (size, mtime) in entry['outputs'].items():
+                st = os.stat(path)
+                if st.st_size != size or st.st_mtime != mtime:
+                    entry = None
+                    break
+        except (OSError, ValueError, KeyError):
+            entry = None
+
+        if entry: self.hits += 1
+        else    : self.misses += 1
+        return entry
+
+
+    def put(self, key, result, delta, outputs):
+        '''
+        Saves result, header delta and output files (their current size/mtime) under key.
+        '''
+
+        entry = {'result': result, 'delta': delta, 'outputs': {}}
+        try:
+            for path in outputs:
+                st = os.stat(path)
+                entry['outputs'][path] = (st.st_size, st.st_mtime)
+            cacheFile = self.get_file(key)
+            os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+            tmpFile = cacheFile + '.' + str(os.getpid()) + '.tmp'
+            with open(tmpFile, 'w') as fp:
+                json.dump(entry, fp, default=to_json)
+            os.replace(tmpFile, cacheFile)
+        except (OSError, TypeError, ValueError) as e:
+            if self.log: self.log.warning('DqaCache: could not save entry {}: {}'.format(key, e))
+
+
+    def log_stats(self):
+        if self.log: self.log.info('DqaCache: {} cached, {} processed'.format(self.hits, self.misses))
+
+
+def get_config_hash(config, instr):
+    '''
+    Hash of the config values that can change DQA output (instrument and MISC sections).
+    '''
+    data = {}
+    for section in (instr, 'MISC'):
+        if section not in config: continue
+        data[section] = {key: val for key, val in config[section].items() if key.upper() not in CONFIG_SKIPS}
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def get_prog_row(progData, filepath):
+    '''
+    Program info row used for filepath (same match as Instrument.set_prog_info).
+    '''
+    for progFile in progData:
+        if progFile['file'] in filepath: return progFile
+    return None
+
+
+def get_header_delta(before, after):
+    '''
+    Keyword changes DQA made to a primary header: {'set': [(key, value, comment)], 'removed': [key]}.
+    Commentary cards (COMMENT, HISTORY, blank) are not compared.
+    '''
+
+    if before == None or after == None: return None
+    skip = ('COMMENT', 'HISTORY', '')
+    delta = {'set': [], 'removed': []}
+    for card in after.cards:
+        key = card.keyword
+        if key in skip: continue
+        if key not in before or before[key] != card.value or before.comments[key] != card.comment:
+            delta['set'].append((key, to_json(card.value), card.comment))
+    for key in before.keys():
+        if key not in skip and key not in after:
+            delta['removed'].append(key)
+    return delta
+
+
+def to_json(val):
+    '''
+    JSON friendly value (numpy scalars to python, undefined header values to None).
+    '''
+    if isinstance(val, (str, int, float, bool)) or val is None: return val
+    if hasattr(val, 'item'): return val.item()
+    if type(val).__name__ == 'Undefined': return None
+    return str(val)
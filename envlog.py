@@ -1,114 +1,173 @@
 import pandas as pd
+import numpy as np
+from datetime import datetime, timedelta
+
+
+#
+# Per log type: match interval (sec), output value names, header column names (with
+# {telnr} placeholder) and column indexes for old files without a header line
+#
+ENVLOG_TYPES = {
+    'envMet': {
+        'interval' : 30,
+        'output'   : ['wx_dewpoint',
+                      'wx_outhum',
+                      'wx_outtmp',
+                      'wx_domtmp',
+                      'wx_domhum',
+                      'wx_pressure',
+                      'wx_windspeed',
+                      'wx_winddir'],
+        'keys'     : [' "k0:met:dewpointRaw"',
+                      ' "k0:met:humidityRaw"',
+                      ' "k0:met:tempRaw"',
+                      ' "k{telnr}:met:tempRaw"',
+                      ' "k{telnr}:met:humidityRaw"',
+                      ' "k0:met:pressureRaw"',
+                      ' "k{telnr}:met:windSpeedRaw"',
+                      ' "k{telnr}:met:windAzRaw"'],
+        'indexes'  : [5, 8, 10, 18, 20, 22, 24, 27]
+    },
+    'envFocus': {
+        'interval' : 2.5,
+        'output'   : ['guidfwhm'],
+        'keys'     : [' "k{telnr}:dcs:pnt:cam0:fwhm"'],
+        'indexes'  : [26]
+    }
+}
+
+
+class EnvLogIndex:
+    '''
+    One night of envMet.arT or envFocus.arT data loaded once, with numeric value columns
+    and a sorted HST time index, for repeated nearest-time lookups by binary search.
+    '''
+
+    def __init__(self, logFile, logType, telnr):
+        '''
+        Reads the log file.  Raises an exception if the file cannot be read.
+
+        @param logFile: path to envMet.arT or envFocus.arT
+        @type logFile: string
+        @param logType: 'envMet' or 'envFocus'
+        @type logType: string
+        @param telnr: telescope number
+        @type telnr: int
+        '''
+
+        logDef = ENVLOG_TYPES[logType]
+        self.logType  = logType
+        self.interval = logDef['interval']
+        self.output   = logDef['output']
+        telnr = str(telnr)
+
+        #
+        # Skip first and third lines (interval and type lines), second line is header.
+        # Older files have no usable header so columns are by index.
+        #
+        data = pd.read_csv(logFile, skiprows=[0,2], dtype=object)
+        if 'UNIXDate' in data.keys():
+            hstKeys = ['HSTdate', 'HSTtime']
+            keys = [key.format(telnr=telnr) for key in logDef['keys']]
+        else:
+            hstKeys = [2, 3]
+            keys = logDef['indexes']
+            data = pd.read_csv(logFile, skiprows=[0,1,2], header=None, dtype=object)
+
+        #
+        # HST timestamps (bad rows dropped) sorted for searchsorted
+        #
+        envDatetime = data[hstKeys[0]] + ' ' + data[hstKeys[1]]
+        times = pd.to_datetime(envDatetime, format=' %d-%b-%Y %H:%M:%S.%f', errors='coerce')
+        good = times.notna().values
+        times = times.values[good].astype('datetime64[ns]').astype(np.int64)
+        order = np.argsort(times, kind='stable')
+        self.times = times[order]
+
+        #
+        # Numeric value columns (missing column or bad value is NaN -> 'null')
+        #
+        self.values = np.full((len(self.times), len(keys)), np.nan)
+        for col, key in enumerate(keys):
+            if key not in data.keys(): continue
+            vals = pd.to_numeric(data[key].str.strip(), errors='coerce').values.astype(float)
+            self.values[:, col] = vals[good][order]
+
+
+    def lookup(self, dateObs, utc):
+        '''
+        Returns dict of values for the entry nearest to and within +-interval seconds of
+        DATE-OBS/UTC.  Values are 'null' if there is no such entry.
+        '''
+        return self.lookup_many([dateObs], [utc])[0]
+
+
+    def lookup_many(self, dateObsList, utcList):
+        '''
+        Batch version of lookup() for many DATE-OBS/UTC pairs in one vectorized search.
+        Returns list of dicts in the same order as the inputs.
+        '''
+
+        #
+        # Convert DATE-OBS/UT to HST ns
+        #
+        targets = []
+        for dateObs, utc in zip(dateObsList, utcList):
+            utDatetime = datetime.strptime(dateObs + ' ' + utc, '%Y-%m-%d %H:%M:%S.%f')
+            utDatetime += timedelta(hours=-10)
+            targets.append(np.datetime64(utDatetime, 'ns').astype(np.int64))
+        targets = np.array(targets, dtype=np.int64)
+
+        #
+        # Nearest entry on either side of each target
+        #
+        num = len(self.times)
+        found = np.zeros(len(targets), dtype=bool)
+        best = np.zeros(len(targets), dtype=np.int64)
+        if num > 0 and len(targets) > 0:
+            right = np.searchsorted(self.times, targets)
+            left  = np.clip(right - 1, 0, num - 1)
+            right = np.clip(right, 0, num - 1)
+            dLeft  = np.abs(targets - self.times[left])
+            dRight = np.abs(targets - self.times[right])
+            best   = np.where(dRight < dLeft, right, left)
+            found  = np.minimum(dLeft, dRight) <= int(self.interval * 1e9)
+
+        results = []
+        for i in range(len(targets)):
+            values = {'time': 'null'}
+            for name in self.output: values[name] = 'null'
+            if found[i]:
+                #
+                # Timestamp of this entry in UT
+                #
+                mTime = pd.Timestamp(int(self.times[best[i]])).to_pydatetime()
+                mTime += timedelta(hours=10)
+                #todo: truncating microseconds b/c strftime does not support rounding overflow
+                values['time'] = mTime.strftime('%H:%M:%S.%f')[:-4]
+                for col, name in enumerate(self.output):
+                    value = self.values[best[i], col]
+                    if not np.isnan(value):
+                        values[name] = float("%0.2f" % value)
+            results.append(values)
+
+        return results
+
 
 def envlog(logFile, logType, telnr, dateObs, utc):
-    """ 
-    Retrieve nearest env log data from envMet.arT or envFocus.arT 
+    """
+    Retrieve nearest env log data from envMet.arT or envFocus.arT
     file that is closest to and within +-interval seconds of the input
     date and time.
+    NOTE: Reads the whole file each call.  Use EnvLogIndex when doing more than one lookup.
     """
-    #
-    # Defaults
-    #
-    telnr = str(telnr)
-    #
-    # Setup defaults and config based on logType
-    #
-    if logType == 'envMet':
-        interval = 30
-        values = {  'time'         : 'null',
-                    'wx_domtmp'    : 'null',
-                    'wx_outtmp'    : 'null',
-                    'wx_domhum'    : 'null',
-                    'wx_outhum'    : 'null',
-                    'wx_pressure'  : 'null',
-                    'wx_windspeed' : 'null',
-                    'wx_winddir'   : 'null',
-                    'wx_dewpoint'  : 'null'}
-        output = [  'wx_dewpoint', 
-                    'wx_outhum', 
-                    'wx_outtmp', 
-                    'wx_domtmp', 
-                    'wx_domhum', 
-                    'wx_pressure', 
-                    'wx_windspeed', 
-                    'wx_winddir']
-    elif logType == 'envFocus':
-        interval = 2.5
-        values = {'time' : 'null', 'guidfwhm' : 'null'}
-        output = ['guidfwhm']
-    else:
+    if logType not in ENVLOG_TYPES:
         return
-    #
-    # Read envlog file to determine if file and header exist
-    # Skip first and third lines (interval and type lines)
-    # Second line is header
-    #
+
     try:
-        #TODO: NOTE: added 'dtype=object' to skip low memory warning due to
-        #column mixed data types. We should define dtypes for columns to speed up.
-        data = pd.read_csv(logFile, skiprows=[0,2], dtype=object)
+        index = EnvLogIndex(logFile, logType, telnr)
     except Exception as e:
         print ('envlog: Unable to open: {}!'.format(logFile))
         return False
-    #
-    # Setup if using header or index numbers
-    #
-    if 'UNIXDate' in data.keys():
-        hstKeys = ['HSTdate', 'HSTtime']
-        keys = [' "k0:met:dewpointRaw"', 
-                ' "k0:met:humidityRaw"', 
-                ' "k0:met:tempRaw"', 
-                ' "k'+telnr+':met:tempRaw"', 
-                ' "k'+telnr+':met:humidityRaw"', 
-                ' "k0:met:pressureRaw"', 
-                ' "k'+telnr+':met:windSpeedRaw"', 
-                ' "k'+telnr+':met:windAzRaw"']
-        if logType == 'envFocus':
-            keys = [' "k'+telnr+':dcs:pnt:cam0:fwhm"']
-    else:
-        hstKeys = [2, 3]
-        keys = [5, 8, 10, 18, 20, 22, 24, 27]
-        if logType == 'envFocus':
-            keys = [26]
-        data = pd.read_csv(logFile, skiprows=[0,1,2], header=None, dtype=object)
-    #
-    # Convert DATE-OBS/UT to HST
-    #
-    from datetime import datetime, timedelta
-    utDatetime = datetime.strptime(dateObs + ' ' + utc, '%Y-%m-%d %H:%M:%S.%f')
-    utDatetime += timedelta(hours=-10)
-    #
-    # Find envMet entry within +-interval seconds of this time
-    #
-    dt1 = utDatetime + timedelta(seconds=-interval)
-    dt1 = dt1.strftime('%Y-%m-%d %H:%M:%S.%f')
-    dt2 = utDatetime + timedelta(seconds=interval)
-    dt2 = dt2.strftime('%Y-%m-%d %H:%M:%S.%f')
-    envDatetime = data[hstKeys[0]][0:] + ' ' + data[hstKeys[1]][0:]
-    envEntries = pd.to_datetime(envDatetime, format=' %d-%b-%Y %H:%M:%S.%f').between(dt1, dt2)
-    envIndex = envEntries.index[envEntries]
-    if len(envIndex) == 0:
-        return values
-    #
-    # Timestamp of this entry in UT
-    #
-    mTime = data[hstKeys[0]][envIndex[0]] + ' ' + data[hstKeys[1]][envIndex[0]]
-    mTime = datetime.strptime(mTime, ' %d-%b-%Y %H:%M:%S.%f')
-    mTime += timedelta(hours=10)
-    #todo: truncating microseconds b/c strftime does not support rounding overflow
-    mTime = mTime.strftime('%H:%M:%S.%f')[:-4]
-
-
-    values['time'] = mTime
-    #
-    # Set individual values for this entry
-    #
-    for index, key in enumerate(keys):
-        try:
-#           value = float(round(data[key][envIndex[0]], 2))
-            value = float("%0.2f" % float(data[key][envIndex[0]]))
-        except (ValueError, KeyError):
-            value = 'null'
-        values[output[index]] = value
-
-    return values
+
+    return index.lookup(dateObs, utc)
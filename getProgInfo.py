@@ -33,6 +33,7 @@ import urllib.request as url
 import time
 import create_log as cl
 from common import *
+from prog_cache import ProgramInfoCache, get_prog_cache_dir
 from dep_obtain import get_obtain_data
 from datetime import datetime, timedelta
 import re
@@ -41,7 +42,7 @@ from astropy.io import fits
 
 class ProgSplit:
 
-    def __init__(self, ut_date, instr, stage_dir, log=None):
+    def __init__(self, ut_date, instr, stage_dir, log=None, progCache=None, apiCacheTtl=API_CACHE_TTL):
         """
         Initialization function for the ProgSplit class
 
@@ -51,6 +52,10 @@ class ProgSplit:
         @param instr: Instrument that is being observed
         @type stage_dir: string
         @param stage_dir: directory we are moving processed files to
+        @type progCache: ProgramInfoCache
+        @param progCache: shared program info lookups (one is created if not given)
+        @type apiCacheTtl: int
+        @param apiCacheTtl: seconds to keep sun times in the stage dir API cache (0 = off)
         """
 
         #save inputs
@@ -58,6 +63,7 @@ class ProgSplit:
         self.instrument = instr
         self.stageDir = stage_dir
         self.log = log
+        self.apiCacheTtl = apiCacheTtl
 
         #consts        
         self.instrList = {  'DEIMOS'    :2, 
@@ -101,6 +107,10 @@ class ProgSplit:
         self.rootDir = self.stageDir.split('/stage')[0]
         if not self.log: self.log = cl.create_log(self.rootDir, instr, ut_date)
 
+        #program info lookups
+        self.progCache = progCache
+        if not self.progCache: self.progCache = ProgramInfoCache(get_prog_cache_dir(self.rootDir), self.log)
+
     def get_semester(self):
         """
         This method determines the semester of the observation
@@ -193,10 +203,10 @@ class ProgSplit:
                             if '/' in progid:
                                 progid, tmp = progid.split('/') # case of /scam and /spec
                             semid = self.semester+'_'+progid
-                            row['proginst'] = get_prog_inst(semid, 'NONE', self.log, isToO=True)
+                            row['proginst'] = self.progCache.get_inst(semid, 'NONE')
                             row['progid']   = progid
-                            row['progpi']   = get_prog_pi(semid, 'NONE', self.log)
-                            row['progtitl'] = get_prog_title(semid, 'NONE', self.log)
+                            row['progpi']   = self.progCache.get_pi(semid, 'NONE')
+                            row['progtitl'] = self.progCache.get_title(semid, 'NONE')
                             #todo: should default title be "ToO Program"
 
                     #add row to list
@@ -259,7 +269,7 @@ class ProgSplit:
             self.fileList[filenum]['progtitl'] = self.instrument +' Engineering'
         else:
             semid = self.semester+'_'+prog['ProjCode']
-            self.fileList[filenum]['progtitl'] = get_prog_title(semid, 'NONE', self.log)
+            self.fileList[filenum]['progtitl'] = self.progCache.get_title(semid, 'NONE')
 
 #---------------------------- END ASSIGN SINGLE TO PI-------------------------------------------
 
@@ -428,7 +438,8 @@ class ProgSplit:
         '''
 
         url = self.api + 'metrics.php?date=' + self.utDate
-        self.suntimes = get_api_data(url, getOne=True)
+        self.suntimes = get_cached_api_data(url, getOne=True, cacheFile=get_api_cache_file(self.stageDir),
+                                            ttl=self.apiCacheTtl)
         if not self.suntimes:
             self.log.error('getProgInfo: Could not get sun times via API call: ', url)
             return
@@ -632,7 +643,8 @@ class ProgSplit:
 #--------------------------------------------------------------------
 
 
-def getProgInfo(utdate, instrument, stageDir, useHdrProg=False, splitTime=None, log=None, test=False):
+def getProgInfo(utdate, instrument, stageDir, useHdrProg=False, splitTime=None, log=None, test=False, progCache=None,
+                apiCacheTtl=API_CACHE_TTL):
 
     if test: 
         rootDir = stageDir.split('/stage')[0]
@@ -643,7 +655,7 @@ def getProgInfo(utdate, instrument, stageDir, useHdrProg=False, splitTime=None,
     instrument = instrument.upper()
 
     #gather info
-    progSplit = ProgSplit(utdate, instrument, stageDir, log)
+    progSplit = ProgSplit(utdate, instrument, stageDir, log, progCache, apiCacheTtl)
     progSplit.check_stage_dir()
     progSplit.check_instrument()
     progSplit.read_file_list()
@@ -0,0 +1,53 @@
+"""
+Pixel statistics shared by the DQA image checks (image stats, saturation and linearity counts).
+
+The image is converted to float64 once.  Mean and standard deviation come from a single
+sum / sum-of-squares pass, the median from an in-place partition of that same copy (no sort),
+and pixel counts above a threshold are cached per threshold.  Instrument.get_image_stats()
+keeps one ImageStats object per HDU for the currently loaded FITS file.
+"""
+
+import numpy as np
+
+
+class ImageStats:
+
+    def __init__(self, image):
+        '''
+        Computes mean, std and median for an image array.
+
+        @param image: image pixel data
+        @type image: numpy array
+        '''
+
+        #float64 copy that we are free to reorder
+        self.values = np.array(image, dtype=np.float64).ravel()
+        self.counts = {}
+
+        n = self.values.size
+        mean = self.values.sum() / n
+        var = np.dot(self.values, self.values) / n - mean * mean
+        self.mean = float(mean)
+        self.std  = float(np.sqrt(var)) if not var < 0 else 0.0
+
+        #median via partition (NaN anywhere gives NaN, same as np.median)
+        if np.isnan(self.mean):
+            self.median = float('nan')
+        elif n % 2:
+            k = n // 2
+            self.values.partition(k)
+            self.median = float(self.values[k])
+        else:
+            k = n // 2
+            self.values.partition([k - 1, k])
+            self.median = float((self.values[k - 1] + self.values[k]) / 2.0)
+
+
+    def count_above(self, threshold):
+        '''
+        Returns number of pixels >= threshold (ie saturated or nonlinear pixel count).
+        '''
+        threshold = float(threshold)
+        if threshold not in self.counts:
+            self.counts[threshold] = int(np.count_nonzero(self.values >= threshold))
+        return self.counts[threshold]
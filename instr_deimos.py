@@ -38,6 +38,18 @@ class Deimos(instrument.Instrument):
         # self.fcsimgfi = 'FCSIMGFI'
 
 
+    def get_locate_companions(self, header):
+        """
+        Science files name their FCS image config file in FCSIMGFI.  It is archived along with them.
+        """
+        fcs = header.get('FCSIMGFI', '')
+        if not isinstance(fcs, str) or fcs.strip() == '': return []
+        fcs = fcs.strip()
+        if '/s/' not in fcs:
+            fcs = '/s' + fcs
+        return [fcs] if os.path.isfile(fcs) else []
+
+
     def get_dir_list(self):
         """
         Function to generate the paths to all the DEIMOS accounts, including engineering
@@ -10,13 +10,9 @@ import datetime as dt
 from common import *
 from math import ceil, floor
 import numpy as np
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
-from PIL import Image
-from astropy.visualization import ZScaleInterval, AsinhStretch
-from astropy.visualization.mpl_normalize import ImageNormalize
 import scipy
+import preview
+from image_stats import ImageStats
 
 class Hires(instrument.Instrument):
     def __init__(self, instr, utDate, rootDir, log=None):
@@ -724,8 +720,6 @@ class Hires(instrument.Instrument):
 
                 # Rotate so same IDL equations work
                 image = np.rot90(image, 3)
-                plt.imshow(image)
-                plt.savefig('test.png')
                 naxis1 = self.fitsHdu[ext].header['NAXIS1']
                 naxis2 = self.fitsHdu[ext].header['NAXIS2']
 
@@ -743,20 +737,20 @@ class Hires(instrument.Instrument):
                 x2 = int(cxi+nx/2)
                 y1 = int(cyi-ny/2)
                 y2 = int(cyi+ny/2)
-                img = image[x1:x2, y1:y2]
-                imageStd    = float("%0.2f" % np.std(img))
-                imageMean   = float("%0.2f" % np.mean(img))
-                imageMedian = float("%0.2f" % np.median(img))
+                stats = ImageStats(image[x1:x2, y1:y2])
+                imageStd    = float("%0.2f" % stats.std)
+                imageMean   = float("%0.2f" % stats.mean)
+                imageMedian = float("%0.2f" % stats.median)
 
                 # postscan area
                 x1 = int(cxp-nx/2)
                 x2 = int(cxp+nx/2)
                 y1 = int(naxis2*0.03-ny/2)
                 y2 = int(naxis2*0.03+ny/2)
-                img = image[x1:x2, y1:y2]
-                postStd    = float("%0.2f" % np.std(img))
-                postMean   = float("%0.2f" % np.mean(img))
-                postMedian = float("%0.2f" % np.median(img))
+                stats = ImageStats(image[x1:x2, y1:y2])
+                postStd    = float("%0.2f" % stats.std)
+                postMean   = float("%0.2f" % stats.mean)
+                postMedian = float("%0.2f" % stats.median)
 
             key = str(ext).zfill(2)
             key_mn = 'IM01MN' + key
@@ -839,53 +833,26 @@ class Hires(instrument.Instrument):
         return True
 
 
-    def make_jpg(self):
+    def render_jpg(self, filePath, hdus=None):
         '''
-        Converts HIRES FITS file to JPG image
+        Converts HIRES FITS file to JPG image, one per CCD extension
         Output filename = KOAID_CCD#_HDU##.jpg
             # = 1, 2, 3...
             ## = 01, 02, 03...
         '''
 
-        # TODO: Can we merge this with instrument.make_jpg()?
-
-        # file to convert is lev0Dir/KOAID
-
-        koaid = self.get_keyword('KOAID')
-        filePath = ''
-        for root, dirs, files in os.walk(self.dirs['lev0']):
-            if koaid in files:
-                filePath = ''.join((root, '/', koaid))
-        if not filePath:
-            self.log.error('make_jpg: Could not find KOAID: ' + koaid)
-            return False
-        self.log.info('make_jpg: converting {} to jpeg format'.format(filePath))
+        if hdus == None: hdus = self.fitsHdu
 
         koaid = filePath.replace('.fits', '')
 
-        if os.path.isfile(filePath):
-            for ext in range(1, len(self.fitsHdu)):
-                try:
-                    ext2 = str(ext)
-                    pngFile = koaid+'_CCD'+ext2+'_HDU'+ext2.zfill(2)+'.png'
-                    jpgFile = pngFile.replace('.png', '.jpg')
-                    # image data to convert
-                    image = self.fitsHdu[ext].data
-                    interval = ZScaleInterval()
-                    vmin, vmax = interval.get_limits(image)
-                    norm = ImageNormalize(vmin=vmin, vmax=vmax, stretch=AsinhStretch())
-                    plt.imshow(image, cmap='gray', origin='lower', norm=norm)
-                    plt.axis('off')
-                    # save as png, then convert to jpg
-                    plt.savefig(pngFile)
-                    Image.open(pngFile).convert('RGB').rotate(-90).save(jpgFile)
-                    os.remove(pngFile)
-                    plt.close()
-                except:
-                    self.log.error('make_jpg: Could not create JPG: ' + jpgFile)
-        else:
-            self.log.error('make_jpg: file does not exist {}'.format(filePath))
-            return False
+        for ext in range(1, len(hdus)):
+            ext2 = str(ext)
+            jpgFile = koaid+'_CCD'+ext2+'_HDU'+ext2.zfill(2)+'.jpg'
+            try:
+                preview.write_jpg(hdus[ext].data, jpgFile, maxSize=self.jpgMaxSize,
+                                  downsample=self.jpgDownsample, rotate=-90)
+            except:
+                self.log.error('make_jpg: Could not create JPG: ' + jpgFile)
 
         return True
 
@@ -905,9 +872,7 @@ class Hires(instrument.Instrument):
         else:
             nPixSat = 0
             for ext in range(1, len(self.fitsHdu)):
-                image = self.fitsHdu[ext].data
-                pixSat = image[np.where(image >= satVal)]
-                nPixSat += len(image[np.where(image >= satVal)])
+                nPixSat += self.get_image_stats(ext).count_above(satVal)
 
             self.set_keyword('NPIXSAT', nPixSat, 'KOA: Number of saturated pixels')
 
@@ -17,6 +17,8 @@ class Kcwi(instrument.Instrument):
         self.ofName = 'OFNAME'
         self.camera = 'CAMERA'
         self.endHour = 'DATE-END'
+        self.locateRules['filenameKeys'] = ['OFNAME']
+        self.locateRules['framenoKeys']  = []
         # Set the KCWI specific paths to anc and stage
         seq = (self.rootDir, '/KCWI/', self.utDate, '/anc')
         self.ancDir = ''.join(seq)
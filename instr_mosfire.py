@@ -24,6 +24,12 @@ class Mosfire(instrument.Instrument):
         self.keywordMap['FRAMENO']      = 'FRAMENUM'
 
 
+        # Original file name is DATAFILE (no frame number)
+        self.locateRules['filenameKeys'] = ['DATAFILE']
+        self.locateRules['addFitsExt']   = True
+        self.locateRules['framenoKeys']  = []
+
+
         # Other vars that subclass can overwrite
         self.endTime = '19:00:00'   # 24 hour period start/end time (UT)
         self.keywordSkips   = ['B\d+STAT', 'B\d+POS']
@@ -185,8 +191,7 @@ class Mosfire(instrument.Instrument):
         if koaimtyp == 'undefined':
             # Is the telescope in dome flat position?
             if flatlampPos:
-                image = self.fitsHdu[0].data
-                imageMean = np.mean(image)
+                imageMean = self.get_image_stats(0).mean
                 koaimtyp = 'flatlampoff'
                 if (imageMean > 500):
                     koaimtyp = 'flatlamp'
@@ -20,6 +20,9 @@ class Nirc2(instrument.Instrument):
         # NIRC2 uses ROOTNAME instead of OUTDIR
         self.ofName = 'FILENAME'
 
+        # NIRC2 headers can be missing the END card
+        self.locateRules['ignoreMissingEnd'] = True
+
         # set endtime to 9AM
         self.endTime = '19:00:00' #UT
 
@@ -443,9 +446,7 @@ class Nirc2(instrument.Instrument):
         if satVal == None:
             self.log.warning("set_nlinear: Could not find SATURATE keyword")
         else:
-            image = self.fitsHdu[0].data     
-            linSat = image[np.where(image >= satVal)]
-            nlinSat = len(image[np.where(image >= satVal)])
+            nlinSat = self.get_image_stats(0).count_above(satVal)
             self.set_keyword('NLINEAR', nlinSat, 'KOA: Number of pixels above linearity')
             self.set_keyword('NONLIN', int(satVal), 'KOA: 3% nonlinearity level (80% full well)')
 
@@ -453,8 +454,9 @@ class Nirc2(instrument.Instrument):
 
     def set_caltype(self,imagetyp):
         image = self.fitsHdu[0].data
-        imgmean = np.mean(image)
-        imgstdv = np.std(image)
+        stats = self.get_image_stats(0)
+        imgmean = stats.mean
+        imgstdv = stats.std
         krtosis = scipy.stats.kurtosis(image, axis=None)
         print(imgmean,imgstdv,krtosis)
         #determine lamp when 'flatTBD'
@@ -22,6 +22,12 @@ class Nires(instrument.Instrument):
         self.keywordMap['FRAMENO']      = 'FRAMENUM'
 
 
+        # Original file name is DATAFILE (no frame number)
+        self.locateRules['filenameKeys'] = ['DATAFILE']
+        self.locateRules['addFitsExt']   = True
+        self.locateRules['framenoKeys']  = []
+
+
         # Other vars that subclass can overwrite
         self.endTime = '19:00:00'   # 24 hour period start/end time (UT)
 
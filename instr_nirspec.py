@@ -21,6 +21,11 @@ class Nirspec(instrument.Instrument):
         self.keywordMap['OFNAME'] = 'DATAFILE'
         self.keywordMap['FRAMENO'] = 'FRAMENUM'
 
+        #original file name is DATAFILE (no frame number)
+        self.locateRules['filenameKeys'] = ['DATAFILE']
+        self.locateRules['addFitsExt']   = True
+        self.locateRules['framenoKeys']  = []
+
         #other vars that subclass can overwrite
         self.endTime = '19:00:00'   # 24 hour period start/end time (UT)
 
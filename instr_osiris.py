@@ -21,6 +21,12 @@ class Osiris(instrument.Instrument):
         self.keywordMap['OFNAME']       = 'DATAFILE'
         self.keywordMap['FRAMENO']      = 'FRAMENUM'
 
+
+        # Original file name is DATAFILE (no frame number)
+        self.locateRules['filenameKeys'] = ['DATAFILE']
+        self.locateRules['addFitsExt']   = True
+        self.locateRules['framenoKeys']  = []
+
         #other vars that subclass can overwrite
         self.endTime = '19:00:00'   # 24 hour period start/end time (UT)
 
@@ -179,11 +185,8 @@ class Osiris(instrument.Instrument):
         # uses dome lamps for instr=imag
         elif instr.lower() == 'imag':
             if 'telescope' in obsfname and 'not controlling' in axestat and flatpos:
-                # divide image by coadds
-                img = self.fitsHdu[0].data
-
                 # median
-                imgmed = np.median(img)
+                imgmed = self.get_image_stats(0).median
 
                 if imgmed > 30.0:
                     koaimtyp = 'flatlamp'
@@ -378,9 +381,7 @@ class Osiris(instrument.Instrument):
             self.log.warning("set_nlinear: Could not find SATURATE keyword")
         else:
             satVal = 0.8 * satVal * self.get_keyword('COADDS')
-            image = self.fitsHdu[0].data     
-            linSat = image[np.where(image >= satVal)]
-            nlinSat = len(image[np.where(image >= satVal)])
+            nlinSat = self.get_image_stats(0).count_above(satVal)
             self.set_keyword('NLINEAR', nlinSat, 'KOA: Number of pixels above linearity')
             self.set_keyword('NONLIN', int(satVal), 'KOA: 3% nonlinearity level (80% full well)')
 
@@ -20,13 +20,38 @@ import json
 import numpy as np
 import re
 from dep_obtain import get_obtain_data
-
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
-from PIL import Image
-from astropy.visualization import ZScaleInterval, AsinhStretch
-from astropy.visualization.mpl_normalize import ImageNormalize
+from image_stats import ImageStats
+from prog_cache import ProgramInfoCache, get_prog_cache_dir
+from locate_rules import LocateRules, DEFAULT_RULES
+from dep_locate import get_watch_manifest_file, get_locate_manifest_file
+import copy
+import preview
+from checksum import HashingFile
+
+
+class LazyHDUList:
+    '''
+    Stand-in for an astropy HDUList that holds only the primary header until something
+    else is needed.  The file is opened on first index, len, iteration or method call
+    (ie writeto).  Header changes made before that are kept since the opened primary HDU
+    is given the same header object.
+    '''
+
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.header   = header
+        self.hdus     = None
+
+    def load(self):
+        if self.hdus is None:
+            self.hdus = fits.open(self.filename, ignore_missing_end=True)
+            self.hdus[0].header = self.header
+        return self.hdus
+
+    def __getitem__(self, key): return self.load()[key]
+    def __len__(self)         : return len(self.load())
+    def __iter__(self)        : return iter(self.load())
+    def __getattr__(self, name): return getattr(self.load(), name)
 
 
 class Instrument:
@@ -68,6 +93,12 @@ class Instrument:
         self.keywordMap['FTYPE']        = 'INSTR'       # For instruments with two file types
 
 
+        # dep_locate rules (see locate_rules.py for the keys)
+        # NOTE: these may be overwritten by instr_*.py
+        self.locateRules = copy.deepcopy(DEFAULT_RULES)
+        self.compiledLocateRules = None
+
+
         # Other values that can be overwritten in instr-*.py
         self.endHour = '20:00:00'   # 24 hour period start/end time (UT)
 
@@ -84,6 +115,17 @@ class Instrument:
         self.fitsHdu        = None
         self.fitsHeader     = None
         self.fitsFilepath   = None
+        self.imageStats     = {}
+
+        #env log indexes loaded once per night (see get_envlog_index)
+        self.envLogs        = {}
+
+        #program info by semid (see get_prog_cache)
+        self.progCache      = None
+
+        #jpg preview options
+        self.jpgMaxSize     = int(self.config['MISC']['JPG_MAX_SIZE'])   if 'JPG_MAX_SIZE'   in self.config['MISC'] else preview.MAX_SIZE
+        self.jpgDownsample  = int(self.config['MISC']['JPG_DOWNSAMPLE']) if 'JPG_DOWNSAMPLE' in self.config['MISC'] else 1
 
 
         #other helpful vars
@@ -105,9 +147,12 @@ class Instrument:
 
 
 
-    def dep_init(self, fullRun=True):
+    def dep_init(self, fullRun=True, resume=False):
         '''
         Perform specific initialization tasks for DEP processing.
+
+        @param resume: watch mode, a full run may resume one that stopped during locate (see init_dirs)
+        @type resume: bool
         '''
 
         #TODO: exit if existence of output/stage dirs? Maybe put override in config?
@@ -126,7 +171,7 @@ class Instrument:
 
 
         #check and create dirs
-        self.init_dirs(fullRun)
+        self.init_dirs(fullRun, resume)
 
 
         #create README (output dir with everything before /koadata##/... stripped off)
@@ -138,18 +183,40 @@ class Instrument:
             f.write(path + '\n')
 
 
-    def init_dirs(self, fullRun=True):
+    def clone(self):
+        '''
+        Returns a new instance of this instrument class with the same run settings
+        (config, log, dirs, API urls) but none of the current FITS file state.
+        Used to give each parallel DQA worker its own instrument object.
+        '''
+        instrObj = self.__class__(self.instr, self.utDate, self.config, self.log)
+        instrObj.koaUrl = self.koaUrl
+        instrObj.telUrl = self.telUrl
+        instrObj.metadataTablesDir = self.metadataTablesDir
+        instrObj.dirs = dict(self.dirs)
+        return instrObj
+
+
+    def init_dirs(self, fullRun=True, resume=False):
 
         # get the various root dirs
         self.dirs = get_root_dirs(self.rootDir, self.instr, self.utDate)
 
 
+        # A watch mode run that stopped before locate finished (watch manifest but no final
+        # locate manifest) is resumed by a full run instead of failing on the existing dirs
+        watchFile = get_watch_manifest_file(self.dirs['stage'], self.instr)
+        locateFile = get_locate_manifest_file(self.dirs['stage'], self.instr)
+        self.isResume = resume and os.path.isfile(watchFile) and not os.path.isfile(locateFile)
+        if self.isResume: self.log.info('instrument.py: resuming watch mode run from ' + watchFile)
+
+
         # Create the directories, if they don't already exist
         for key, dir in self.dirs.items():
             if key == 'process': continue # process dir should always exists
             self.log.info('instrument.py: {} directory {}'.format(key, dir))
             if os.path.isdir(dir):
-                if (fullRun):
+                if (fullRun and not self.isResume):
                     raise Exception('instrument.py: staging and/or output directories already exist')
             else:
                 try:
@@ -168,15 +235,21 @@ class Instrument:
 
 
 
-    def set_fits_file(self, filename):
+    def set_fits_file(self, filename, lazy=False, header=None):
         '''
         Sets the current FITS file we are working on.  Clears out temp fits variables.
+        NOTE: With lazy=True only the primary header is read.  The full HDUList (and pixel data)
+        is read the first time self.fitsHdu is accessed (ie image stats, jpg, lev0 write).
+        A lazy load can be given the primary header already read (ie from the locate manifest).
         '''
 
-        #todo: should we have option to just read the header for performance if that is all that is needed?
         try:
-            self.fitsHdu = fits.open(filename, ignore_missing_end=True)
-            self.fitsHeader = self.fitsHdu[0].header
+            if lazy:
+                self.fitsHeader = header if header != None else fits.getheader(filename, ignore_missing_end=True)
+                self.fitsHdu = LazyHDUList(filename, self.fitsHeader)
+            else:
+                self.fitsHdu = fits.open(filename, ignore_missing_end=True)
+                self.fitsHeader = self.fitsHdu[0].header
             #self.fitsHeader = fits.getheader(filename)
             self.fitsFilepath = filename
         except:
@@ -187,6 +260,7 @@ class Instrument:
         self.rawfile = ''
         self.prefix = ''
         self.extraMeta = {}
+        self.imageStats = {}
 
         return True
 
@@ -703,6 +777,16 @@ class Instrument:
         return True
 
 
+    def get_image_stats(self, ext=0):
+        '''
+        Returns pixel stats (mean, std, median, counts above threshold) for an extension.
+        Computed once per FITS file and shared by the image stat, saturation and linearity checks.
+        '''
+        if ext not in self.imageStats:
+            self.imageStats[ext] = ImageStats(self.fitsHdu[ext].data)
+        return self.imageStats[ext]
+
+
     def set_image_stats_keywords(self):
         '''
         Adds mean, median, std keywords to header
@@ -710,10 +794,10 @@ class Instrument:
 
         # self.log.info('set_image_stats_keywords: setting image statistics keyword values')
 
-        image = self.fitsHdu[0].data     
-        imageStd    = float("%0.2f" % np.std(image))
-        imageMean   = float("%0.2f" % np.mean(image))
-        imageMedian = float("%0.2f" % np.median(image))
+        stats = self.get_image_stats(0)
+        imageStd    = float("%0.2f" % stats.std)
+        imageMean   = float("%0.2f" % stats.mean)
+        imageMedian = float("%0.2f" % stats.median)
 
         self.set_keyword('IMAGEMN' ,  imageMean,   'KOA: Image data mean')
         self.set_keyword('IMAGESD' ,  imageStd,    'KOA: Image data standard deviation')
@@ -735,9 +819,7 @@ class Instrument:
         if satVal == None:
             self.log.warning("set_npixsat: Could not find SATURATE keyword")
         else:
-            image = self.fitsHdu[0].data     
-            pixSat = image[np.where(image >= satVal)]
-            nPixSat = len(image[np.where(image >= satVal)])
+            nPixSat = self.get_image_stats(0).count_above(satVal)
             self.set_keyword('NPIXSAT', nPixSat, 'KOA: Number of saturated pixels')
 
         return True
@@ -797,12 +879,11 @@ class Instrument:
         telnr   = self.get_telnr()
 
         #read envMet.arT and write to header
-        #todo: read this once in dqa to speed things up?
-        logFile = self.dirs['anc'] + '/nightly/envMet.arT'
-        data = envlog(logFile, 'envMet', telnr, dateobs, utc)
-        if type(data) is not dict: 
+        envIndex = self.get_envlog_index('envMet', telnr)
+        if envIndex == None:
             self.log.error("Could not read envMet.arT data")
             return True
+        data = envIndex.lookup(dateobs, utc)
 
         self.set_keyword('WXDOMHUM' , data['wx_domhum'],    'KOA: Weather dome humidity')
         self.set_keyword('WXDOMTMP' , data['wx_domtmp'],    'KOA: Weather dome temperature')
@@ -816,11 +897,11 @@ class Instrument:
 
 
         #read envFocus.arT and write to header
-        logFile = self.dirs['anc'] + '/nightly/envFocus.arT'
-        data = envlog(logFile, 'envFocus', telnr, dateobs, utc)
-        if type(data) is not dict: 
+        envIndex = self.get_envlog_index('envFocus', telnr)
+        if envIndex == None:
             self.log.error("Could not read envFocus.arT data")
             return True
+        data = envIndex.lookup(dateobs, utc)
 
         self.set_keyword('GUIDFWHM' , data['guidfwhm'],     'KOA: Guide star FWHM value')
         self.set_keyword('GUIDTIME' , data['time'],         'KOA: Guide star FWHM measure time')
@@ -828,21 +909,97 @@ class Instrument:
         return True
 
 
+    def get_envlog_index(self, logType, telnr):
+        '''
+        Returns EnvLogIndex for anc/nightly/<logType>.arT, reading the file only the first time.
+        Returns None if the file could not be read.
+        '''
+
+        key = (logType, telnr)
+        if key not in self.envLogs:
+            logFile = self.dirs['anc'] + '/nightly/' + logType + '.arT'
+            try:
+                self.envLogs[key] = EnvLogIndex(logFile, logType, telnr)
+            except Exception as e:
+                self.log.warning('get_envlog_index: Unable to read {}: {}'.format(logFile, e))
+                self.envLogs[key] = None
+        return self.envLogs[key]
+
+
+    def get_cached_api_data(self, url, getOne=False, isJson=True):
+        '''
+        Gets static/slow-changing API data, cached for the run and in the stage dir.
+        Set MISC API_CACHE_TTL to 0 to turn off the on-disk cache.
+        '''
+
+        cacheFile = None
+        if hasattr(self, 'dirs') and os.path.isdir(self.dirs['stage']):
+            cacheFile = get_api_cache_file(self.dirs['stage'])
+        return get_cached_api_data(url, getOne=getOne, isJson=isJson, cacheFile=cacheFile, ttl=self.get_api_cache_ttl())
+
+
+    def get_api_cache_ttl(self):
+        '''
+        Seconds API results are kept in the stage dir cache (MISC API_CACHE_TTL, 0 = off).
+        '''
+        return int(self.config['MISC']['API_CACHE_TTL']) if 'API_CACHE_TTL' in self.config['MISC'] else API_CACHE_TTL
+
+
+    def get_locate_rules(self):
+        '''
+        Returns the compiled LocateRules for self.locateRules (compiled once).
+        '''
+        if self.compiledLocateRules == None:
+            self.compiledLocateRules = LocateRules(**self.locateRules)
+        return self.compiledLocateRules
+
+
+    def get_locate_companions(self, header):
+        '''
+        Extra files (ie config files) that must be located along with a raw file, from its
+        primary header.  Called from the dep_locate worker threads.  Returns list of paths.
+        '''
+        return []
+
+
+    def get_prog_cache(self):
+        '''
+        Returns the ProgramInfoCache shared by create_prog, getProgInfo and DQA for this run.
+        '''
+        if self.progCache == None:
+            self.progCache = ProgramInfoCache(get_prog_cache_dir(self.rootDir), self.log)
+        return self.progCache
+
+
     def get_telnr(self):
         '''
-        Gets telescope number for instrument via API
-        #todo: store this and skip api call if exists?  Would need to clear var on fits reload.
+        Gets telescope number for instrument via API (cached, see get_cached_api_data)
         #todo: Replace API call with hard-coded?
         '''
 
         url = self.telUrl + 'cmd=getTelnr&instr=' + self.instr.upper()
-        data = get_api_data(url, getOne=True)
+        data = self.get_cached_api_data(url, getOne=True)
         telNr = int(data['TelNr'])
         assert telNr in [1, 2], 'telNr "' + telNr + '"" not allowed'
         return telNr
 
 
-    def write_lev0_fits_file(self):
+    def get_lev0_filepath(self, koaid):
+        '''
+        Returns the lev0 output path for a KOAID (NIRSPEC files go in scam/spec subdirs)
+        '''
+        outfile = self.dirs['lev0']
+        if   (koaid.startswith('NC')): outfile += '/scam'
+        elif (koaid.startswith('NS')): outfile += '/spec'
+        outfile += '/' + koaid
+        return outfile
+
+
+    def write_lev0_fits_file(self, outfile=None):
+        '''
+        Writes the current FITS file with altered header to lev0 dir.
+        NOTE: outfile can be given to write elsewhere (ie parallel DQA writes to a temp file first)
+        '''
 
         #make sure we have a koaid
         koaid = self.get_keyword('KOAID')
@@ -851,10 +1008,8 @@ class Instrument:
             return False
 
         #build outfile path
-        outfile = self.dirs['lev0']
-        if   (koaid.startswith('NC')): outfile += '/scam'
-        elif (koaid.startswith('NS')): outfile += '/spec'
-        outfile += '/' + koaid
+        if not outfile:
+            outfile = self.get_lev0_filepath(koaid)
 
         #write out new fits file with altered header
         try:
@@ -863,11 +1018,14 @@ class Instrument:
             # if os.path.isfile(outfile):
             #     self.log.warning('write_lev0_fits_file: file already exists. SKIPPING')
             #     return True
-            self.fitsHdu.writeto(outfile)
+            #md5 computed while writing (HashingFile removes the file if writeto fails)
+            with HashingFile(outfile, 'xb') as fp:
+                self.fitsHdu.writeto(fp)
             self.log.info('write_lev0_fits_file: output file is ' + outfile)
         except:
             try:
-                self.fitsHdu.writeto(outfile, output_verify='ignore')
+                with HashingFile(outfile, 'xb') as fp:
+                    self.fitsHdu.writeto(fp, output_verify='ignore')
                 self.log.error('write_lev0_fits_file: Forced to write FITS using output_verify="ignore". May want to inspect:' + outfile)                
             except:
                 self.log.error('write_lev0_fits_file: Could not write out lev0 FITS file to ' + outfile)
@@ -903,26 +1061,25 @@ class Instrument:
 
         # verify file exists
 
+        if not os.path.isfile(filePath):
+            #TODO: if this errors, should we remove .fits file added previously?
+            self.log.error('make_jpg: file does not exist {}'.format(filePath))
+            return False
+
+        return self.render_jpg(filePath)
+
+
+    def render_jpg(self, filePath, hdus=None):
+        '''
+        Writes the JPG preview(s) for lev0 file filePath from hdus (default self.fitsHdu).
+        Does not touch any other instrument state so it can be run from a thread.
+        '''
+
+        if hdus == None: hdus = self.fitsHdu
+
+        jpgFile = filePath.replace('.fits', '.jpg')
         try:
-            if os.path.isfile(filePath):
-                # image data to convert
-                image = self.fitsHdu[0].data
-                interval = ZScaleInterval()
-                vmin, vmax = interval.get_limits(image)
-                norm = ImageNormalize(vmin=vmin, vmax=vmax, stretch=AsinhStretch())
-                plt.imshow(image, cmap='gray', origin='lower', norm=norm)
-                plt.axis('off')
-                # save as png, then convert to jpg
-                pngFile = filePath.replace('.fits', '.png')
-                jpgFile = pngFile.replace('.png', '.jpg')
-                plt.savefig(pngFile)
-                Image.open(pngFile).convert('RGB').save(jpgFile)
-                os.remove(pngFile)
-                plt.close()
-            else:
-                #TODO: if this errors, should we remove .fits file added previously?
-                self.log.error('make_jpg: file does not exist {}'.format(filePath))
-                return False
+            preview.write_jpg(hdus[0].data, jpgFile, maxSize=self.jpgMaxSize, downsample=self.jpgDownsample)
         except:
             self.log.error('make_jpg: Could not create JPG: ' + jpgFile)
             return False
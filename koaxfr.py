@@ -1,5 +1,5 @@
 from send_email import *
-from common import update_koatpx
+from common import TpxUpdater
 from datetime import datetime as dt
 import os
 
@@ -41,7 +41,7 @@ def koaxfr(instrObj, tpx=0):
     count = 0
     for dirpath, dirnames, filenames in os.walk(instrObj.dirs['lev0']):
         for f in filenames:
-            if f.endswith('.fits.gz'):
+            if f.endswith('.fits.gz') or f.endswith('.fits.fz'):
                 count += 1
 
     if count == 0:
@@ -52,15 +52,17 @@ def koaxfr(instrObj, tpx=0):
         send_email(emailTo, emailFrom, subject, message)
 
         if tpx:
-            update_koatpx(instr, utDate, 'files_arch', '0', log)
-            update_koatpx(instr, utDate, 'sci_files', '0', log)
-            update_koatpx(instr, utDate, 'ondisk_stat', 'N/A', log)
-            update_koatpx(instr, utDate, 'arch_stat', 'N/A', log)
-            update_koatpx(instr, utDate, 'metadata_stat', 'N/A', log)
-            update_koatpx(instr, utDate, 'dvdwrit_stat', 'N/A', log)
-            update_koatpx(instr, utDate, 'dvdsent_stat', 'N/A', log)
-            update_koatpx(instr, utDate, 'dvdstor_stat', 'N/A', log)
-            #update_koatpx(instr, utDate, 'tpx_stat', 'N/A', log)
+            tpxUpdater = TpxUpdater(instr, utDate, instrObj.dirs['process'], log)
+            tpxUpdater.add('files_arch', '0')
+            tpxUpdater.add('sci_files', '0')
+            tpxUpdater.add('ondisk_stat', 'N/A')
+            tpxUpdater.add('arch_stat', 'N/A')
+            tpxUpdater.add('metadata_stat', 'N/A')
+            tpxUpdater.add('dvdwrit_stat', 'N/A')
+            tpxUpdater.add('dvdsent_stat', 'N/A')
+            tpxUpdater.add('dvdstor_stat', 'N/A')
+            #tpxUpdater.add('tpx_stat', 'N/A')
+            tpxUpdater.flush()
 
         return True
 
@@ -87,8 +89,10 @@ def koaxfr(instrObj, tpx=0):
         send_email(emailTo, emailFrom, subject, message)
         if tpx:
             utcTimestamp = dt.utcnow().strftime("%Y%m%d %H:%M")
-            update_koatpx(instr, utDate, 'dvdsent_stat', 'DONE', log)
-            update_koatpx(instr, utDate, 'dvdsent_time', utcTimestamp, log)
+            tpxUpdater = TpxUpdater(instr, utDate, instrObj.dirs['process'], log)
+            tpxUpdater.add('dvdsent_stat', 'DONE')
+            tpxUpdater.add('dvdsent_time', utcTimestamp)
+            tpxUpdater.flush()
         return True
     else:
         # Send email notifying of error
@@ -0,0 +1,189 @@
+"""
+Persistent index of the FITS files under the sdata search dirs, for incremental dep_locate.
+
+The index (SQLite, one per instrument in the process dir) stores path, size, mtime and inode
+of every FITS file seen plus each directory's mtime and subdirectories.  On a later run a
+directory whose mtime has not changed is not listed again (its file entries and subdirs are
+taken from the index); only changed directories are re-read.  Files modified recently
+("hot", still possibly being written) are re-stat'ed even in unchanged directories.
+The 24 hour window is then answered by an indexed query on mtime.
+
+NOTE: A file rewritten in place in an old directory long after it was created is only
+picked up once that directory changes again.  Delete the index file to force a full scan.
+"""
+
+import os
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+
+#files modified in the last this many seconds are re-stat'ed every run
+HOT_SECONDS = 2 * 86400
+
+#don't trust a dir mtime this close (sec) to the scan time (changes in the same tick)
+MTIME_SETTLE = 2
+
+
+class LocateIndex:
+
+    def __init__(self, dbFile, log=None, hotSeconds=HOT_SECONDS):
+        self.dbFile = dbFile
+        self.log = log
+        self.hotSeconds = hotSeconds
+        self.conn = sqlite3.connect(dbFile)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS dirs  (path TEXT PRIMARY KEY, mtime INTEGER, subdirs TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime REAL, inode INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+        self.conn.commit()
+
+
+    def close(self):
+        self.conn.close()
+
+
+    def update(self, roots, numWorkers=8):
+        '''
+        Brings the index up to date for the search roots.  Roots are scanned concurrently
+        against a snapshot of the index; all changes are then written in one transaction.
+        '''
+
+        roots = [root.rstrip('/') for root in roots]
+        now = time.time()
+
+        #snapshot of known dirs and hot files
+        knownDirs = {}
+        for path, mtime, subdirs in self.conn.execute('SELECT path, mtime, subdirs FROM dirs'):
+            knownDirs[path] = (mtime, subdirs.split('\n') if subdirs else [])
+        hotFiles = {}
+        for path, dirPath in self.conn.execute('SELECT path, dir FROM files WHERE mtime > ?', (now - self.hotSeconds,)):
+            hotFiles.setdefault(dirPath, []).append(path)
+
+        with ThreadPoolExecutor(max_workers=max(1, numWorkers)) as executor:
+            results = list(executor.map(lambda root: scan_root(root, knownDirs, hotFiles, now), roots))
+
+        numListed = 0
+        numDirs = 0
+        with self.conn:
+            for dirUpdates, fileUpdates, goneDirs in results:
+                for dirPath, mtime, subdirs, files in dirUpdates:
+                    numDirs += 1
+                    if files == None: continue
+                    numListed += 1
+                    self.conn.execute('DELETE FROM files WHERE dir = ?', (dirPath,))
+                    self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                          [(p, dirPath, size, m, inode) for p, size, m, inode in files])
+                    self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (dirPath, mtime, '\n'.join(subdirs)))
+                for path, dirPath, st in fileUpdates:
+                    if st == None: self.conn.execute('DELETE FROM files WHERE path = ?', (path,))
+                    else         : self.conn.execute('UPDATE files SET size = ?, mtime = ?, inode = ? WHERE path = ?',
+                                                     (st.st_size, st.st_mtime, st.st_ino, path))
+                for dirPath in goneDirs:
+                    self.remove_tree(dirPath)
+
+        if self.log:
+            self.log.info('locate_index: {} dirs checked, {} re-read'.format(numDirs, numListed))
+
+
+    def remove_tree(self, dirPath):
+        '''
+        Drops a directory and everything under it from the index.
+        '''
+        lo, hi = dirPath + '/', dirPath + '0'
+        self.conn.execute('DELETE FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)', (dirPath, lo, hi))
+        self.conn.execute('DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)', (dirPath, lo, hi))
+
+
+    def find(self, roots, minTime=None, maxTime=None):
+        '''
+        Returns (path, mtime, size) for indexed files under roots with minTime < mtime <= maxTime
+        (no time filter if None), sorted by mtime then path.
+        '''
+
+        records = []
+        for root in roots:
+            root = root.rstrip('/')
+            sql = 'SELECT path, mtime, size FROM files WHERE path >= ? AND path < ?'
+            args = [root + '/', root + '0']
+            if minTime != None:
+                sql += ' AND mtime > ? AND mtime <= ?'
+                args += [minTime, maxTime]
+            records += self.conn.execute(sql, args).fetchall()
+
+        records.sort(key=lambda rec: (rec[1], rec[0]))
+        return records
+
+
+def scan_root(root, knownDirs, hotFiles, now):
+    '''
+    Walks one search root, listing only dirs that are new or whose mtime changed.
+    Returns (dirUpdates, fileUpdates, goneDirs):
+        dirUpdates : (dirPath, mtime_ns, subdirs, files or None if unchanged)
+        fileUpdates: (path, dirPath, stat or None if gone) for hot files in unchanged dirs
+        goneDirs   : indexed subdirs that no longer exist
+    '''
+
+    dirUpdates = []
+    fileUpdates = []
+    goneDirs = []
+
+    stack = [root]
+    while stack:
+        dirPath = stack.pop()
+        try:
+            dirMtime = os.stat(dirPath).st_mtime_ns
+        except OSError:
+            if dirPath in knownDirs: goneDirs.append(dirPath)
+            continue
+
+        known = knownDirs.get(dirPath)
+        if known and known[0] == dirMtime:
+            #unchanged listing: reuse subdirs, re-stat hot files only
+            subdirs = known[1]
+            dirUpdates.append((dirPath, dirMtime, subdirs, None))
+            for path in hotFiles.get(dirPath, []):
+                try:
+                    fileUpdates.append((path, dirPath, os.stat(path)))
+                except OSError:
+                    fileUpdates.append((path, dirPath, None))
+        else:
+            subdirs, files = list_dir(dirPath)
+            if subdirs == None: continue
+            #dir changed in this same tick could change again unseen, so don't trust its mtime
+            if now - dirMtime / 1e9 < MTIME_SETTLE: dirMtime = -1
+            dirUpdates.append((dirPath, dirMtime, subdirs, files))
+            if known:
+                for sub in set(known[1]) - set(subdirs): goneDirs.append(sub)
+
+        stack.extend(reversed(subdirs))
+
+    return dirUpdates, fileUpdates, goneDirs
+
+
+def list_dir(dirPath):
+    '''
+    Returns (subdirs, files) for a directory (None, None if unreadable).  files are
+    (path, size, mtime, inode) for names containing '.fits'.  Symlinked dirs are not followed.
+    '''
+
+    try:
+        with os.scandir(dirPath) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError:
+        return None, None
+
+    subdirs = []
+    files = []
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                if not entry.is_symlink(): subdirs.append(entry.path)
+                continue
+            if '.fits' not in entry.name: continue
+            st = entry.stat()
+        except OSError:
+            continue
+        files.append((entry.path, st.st_size, st.st_mtime, st.st_ino))
+
+    return subdirs, files
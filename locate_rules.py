@@ -0,0 +1,107 @@
+"""
+Per-instrument dep_locate rules, compiled once per run.
+
+The rules are plain data: Instrument.locateRules starts as a copy of DEFAULT_RULES and the
+instr_*.py classes update it:
+
+    excludes         : path substrings never located (one precompiled regex)
+    filenameKeys     : header keywords for the original file name, first one present wins
+    addFitsExt       : add '.fits' to the file name keyword value if missing
+    framenoKeys      : header keywords for the frame number, first one present wins
+                       (empty list = file name keyword is already the full file name)
+    prefixFramenoKeys: file name prefix -> frame number keyword for that prefix (ie 'kf' -> 'IMGNUM')
+    ignoreMissingEnd : read headers with ignore_missing_end
+    udfSkips         : path substrings of rejected files that are not copied to udf
+"""
+
+import re
+
+
+DEFAULT_RULES = {
+    'excludes'         : ['/fcs', 'mira', 'savier-protected', 'SPEC/ORP/', 'idf'],
+    'filenameKeys'     : ['OUTFILE', 'ROOTNAME', 'FILENAME'],
+    'addFitsExt'       : False,
+    'framenoKeys'      : ['FRAMENO', 'FILENUM', 'FILENUM2'],
+    'prefixFramenoKeys': {'kf': 'IMGNUM'},
+    'ignoreMissingEnd' : False,
+    'udfSkips'         : ['/SPEC/ORP/', '/SPEC/cal/', 'mdark.fits'],
+}
+
+
+class LocateRules:
+
+    def __init__(self, **rules):
+        '''
+        Compiles rules (any keys not given come from DEFAULT_RULES).
+        '''
+
+        unknown = set(rules) - set(DEFAULT_RULES)
+        if unknown: raise Exception('LocateRules: unknown rules ' + str(sorted(unknown)))
+        rules = dict(DEFAULT_RULES, **rules)
+
+        self.excludeRe         = make_substring_regex(rules['excludes'])
+        self.udfSkipRe         = make_substring_regex(rules['udfSkips'])
+        self.filenameKeys      = tuple(rules['filenameKeys'])
+        self.addFitsExt        = rules['addFitsExt']
+        self.framenoKeys       = tuple(rules['framenoKeys'])
+        self.prefixFramenoKeys = dict(rules['prefixFramenoKeys'])
+        self.ignoreMissingEnd  = rules['ignoreMissingEnd']
+
+
+    def is_located(self, path):
+        '''
+        True if path is a FITS file path not matching any exclude.
+        '''
+        if '.fits' not in path: return False
+        return not (self.excludeRe and self.excludeRe.search(path))
+
+
+    def skip_udf(self, path):
+        return bool(self.udfSkipRe and self.udfSkipRe.search(path))
+
+
+    def construct_filename(self, header):
+        '''
+        Constructs the original filename from the header keywords.
+        Returns (filename, None) or (None, reject reason).
+        '''
+
+        outfile = first_value(header, self.filenameKeys)
+        if outfile == None: return None, 'Bad Outfile'
+        outfile = str(outfile)
+
+        #file name keyword is the whole name
+        if not self.framenoKeys:
+            if self.addFitsExt and '.fits' not in outfile: outfile += '.fits'
+            return outfile, None
+
+        key = self.prefixFramenoKeys.get(outfile[:2])
+        frameno = header.get(key) if key else first_value(header, self.framenoKeys)
+        if frameno == None: return None, 'Bad Frameno'
+
+        # Zero pad frame number to 4 digits
+        try:
+            num = float(frameno)
+        except (TypeError, ValueError):
+            return None, 'Bad Frameno'
+        zero = ''
+        if   num < 10  : zero = '000'
+        elif num < 100 : zero = '00'
+        elif num < 1000: zero = '0'
+
+        filename = ''.join((outfile.strip(), zero, str(frameno).strip(), '.fits'))
+        return filename, None
+
+
+def first_value(header, keys):
+    '''
+    Value of the first of keys in header (None if none are).
+    '''
+    for key in keys:
+        if key in header: return header[key]
+    return None
+
+
+def make_substring_regex(substrings):
+    if not substrings: return None
+    return re.compile('|'.join(re.escape(s) for s in substrings))
@@ -0,0 +1,262 @@
+"""
+Watch mode for dep_locate: locates FITS files during the night as they are written.
+
+The search dirs are watched with inotify (optional inotify_simple package) or, if that is
+not available, rescanned every pollSecs.  A file is ready once its size and mod time have
+not changed for settleSecs.  Ready files inside the 24 hour window are validated and staged
+right away (dep_locate.locate_records) and their records appended to the watch manifest
+dep_locate<INSTR>.watch.jsonl.  Once the window has ended the regular dep_locate run only
+handles files the watcher did not see and writes the final manifest.
+
+NOTE: DQA is not run incrementally.  Program assignment (getProgInfo) needs all of the
+night's files for split nights, so DQA stays in the run after the window.
+"""
+
+import os
+import time
+import errno
+from dep_locate import get_locate_dirs, get_24hr_window, scan_fits_dir, make_record, locate_records
+from dep_locate import write_locate_manifest, get_watch_manifest_file, get_watch_records
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+#seconds a file must be unchanged before it is located
+SETTLE_SECS = 30
+
+#seconds between polls (also max wait between settle checks)
+POLL_SECS = 60
+
+
+def dep_locate_watch(instrObj, stopTime=None):
+    '''
+    Watches the search dirs and locates files as they are done being written, until
+    stopTime (default is the end of the 24 hour window plus the settle time).
+    '''
+
+    log = instrObj.log
+    config = instrObj.config['LOCATE']
+    settleSecs = int(config['WATCH_SETTLE'])  if 'WATCH_SETTLE'  in config else SETTLE_SECS
+    pollSecs   = int(config['WATCH_POLL'])    if 'WATCH_POLL'    in config else POLL_SECS
+    backend    = config['WATCH_BACKEND']      if 'WATCH_BACKEND' in config else 'auto'
+
+    useDirs = get_locate_dirs(instrObj)
+    minTime, maxTime = get_24hr_window(instrObj.utDate, instrObj.endTime)
+    if stopTime == None: stopTime = maxTime + settleSecs
+
+    #resume: files already in the watch manifest are not done again
+    seen = set(record['source'] for record in get_watch_records(instrObj))
+    watchFile = get_watch_manifest_file(instrObj.dirs['stage'], instrObj.instr)
+
+    watcher = FitsWatcher(useDirs, minTime, maxTime, settleSecs, pollSecs, backend, log)
+    watcher.done.update(seen)
+    log.info('locate_watch: watching {} dirs ({}) until {}'.format(len(useDirs), watcher.backendName,
+             time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(stopTime))))
+
+    total = 0
+    try:
+        while time.time() < stopTime:
+            ready = watcher.wait(min(pollSecs, max(1, stopTime - time.time())))
+            if not ready: continue
+            records = (make_record(path, mtime, size) for path, mtime, size in ready)
+            num = write_locate_manifest(watchFile, locate_records(instrObj, records, seen), append=True)
+            total += num
+            log.info('locate_watch: {} of {} new files located ({} total)'.format(num, len(ready), total))
+    finally:
+        watcher.close()
+
+    log.info('locate_watch: done, {} files located'.format(total))
+    return total
+
+
+class FitsWatcher:
+    '''
+    Reports FITS files under dirs that are done being written, once each.
+    '''
+
+    def __init__(self, dirs, minTime, maxTime, settleSecs=SETTLE_SECS, pollSecs=POLL_SECS, backend='auto', log=None):
+        '''
+        @param minTime, maxTime: only files with minTime < mtime <= maxTime are reported
+        @param backend: 'inotify', 'poll' or 'auto' (inotify if available)
+        '''
+
+        self.dirs       = [d for d in dirs if os.path.isdir(d)]
+        self.minTime    = minTime
+        self.maxTime    = maxTime
+        self.settleSecs = settleSecs
+        self.pollSecs   = pollSecs
+        self.log        = log
+        self.pending    = {}
+        self.done       = set()
+
+        self.backend = None
+        if backend in ('auto', 'inotify') and inotify_simple:
+            try:
+                self.backend = InotifyBackend(self.dirs, log)
+            except OSError as e:
+                if log: log.warning('locate_watch: inotify not possible ({}), polling instead'.format(e))
+        elif backend == 'inotify' and log:
+            log.warning('locate_watch: inotify_simple not installed, polling instead')
+        if not self.backend:
+            self.backend = PollBackend(self.dirs, pollSecs)
+        self.backendName = self.backend.name
+
+        #files written before the watch started
+        for path in self.backend.initial_files(minTime):
+            self.pending.setdefault(path, None)
+
+
+    def wait(self, timeout):
+        '''
+        Waits up to timeout seconds for changes.  Returns list of (path, mtime, size) for
+        files that are now ready, in mod time order.
+        '''
+
+        #don't wait past the time a pending file could be ready
+        if self.pending: timeout = min(timeout, self.settleSecs)
+        try:
+            changed = self.backend.changed(timeout)
+        except OSError as e:
+            #ie out of inotify watches for a new dir: poll from here on
+            if self.backend.name == 'poll': raise
+            if self.log: self.log.warning('locate_watch: inotify failed ({}), polling instead'.format(e))
+            self.backend.close()
+            self.backend = PollBackend(self.dirs, self.pollSecs)
+            self.backendName = self.backend.name
+            #events may have been lost, so rescan the whole window (done files are skipped)
+            changed = self.backend.initial_files(self.minTime)
+        for path in changed:
+            if path not in self.done and '.fits' in path:
+                self.pending.setdefault(path, None)
+        return self.check_pending()
+
+
+    def check_pending(self):
+        '''
+        Moves files whose size and mod time are unchanged since the last check and are
+        older than settleSecs out of pending.
+        '''
+
+        now = time.time()
+        ready = []
+        for path, last in list(self.pending.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            current = (st.st_size, st.st_mtime)
+            if current == last and now - st.st_mtime >= self.settleSecs:
+                del self.pending[path]
+                self.done.add(path)
+                if self.minTime < st.st_mtime <= self.maxTime:
+                    ready.append((path, st.st_mtime, st.st_size))
+            else:
+                self.pending[path] = current
+
+        ready.sort(key=lambda rec: rec[1])
+        return ready
+
+
+    def close(self):
+        self.backend.close()
+
+
+class PollBackend:
+    '''
+    Rescans the dirs every pollSecs.  Files are only stat'ed in dirs changed since the
+    last scan (new files change the dir mtime; files being written are then pending).
+    '''
+
+    name = 'poll'
+
+    def __init__(self, dirs, pollSecs):
+        self.dirs     = dirs
+        self.pollSecs = pollSecs
+        self.lastScan = None
+
+
+    def initial_files(self, minTime):
+        self.lastScan = time.time()
+        return [path for d in self.dirs for path, mtime, size in scan_fits_dir(d, minTime, float('inf'))]
+
+
+    def changed(self, timeout):
+        wait = self.lastScan + self.pollSecs - time.time()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0, wait))
+
+        #slack for dir mtimes changed in the same second as the last scan
+        since = self.lastScan - 2
+        self.lastScan = time.time()
+        return [path for d in self.dirs for path, mtime, size in scan_fits_dir(d, since, float('inf'), pruneTime=since)]
+
+
+    def close(self):
+        pass
+
+
+class InotifyBackend:
+    '''
+    inotify watches on every dir under the search dirs (new subdirs are added as they appear).
+    '''
+
+    name = 'inotify'
+
+    def __init__(self, dirs, log=None):
+        self.dirs = dirs
+        self.log = log
+        self.inotify = inotify_simple.INotify()
+        flags = inotify_simple.flags
+        self.fileFlags = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MODIFY
+        self.mask = self.fileFlags | flags.CREATE
+        self.isDir = flags.ISDIR
+        self.watches = {}
+        self.newFiles = []
+        for d in dirs:
+            self.add_tree(d)
+
+
+    def add_tree(self, root):
+        '''
+        Adds watches for root and its subdirs (symlinked dirs not followed).
+        Returns FITS files found in them.
+        '''
+        files = []
+        for dirPath, dirNames, fileNames in os.walk(root):
+            try:
+                wd = self.inotify.add_watch(dirPath, self.mask)
+            except OSError as e:
+                #out of watches (ENOSPC) is fatal for this backend (FitsWatcher polls instead), others just skip the dir
+                if e.errno == errno.ENOSPC: raise
+                continue
+            self.watches[wd] = dirPath
+            files += [os.path.join(dirPath, name) for name in fileNames if '.fits' in name]
+        return files
+
+
+    def initial_files(self, minTime):
+        return [path for d in self.dirs for path, mtime, size in scan_fits_dir(d, minTime, float('inf'))]
+
+
+    def changed(self, timeout):
+        paths = []
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            dirPath = self.watches.get(event.wd)
+            if dirPath == None or not event.name: continue
+            path = os.path.join(dirPath, event.name)
+            if event.mask & self.isDir:
+                #files may be written before the new dir's watch is added
+                if os.path.isdir(path) and not os.path.islink(path): paths += self.add_tree(path)
+            elif event.mask & (self.fileFlags | inotify_simple.flags.CREATE):
+                paths.append(path)
+        return paths
+
+
+    def close(self):
+        self.inotify.close()
@@ -17,16 +17,26 @@ import sys
 import os
 from astropy.io import fits
 from common import make_dir_md5_table
+from checksum import open_text
 import datetime
 import re
 import pandas as pd
 import html
+from collections import namedtuple
 
 
+#one keywords.format row
+KeyDef = namedtuple('KeyDef', ['keyword', 'dataType', 'colSize', 'allowNull'])
 
-def make_metadata(keywordsDefFile, metaOutFile, lev0Dir, extraData=None, log=None, dev=False, instrKeywordSkips=[]):
+#compiled schemas by keywords format file (see get_keyword_schema)
+_schemas = {}
+
+
+def make_metadata(keywordsDefFile, metaOutFile, lev0Dir, extraData=None, log=None, dev=False, instrKeywordSkips=[],
+                  headers=None):
     """
     Creates the archiving metadata file as part of the DQA process.
+    Without headers (ie reprocessing) the table is rebuilt from the FITS files in lev0Dir.
 
     @param keywordsDefFile: keywords format definition input file path
     @type keywordsDefFile: string
@@ -36,59 +46,42 @@ def make_metadata(keywordsDefFile, metaOutFile, lev0Dir, extraData=None, log=Non
     @type lev0Dir: string
     @param extraData: dictionary of any extra key val pairs not in header
     @type extraData: dictionary
+    @param headers: lev0 files and their header values collected during DQA
+    @type headers: MetadataAccumulator
     """
 
 
-    #open keywords format file and read data
-    #NOTE: changed this file to tab-delimited
+    #get compiled keywords format (parsed once per file)
     if log: log.info('metadata.py reading keywords definition file: {}'.format(keywordsDefFile))
-    keyDefs = pd.read_csv(keywordsDefFile, sep='\t')
-
+    schema = get_keyword_schema(keywordsDefFile)
 
-    #add header to output file
-    if log: log.info('metadata.py writing to metadata table file: {}'.format(metaOutFile))
-    with open(metaOutFile, 'w+') as out:
-
-        #check col width is at least as big is the keyword name
-        for index, row in keyDefs.iterrows():
-            if (len(row['keyword']) > row['colSize']):
-                raise Exception("metadata.py: Alignment issue: Keyword column name {} is bigger than column size of {}".format(row['keyword'], row['colSize']))            
 
-        for index, row in keyDefs.iterrows():
-            out.write('|' + row['keyword'].ljust(row['colSize']))
-        out.write("|\n")
-
-        for index, row in keyDefs.iterrows():
-            out.write('|' + row['dataType'].ljust(row['colSize']))
-        out.write("|\n")
-
-        #todo: add units?
-        for index, row in keyDefs.iterrows():
-            out.write('|' + ''.ljust(row['colSize']))
-        out.write("|\n")
+    #track warning counts
+    warns = {'type': 0, 'truncate': 0}
 
-        for index, row in keyDefs.iterrows():
-            nullStr = '' if (row['allowNull'] == "N") else "null"
-            out.write('|' + nullStr.ljust(row['colSize']))
-        out.write("|\n")
 
+    #write header and a line per fits file through one buffered handle
+    if log: log.info('metadata.py writing to metadata table file: {}'.format(metaOutFile))
+    with open_text(metaOutFile, bufferSize=1024*1024) as out:
 
-    #track warning counts
-    warns = {'type': 0, 'truncate': 0}
+        out.write(schema.header)
 
+        #walk lev0Dir to find all final fits files
+        if headers == None:
+            if log: log.info('metadata.py searching fits files in dir: {}'.format(lev0Dir))
+            headers = MetadataAccumulator()
+            for root, directories, files in os.walk(lev0Dir):
+                for filename in files:
+                    if filename.endswith('.fits'): headers.add(os.path.join(root, filename))
 
-    #walk lev0Dir to find all final fits files
-    if log: log.info('metadata.py searching fits files in dir: {}'.format(lev0Dir))
-    for root, directories, files in os.walk(lev0Dir):
-        for filename in sorted(files):
-            if filename.endswith('.fits'):
-                fitsFile = os.path.join(root, filename)
+        for fitsFile, values in headers.get_files():
 
-                extra = {}
-                if filename in extraData: extra = extraData[filename]
+            extra = {}
+            filename = os.path.basename(fitsFile)
+            if extraData and filename in extraData: extra = extraData[filename]
 
-                log.info("Creating metadata record for: " + fitsFile)
-                add_fits_metadata_line(fitsFile, metaOutFile, keyDefs, extra, warns, log, dev, instrKeywordSkips)
+            if log: log.info("Creating metadata record for: " + fitsFile)
+            add_fits_metadata_line(fitsFile, out, schema, extra, warns, log, dev, instrKeywordSkips, values)
 
 
     #create md5 sum
@@ -105,69 +98,145 @@ def make_metadata(keywordsDefFile, metaOutFile, lev0Dir, extraData=None, log=Non
 
 
 
-def add_fits_metadata_line(fitsFile, metaOutFile, keyDefs, extra, warns, log, dev, instrKeywordSkips):
-    """
-    Adds a line to metadata file for one FITS file.
-    """
+class KeywordSchema:
+    '''
+    Compiled keywords format file: KeyDef tuples plus the precomputed table header and row format.
+    '''
 
-    #get header object using astropy
-    header = fits.getheader(fitsFile)
+    def __init__(self, keyDefs):
 
-    #check keywords
-    check_keyword_existance(header, keyDefs, log, dev, instrKeywordSkips)
+        self.keyDefs  = tuple(keyDefs)
+        self.keywords = frozenset(kd.keyword for kd in self.keyDefs)
 
-    #write all keywords vals for image to a line
-    with open(metaOutFile, 'a') as out:
+        #check col width is at least as big is the keyword name
+        for kd in self.keyDefs:
+            if (len(kd.keyword) > kd.colSize):
+                raise Exception("metadata.py: Alignment issue: Keyword column name {} is bigger than column size of {}".format(kd.keyword, kd.colSize))
 
-        for index, row in keyDefs.iterrows():
+        #table header: names, types, units (todo), null
+        rows = [[kd.keyword  for kd in self.keyDefs],
+                [kd.dataType for kd in self.keyDefs],
+                [''          for kd in self.keyDefs],
+                ['' if (kd.allowNull == "N") else "null" for kd in self.keyDefs]]
+        self.header = ''.join('|' + '|'.join(val.ljust(kd.colSize) for kd, val in zip(self.keyDefs, row)) + '|\n'
+                              for row in rows)
 
-            keyword   = row['keyword']
-            dataType  = row['dataType']
-            colSize   = row['colSize']
-            allowNull = row['allowNull']
+        #data row: each (str) val left justified to its col size
+        self.rowFormat = ''.join(' {:<%d}' % kd.colSize for kd in self.keyDefs) + '\n'
 
-            #get value from header, set to null if not found
-            if   (keyword in header) : val = header[keyword]
-            elif (keyword in extra)  : val = extra[keyword]
-            else: 
-                val = 'null';
-                if dev: log_msg(log, dev, 'metadata check: Keyword not found in header: ' + keyword)
 
-            #check keyword val and format
-            val = check_keyword_val(keyword, val, row, warns, log)
+    def format_row(self, vals):
+        return self.rowFormat.format(*[str(val) for val in vals])
 
-            #write out val padded to size
-            out.write(' ')
-            out.write(str(val).ljust(colSize))
 
-        out.write("\n")
- 
+def get_keyword_schema(keywordsDefFile):
+    '''
+    Returns the KeywordSchema for a keywords format file (tab-delimited), cached until the file changes.
+    '''
+
+    mtime = os.path.getmtime(keywordsDefFile)
+    cached = _schemas.get(keywordsDefFile)
+    if cached and cached[0] == mtime: return cached[1]
+
+    keyDefs = pd.read_csv(keywordsDefFile, sep='\t')
+    schema = KeywordSchema(KeyDef(str(row.keyword), str(row.dataType), int(row.colSize), row.allowNull)
+                           for row in keyDefs.itertuples(index=False))
+    _schemas[keywordsDefFile] = (mtime, schema)
+    return schema
 
 
-def check_keyword_existance(header, keyDefs, log, dev=False, instrKeywordSkips=[]):
+class MetadataAccumulator:
+    '''
+    Lev0 files and their final primary header values, collected as DQA writes them so the
+    metadata table can be made without reading the lev0 files again.
+    '''
+
+    def __init__(self):
+        self.files = {}
+
+
+    def add(self, fitsFile, header=None, values=None):
+        '''
+        Adds a lev0 file with its header as written or its get_header_values() (neither: read
+        from the file later).
+        '''
+        if header != None: values = get_header_values(header)
+        self.files[fitsFile] = values
+
+
+    def get_files(self):
+        '''
+        Returns (fitsFile, values) in lev0 dir walk order (dir by dir, sorted).  values is the
+        header values dict or None.
+        '''
+        paths = sorted(self.files, key=lambda path: (os.path.dirname(path).split('/'), os.path.basename(path)))
+        return [(path, self.files[path]) for path in paths]
+
+
+def get_header_values(header):
+    '''
+    Returns {keyword: value} for a header as it reads back from a FITS file (each card image is
+    parsed again, so ie float formatting and string padding match fits.getheader).  The first
+    card wins for repeated keywords, like header[keyword].
+    '''
+    values = {}
+    for card in fits.Header.fromstring(header.tostring()).cards:
+        if card.keyword not in values: values[card.keyword] = card.value
+    return values
+
+
+def add_fits_metadata_line(fitsFile, out, schema, extra, warns, log, dev, instrKeywordSkips, values=None):
+    """
+    Writes the metadata line for one FITS file to open file out (header values read from the file if not given).
+    """
 
-    #get simple list of keywords
-    keyDefList = []
-    for index, row in keyDefs.iterrows():
-        keyDefList.append(row['keyword'])        
+    #get header values using astropy, parse each card value once
+    if values == None:
+        values = {}
+        for card in fits.getheader(fitsFile).cards:
+            if card.keyword not in values: values[card.keyword] = card.value
+
+    #check keywords
+    check_keyword_existance(values, schema, log, dev, instrKeywordSkips)
+
+    #get all keywords vals for image
+    vals = []
+    for kd in schema.keyDefs:
+
+        #get value from header, set to null if not found
+        keyword = kd.keyword
+        if   (keyword in values) : val = values[keyword]
+        elif (keyword in extra)  : val = extra[keyword]
+        else: 
+            val = 'null';
+            if dev: log_msg(log, dev, 'metadata check: Keyword not found in header: ' + keyword)
+
+        #check keyword val and format
+        vals.append(check_keyword_val(keyword, val, kd, warns, log))
+
+    #write out vals padded to size
+    out.write(schema.format_row(vals))
+ 
+
+
+def check_keyword_existance(header, schema, log, dev=False, instrKeywordSkips=[]):
 
     #find all keywords in header that are not in metadata file
     skips = ['SIMPLE', 'COMMENT', 'PROGTL1', 'PROGTL2', 'PROGTL3'] + instrKeywordSkips
     for keywordHdr in header:
-        if keywordHdr not in keyDefList and not is_keyword_skip(keywordHdr, skips):
+        if keywordHdr not in schema.keywords and not is_keyword_skip(keywordHdr, skips):
             log_msg(log, dev, 'metadata.py: header keyword "{}" not found in metadata definition file.'.format(keywordHdr))
 
     #find all keywords in metadata def file that are not in header
     skips = ['PROGTITL', 'PROPINT']
-    for index, row in keyDefs.iterrows():
-        keyword = row['keyword']
-        if keyword not in header and keyword not in skips and row['allowNull'] == "N":
-            log_msg(log, dev, 'metadata.py: non-null metadata keyword "{}" not found in header.'.format(keyword))
+    for kd in schema.keyDefs:
+        if kd.keyword not in header and kd.keyword not in skips and kd.allowNull == "N":
+            log_msg(log, dev, 'metadata.py: non-null metadata keyword "{}" not found in header.'.format(kd.keyword))
 
 
 def check_keyword_val(keyword, val, fmt, warns, log=None, dev=False):
     '''
-    Checks keyword for correct type and proper value.
+    Checks keyword for correct type and proper value (fmt is the keyword's KeyDef).
     '''
 
     #specific ERROR, UDF values that we should convert to "null"
@@ -178,7 +247,7 @@ def check_keyword_val(keyword, val, fmt, warns, log=None, dev=False):
 
     #check null
     if (val == 'null' or val == ''):
-        if (fmt['allowNull'] == 'N'):
+        if (fmt.allowNull == 'N'):
             raise Exception('metadata check: incorrect "null" value found for non-null keyword {}'.format(keyword))            
         return val
 
@@ -186,35 +255,35 @@ def check_keyword_val(keyword, val, fmt, warns, log=None, dev=False):
     #check value type
     vtype = type(val).__name__
 
-    if (fmt['dataType'] == 'char'):
+    if (fmt.dataType == 'char'):
         if (vtype == 'bool'):
             if   (val == True):  val = 'T'
             elif (val == False): val = 'F'
         elif (vtype == 'int' and val == 0):
             val = ''
-            log_msg(log, dev, 'metadata check: found integer 0, expected {}. KNOWN ISSUE. SETTING TO BLANK!'.format(fmt['dataType']))
+            log_msg(log, dev, 'metadata check: found integer 0, expected {}. KNOWN ISSUE. SETTING TO BLANK!'.format(fmt.dataType))
         elif (vtype != "str"):
-            log_msg(log, dev, 'metadata check: var type {}, expected {} ({}={}).'.format(vtype, fmt['dataType'], keyword, val))
+            log_msg(log, dev, 'metadata check: var type {}, expected {} ({}={}).'.format(vtype, fmt.dataType, keyword, val))
             warns['type'] += 1
 
-    elif (fmt['dataType'] == 'integer'):
+    elif (fmt.dataType == 'integer'):
         if (vtype != "int"):
-            log_msg(log, dev, 'metadata check: var type of {}, expected {} ({}={}).'.format(vtype, fmt['dataType'], keyword, val))
+            log_msg(log, dev, 'metadata check: var type of {}, expected {} ({}={}).'.format(vtype, fmt.dataType, keyword, val))
             warns['type'] += 1
 
-    elif (fmt['dataType'] == 'double'):
+    elif (fmt.dataType == 'double'):
         if (vtype != "float" and vtype != "int"):
-            log_msg(log, dev, 'metadata check: var type of {}, expected {} ({}={}).'.format(vtype, fmt['dataType'], keyword, val))
+            log_msg(log, dev, 'metadata check: var type of {}, expected {} ({}={}).'.format(vtype, fmt.dataType, keyword, val))
             warns['type'] += 1
 
-    elif (fmt['dataType'] == 'date'):
+    elif (fmt.dataType == 'date'):
         try:
             datetime.datetime.strptime(val, '%Y-%m-%d')
         except ValueError:
             log_msg(log, dev, 'metadata check: expected date format YYYY-mm-dd ({}={}).'.format(keyword, val))
             warns['type'] += 1
 
-    elif (fmt['dataType'] == 'datetime'):
+    elif (fmt.dataType == 'datetime'):
         try:
             datetime.datetime.strptime(val, '%Y-%m-%d %H:%i:%s')
         except ValueError:
@@ -224,15 +293,15 @@ def check_keyword_val(keyword, val, fmt, warns, log=None, dev=False):
 
     #check char length
     length = len(str(val))
-    if (length > fmt['colSize']):
-        if (fmt['dataType'] == 'double'): 
-            log_msg(log, dev, 'metadata check: char length of {} greater than column size of {} ({}={}).  TRUNCATING.'.format(length, fmt['colSize'], keyword, val))
+    if (length > fmt.colSize):
+        if (fmt.dataType == 'double'): 
+            log_msg(log, dev, 'metadata check: char length of {} greater than column size of {} ({}={}).  TRUNCATING.'.format(length, fmt.colSize, keyword, val))
             warns['truncate'] += 1
-            val = truncate_float(val, fmt['colSize'])
+            val = truncate_float(val, fmt.colSize)
         else: 
-            log_msg(log, dev, 'metadata check: char length of {} greater than column size of {} ({}={}).  TRUNCATING.'.format(length, fmt['colSize'], keyword, val))
+            log_msg(log, dev, 'metadata check: char length of {} greater than column size of {} ({}={}).  TRUNCATING.'.format(length, fmt.colSize, keyword, val))
             warns['truncate'] += 1
-            val = str(val)[:fmt['colSize']]
+            val = str(val)[:fmt.colSize]
 
 
     #todo: check value range, discrete values?
@@ -420,7 +489,7 @@ def header_keyword_report(keywordsDefFile, fitsFile):
 
 
     #read keywords format file and fits file
-    keyDefs = pd.read_csv(keywordsDefFile, sep='\t')
+    schema = get_keyword_schema(keywordsDefFile)
     header = fits.getheader(fitsFile, ignore_missing_end=True)
 
     #put header keys into set
@@ -433,9 +502,9 @@ def header_keyword_report(keywordsDefFile, fitsFile):
     #put keyDefs into set
     print ("=========FORMAT LIST===========")
     formatKeys = []
-    for index, row in keyDefs.iterrows():
-        print (row['keyword'])
-        formatKeys.append(row['keyword'])
+    for kd in schema.keyDefs:
+        print (kd.keyword)
+        formatKeys.append(kd.keyword)
 
     #diff sets 
     diff1 = list(set(headerKeys) - set(formatKeys))
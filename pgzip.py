@@ -0,0 +1,122 @@
+"""
+Block-parallel gzip writer (same scheme as pigz).
+
+Input is cut into blocks that are deflated on a thread pool (zlib releases the GIL).  Each
+block is primed with the last 32KB of the previous one so compression stays close to a
+single stream, and ends on a byte boundary (Z_SYNC_FLUSH) so the compressed blocks can just
+be concatenated.  The result is a normal single-member gzip file any gunzip can read.
+"""
+
+import gzip
+import time
+import zlib
+import struct
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+#uncompressed bytes per block
+BLOCK_SIZE = 128 * 1024
+
+#deflate window, used as the preset dictionary of the next block
+DICT_SIZE = 32 * 1024
+
+
+def open_gzip(fileobj, level=9, numWorkers=4, blockSize=BLOCK_SIZE):
+    '''
+    Returns a writable gzip stream on binary fileobj: ParallelGzipWriter or, for
+    numWorkers <= 1, a plain gzip.GzipFile.  Closing it does not close fileobj.
+    '''
+    if numWorkers <= 1: return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=level)
+    return ParallelGzipWriter(fileobj, level, numWorkers, blockSize)
+
+
+def compress_block(data, level, zdict, isLast):
+    '''
+    Raw deflate of one block, byte aligned (or finished if isLast).
+    '''
+    if zdict: comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else    : comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return comp.compress(data) + comp.flush(zlib.Z_FINISH if isLast else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter:
+    '''
+    Writes gzip to binary fileobj, compressing blocks on numWorkers threads.  Compressed
+    blocks are written in order as they finish; at most 2 * numWorkers blocks are in flight.
+    '''
+
+    def __init__(self, fileobj, level=9, numWorkers=4, blockSize=BLOCK_SIZE):
+
+        self.fileobj    = fileobj
+        self.name       = getattr(fileobj, 'name', None)
+        self.level      = level
+        self.numWorkers = numWorkers
+        self.blockSize  = blockSize
+        self.executor   = ThreadPoolExecutor(max_workers=numWorkers)
+        self.pending    = collections.deque()
+        self.buf        = bytearray()
+        self.prevTail   = b''
+        self.crc        = 0
+        self.size       = 0
+        self.closed     = False
+
+        #gzip header: magic, deflate, no flags, mtime, extra flags, os unknown
+        xfl = 2 if level == 9 else 4 if level == 1 else 0
+        self.fileobj.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, int(time.time()), xfl, 255))
+
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buf += data
+        while len(self.buf) >= self.blockSize:
+            self.submit(bytes(self.buf[:self.blockSize]))
+            del self.buf[:self.blockSize]
+        return len(data)
+
+
+    def submit(self, block, isLast=False):
+        self.pending.append(self.executor.submit(compress_block, block, self.level, self.prevTail, isLast))
+        self.prevTail = block[-DICT_SIZE:]
+        while len(self.pending) > 2 * self.numWorkers:
+            self.fileobj.write(self.pending.popleft().result())
+
+
+    def flush(self):
+        pass
+
+
+    def close(self):
+        '''
+        Writes the last block and the gzip trailer (crc32 and size).
+        '''
+        if self.closed: return
+        self.closed = True
+        try:
+            self.submit(bytes(self.buf), isLast=True)
+            self.buf = bytearray()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.fileobj.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        finally:
+            self.executor.shutdown()
+
+
+    def abort(self):
+        '''
+        Stops without writing the rest (ie after an error).
+        '''
+        self.closed = True
+        for future in self.pending: future.cancel()
+        self.executor.shutdown()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType: self.abort()
+        else      : self.close()
+        return False
@@ -0,0 +1,95 @@
+"""
+JPEG previews of FITS image data.
+
+Scaling matches the old matplotlib version (ZScale limits with an asinh stretch, gray, origin
+lower) but is done directly in numpy and the JPEG is written from the uint8 array with PIL.
+No pyplot/global state is used, so this is safe to call from threads and worker processes.
+"""
+
+import numpy as np
+from PIL import Image
+from astropy.visualization import ZScaleInterval
+from checksum import HashingFile
+
+
+#same softening as astropy AsinhStretch() default
+ASINH_A = 0.1
+
+#default max width/height, about the size of the old 640x480 matplotlib figure
+MAX_SIZE = 640
+
+
+def downsample_image(image, factor):
+    '''
+    Block-averages an image by an integer factor (edge rows/cols that do not fill a block are dropped).
+
+    @param image: 2D image data
+    @type image: numpy array
+    @param factor: block size in pixels
+    @type factor: int
+    '''
+
+    if factor <= 1: return image
+
+    ny = (image.shape[0] // factor) * factor
+    nx = (image.shape[1] // factor) * factor
+    if ny == 0 or nx == 0: return image
+
+    blocks = image[:ny, :nx].reshape(ny // factor, factor, nx // factor, factor)
+    return blocks.mean(axis=(1, 3))
+
+
+def scale_image(image, maxSize=0, downsample=1):
+    '''
+    Returns a uint8 preview array (row 0 at top) for a 2D image.
+
+    @param image: image data (cubes use the first plane)
+    @type image: numpy array
+    @param maxSize: max output width/height in pixels (0 = no limit)
+    @type maxSize: int
+    @param downsample: integer block-average factor
+    @type downsample: int
+    '''
+
+    image = np.asarray(image)
+    while image.ndim > 2: image = image[0]
+    image = image.astype(np.float32, copy=False)
+
+    #zscale limits are from a sample of the full resolution data
+    vmin, vmax = ZScaleInterval().get_limits(image)
+
+    #pick a block factor so the result fits in maxSize
+    factor = max(1, int(downsample))
+    if maxSize and maxSize > 0:
+        factor = max(factor, int(np.ceil(max(image.shape) / float(maxSize))))
+    image = downsample_image(image, factor)
+
+    #normalize to 0-1 and asinh stretch
+    span = vmax - vmin
+    if not span > 0: span = 1.0
+    data = (image - vmin) / span
+    np.clip(data, 0.0, 1.0, out=data)
+    data = np.arcsinh(data / ASINH_A) / np.arcsinh(1.0 / ASINH_A)
+    data = np.nan_to_num(data, nan=0.0)
+
+    #quantize; flip so origin is lower left like imshow(origin='lower')
+    data = (data * 255.0 + 0.5).astype(np.uint8)
+    return np.ascontiguousarray(data[::-1])
+
+
+def write_jpg(image, jpgFile, maxSize=MAX_SIZE, downsample=1, rotate=0, quality=90):
+    '''
+    Scales image data and writes it to jpgFile.
+
+    @param maxSize: max output width/height in pixels (0 = full size)
+    @type maxSize: int
+
+    @param rotate: degrees counter-clockwise (ie -90 for HIRES)
+    @type rotate: int
+    '''
+
+    data = scale_image(image, maxSize=maxSize, downsample=downsample)
+    img = Image.fromarray(data)
+    if rotate: img = img.rotate(rotate, expand=True)
+    with HashingFile(jpgFile) as fp:
+        img.save(fp, 'JPEG', quality=quality)
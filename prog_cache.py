@@ -0,0 +1,163 @@
+"""
+Cache of program PI, institution and title by semid (ie 2019B_U123).
+
+create_prog, getProgInfo and dep_dqa all ask for the same handful of programs for every
+file.  ProgramInfoCache looks each one up once, can fetch all distinct semids for a night
+concurrently, and saves answers per semester (proginfo_<semester>.json in cacheDir) so
+reprocessing does not need the proposals API at all.  Failed lookups are remembered for
+the run but not saved.
+"""
+
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from common import get_prog_pi, get_prog_inst, get_prog_title
+
+
+class ProgramInfoCache:
+
+    def __init__(self, cacheDir=None, log=None, numWorkers=8):
+        '''
+        @param cacheDir: directory for per semester cache files (None = memory only)
+        @type cacheDir: string
+        @param numWorkers: max concurrent API requests for prefetch
+        @type numWorkers: int
+        '''
+
+        self.cacheDir   = cacheDir
+        self.log        = log
+        self.numWorkers = numWorkers
+        self.progs      = {}
+        self.failed     = set()
+        self.semesters  = set()
+        self.lock       = threading.Lock()
+
+        if self.cacheDir and not os.path.isdir(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except Exception as e:
+                if self.log: self.log.warning('ProgramInfoCache: could not create ' + self.cacheDir)
+                self.cacheDir = None
+
+
+    def get_pi(self, semid, default=None):
+        return self.get(semid, 'progpi', default)
+
+    def get_inst(self, semid, default=None):
+        return self.get(semid, 'proginst', default)
+
+    def get_title(self, semid, default=None):
+        return self.get(semid, 'progtitl', default)
+
+
+    def get(self, semid, field, default=None):
+        '''
+        Returns field ('progpi', 'proginst' or 'progtitl') for semid, querying the API if not cached.
+        '''
+
+        val = self.lookup(semid, field)
+        if val == None:
+            val = self.fetch(semid, field)
+            self.save(semid)
+        return default if val == None else val
+
+
+    def prefetch(self, semids):
+        '''
+        Fetches all fields for the distinct semids not already cached, concurrently.
+        '''
+
+        jobs = []
+        for semid in sorted(set(semids)):
+            for field in ('progpi', 'proginst', 'progtitl'):
+                if self.lookup(semid, field) == None and (semid, field) not in self.failed:
+                    jobs.append((semid, field))
+        if not jobs: return
+
+        if self.log: self.log.info('ProgramInfoCache: fetching {} program values'.format(len(jobs)))
+        with ThreadPoolExecutor(max_workers=self.numWorkers) as executor:
+            list(executor.map(lambda job: self.fetch(*job), jobs))
+
+        for semid in set(semid for semid, field in jobs):
+            self.save(semid)
+
+
+    def lookup(self, semid, field):
+        '''
+        Cached value or None.  Loads the semester cache file on first use.
+        '''
+        self.load(semid)
+        with self.lock:
+            return self.progs.get(semid, {}).get(field)
+
+
+    def fetch(self, semid, field):
+        '''
+        Queries the API for one value and caches it.
+        '''
+
+        if (semid, field) in self.failed: return None
+
+        if   field == 'progpi'  : val = get_prog_pi   (semid, None, self.log)
+        elif field == 'proginst': val = get_prog_inst (semid, None, self.log)
+        elif field == 'progtitl': val = get_prog_title(semid, None, self.log)
+        else: raise Exception('ProgramInfoCache: unknown field ' + field)
+
+        with self.lock:
+            if val == None: self.failed.add((semid, field))
+            else          : self.progs.setdefault(semid, {})[field] = val
+        return val
+
+
+    def get_cache_file(self, semid):
+        semester = semid.split('_')[0]
+        return self.cacheDir + '/proginfo_' + semester + '.json'
+
+
+    def load(self, semid):
+        '''
+        Reads the semester cache file for semid once.
+        '''
+
+        semester = semid.split('_')[0]
+        if not self.cacheDir or semester in self.semesters: return
+
+        with self.lock:
+            if semester in self.semesters: return
+            self.semesters.add(semester)
+            try:
+                with open(self.get_cache_file(semid), 'r') as fp:
+                    for key, vals in json.load(fp).items():
+                        self.progs.setdefault(key, {}).update(vals)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                if self.log: self.log.warning('ProgramInfoCache: could not read cache for ' + semester)
+
+
+    def save(self, semid):
+        '''
+        Writes all cached programs for the semester of semid to its cache file.
+        '''
+
+        if not self.cacheDir: return
+
+        semester = semid.split('_')[0]
+        cacheFile = self.get_cache_file(semid)
+        with self.lock:
+            data = {key: vals for key, vals in self.progs.items() if key.split('_')[0] == semester}
+            try:
+                tmpFile = cacheFile + '.' + str(os.getpid()) + '.tmp'
+                with open(tmpFile, 'w') as fp:
+                    json.dump(data, fp, indent=1, sort_keys=True)
+                os.replace(tmpFile, cacheFile)
+            except Exception as e:
+                if self.log: self.log.warning('ProgramInfoCache: could not write ' + cacheFile)
+
+
+def get_prog_cache_dir(rootDir):
+    '''
+    Program info cache dir shared by all instruments and nights.
+    '''
+    return rootDir + '/stage/proginfo'
@@ -0,0 +1,59 @@
+import multiprocessing
+
+from apiclient import StubServer, get_api_client
+
+
+def get_in_worker(url):
+    return url, get_api_client().get(url)
+
+
+def test_forked_pool_does_not_share_connections():
+    responses = {'cmd=item{:03d}&'.format(i): 'body{:03d}'.format(i) for i in range(40)}
+    stub = StubServer(responses).start()
+    try:
+        client = get_api_client()
+        urls = [stub.url + '?cmd=item{:03d}&'.format(i) for i in range(40)]
+
+        #parent opens its keep-alive connection before the fork
+        assert client.get(urls[0]) == 'body000'
+
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(4) as pool:
+            results = pool.map(get_in_worker, urls * 3, chunksize=1)
+        for url, body in results:
+            assert body == 'body' + url.split('cmd=item')[1][:3]
+
+        #parent connection still works afterwards
+        assert client.get(urls[1]) == 'body001'
+    finally:
+        stub.stop()
+
+
+def test_get_many_keeps_order():
+    stub = StubServer({'a=1': 'one', 'a=2': 'two'}).start()
+    try:
+        urls = [stub.url + '?a=1', stub.url + '?a=2', stub.url + '?a=3'] * 5
+        assert get_api_client().get_many(urls) == ['one', 'two', None] * 5
+    finally:
+        stub.stop()
+
+
+def test_get_many_reuses_executor_and_closes_connections(monkeypatch):
+    stub = StubServer({'a=1': 'one'}).start()
+    try:
+        client = get_api_client()
+        conns = []
+        get_connection = client.get_connection
+        def record_connection(scheme, netloc):
+            conn = get_connection(scheme, netloc)
+            conns.append(conn)
+            return conn
+        monkeypatch.setattr(client, 'get_connection', record_connection)
+
+        client.get_many([stub.url + '?a=1'] * 4)
+        executor = client.executor
+        assert client.get_many([stub.url + '?a=1'] * 4) == ['one'] * 4
+        assert client.executor is executor
+        assert conns and all(conn.sock is None for conn in conns)
+    finally:
+        stub.stop()
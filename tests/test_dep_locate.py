@@ -0,0 +1,127 @@
+import os
+import gzip
+import logging
+
+import numpy as np
+from astropy.io import fits
+
+from dep_locate import dep_rawfiles, make_record, StageCopier
+from locate_rules import LocateRules
+
+
+log = logging.getLogger('test_dep_locate')
+rules = LocateRules(filenameKeys=['OUTFILE'], framenoKeys=[])
+
+
+class TruncatingCopier(StageCopier):
+    '''
+    Stages a truncated copy, as if the raw file was cut short after it was checked.
+    '''
+    def copy_one(self, job):
+        used = super().copy_one(job)
+        with open(job[1], 'r+b') as fp:
+            fp.truncate(os.path.getsize(job[1]) - 20)
+        return used
+
+
+class FailingCopier(StageCopier):
+    def copy_one(self, job):
+        os.makedirs(os.path.dirname(job[1]), exist_ok=True)
+        with open(job[1], 'wb') as fp:
+            fp.write(b'partial')
+        raise OSError(28, 'No space left on device')
+
+
+def make_dirs(tmp_path):
+    rawDir = tmp_path / 'raw'
+    ancDir = tmp_path / 'anc'
+    rawDir.mkdir()
+    (ancDir / 'udf').mkdir(parents=True)
+    return rawDir, str(tmp_path / 'stage'), ancDir
+
+
+def write_fits_gz(path):
+    hdu = fits.PrimaryHDU(np.random.default_rng(0).integers(0, 60000, (200, 200)).astype('int32'))
+    hdu.header['OUTFILE'] = os.path.basename(path)[:-3]
+    hdu.writeto(path[:-3])
+    with open(path[:-3], 'rb') as fp:
+        data = gzip.compress(fp.read())
+    os.remove(path[:-3])
+    with open(path, 'wb') as fp:
+        fp.write(data)
+
+
+def test_truncated_gzip_is_rejected(tmp_path):
+    rawDir, stageDir, ancDir = make_dirs(tmp_path)
+    bad = str(rawDir / 'bad.fits.gz')
+    write_fits_gz(bad)
+
+    records = list(dep_rawfiles('TEST', [make_record(bad)], str(ancDir), False, log,
+                                stageDir=stageDir, copier=TruncatingCopier(numWorkers=1), rules=rules))
+
+    assert records[0]['status'] == 'reject'
+    assert records[0]['reason'] == 'Bad gzip'
+    #partial and staged copies are gone, raw file kept and copied to udf
+    for path in (stageDir + bad, stageDir + bad[:-3], stageDir + bad[:-3] + '.tmp'):
+        assert not os.path.exists(path)
+    assert os.path.isfile(bad)
+    assert os.path.isfile(str(ancDir / 'udf' / 'bad.fits.gz'))
+
+
+def test_bad_gzip_does_not_stop_locate(tmp_path):
+    rawDir, stageDir, ancDir = make_dirs(tmp_path)
+    good = str(rawDir / 'good.fits.gz')
+    bad = str(rawDir / 'bad.fits.gz')
+    write_fits_gz(good)
+    write_fits_gz(bad)
+    #header is readable but the gzip crc is not
+    with open(bad, 'r+b') as fp:
+        fp.seek(-8, os.SEEK_END)
+        fp.write(b'\0\0\0\0')
+
+    records = list(dep_rawfiles('TEST', [make_record(bad), make_record(good)], str(ancDir), False, log,
+                                stageDir=stageDir, rules=rules))
+
+    assert [(r['status'], r['reason']) for r in records] == [('reject', 'Bad gzip'), ('accept', None)]
+    assert os.path.isfile(stageDir + good[:-3])
+    assert not os.path.exists(stageDir + bad)
+
+
+def test_copy_failure_is_rejected(tmp_path):
+    rawDir, stageDir, ancDir = make_dirs(tmp_path)
+    raw = str(rawDir / 'raw.fits.gz')
+    write_fits_gz(raw)
+
+    records = list(dep_rawfiles('TEST', [make_record(raw)], str(ancDir), False, log,
+                                stageDir=stageDir, copier=FailingCopier(numWorkers=1), rules=rules))
+
+    assert (records[0]['status'], records[0]['reason']) == ('reject', 'Copy failed')
+    assert not os.path.exists(stageDir + raw)
+    assert os.path.isfile(raw)
+
+
+def write_fits(path, **keys):
+    hdu = fits.PrimaryHDU()
+    hdu.header['OUTFILE'] = os.path.basename(path)
+    for key, val in keys.items(): hdu.header[key] = val
+    hdu.writeto(path)
+
+
+def test_located_companion_is_staged_once(tmp_path):
+    rawDir, stageDir, ancDir = make_dirs(tmp_path)
+    fcs = str(rawDir / 'fcs.fits')
+    sci = str(rawDir / 'sci.fits')
+    write_fits(fcs)
+    write_fits(sci, FCSIMGFI=fcs)
+
+    def companions(header):
+        return [header['FCSIMGFI']] if 'FCSIMGFI' in header else []
+
+    seen = set()
+    records = list(dep_rawfiles('TEST', [make_record(sci), make_record(fcs)], str(ancDir), False, log,
+                                stageDir=stageDir, copier=StageCopier(numWorkers=2), rules=rules,
+                                companions=companions, seen=seen))
+
+    assert [r['source'] for r in records] == [sci, fcs]
+    assert all(r['status'] == 'accept' for r in records)
+    assert seen == {sci, fcs}
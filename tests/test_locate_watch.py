@@ -0,0 +1,74 @@
+import os
+import time
+import errno
+import logging
+import types
+
+import pytest
+
+from instrument import Instrument
+from locate_watch import FitsWatcher
+from dep_locate import get_watch_manifest_file, get_locate_manifest_file
+
+
+log = logging.getLogger('test_locate_watch')
+
+
+class FailingInotify:
+    '''
+    Stands in for InotifyBackend running out of watches when a new dir appears.
+    '''
+    name = 'inotify'
+
+    def __init__(self):
+        self.closed = False
+
+    def changed(self, timeout):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+
+    def close(self):
+        self.closed = True
+
+
+def test_watcher_falls_back_to_polling(tmp_path):
+    path = str(tmp_path / 'a.fits')
+    with open(path, 'wb') as fp:
+        fp.write(b'x')
+    mtime = time.time() - 100
+    os.utime(path, (mtime, mtime))
+
+    watcher = FitsWatcher([str(tmp_path)], mtime - 10, mtime + 10, settleSecs=0, pollSecs=0, backend='poll', log=log)
+    watcher.pending.clear()
+    inotify = FailingInotify()
+    watcher.backend = inotify
+
+    watcher.wait(0)
+    assert inotify.closed
+    assert watcher.backendName == 'poll'
+    #file written while the events were lost is still located
+    assert [rec[0] for rec in watcher.wait(0)] == [path]
+
+
+def make_instr(tmp_path):
+    return types.SimpleNamespace(rootDir=str(tmp_path), instr='HIRES', utDate='2026-10-18', log=log)
+
+
+def test_full_run_fails_on_existing_dirs(tmp_path):
+    instr = make_instr(tmp_path)
+    Instrument.init_dirs(instr, True)
+    with pytest.raises(Exception):
+        Instrument.init_dirs(instr, True, resume=True)
+
+
+def test_watch_run_resumes_until_locate_finished(tmp_path):
+    instr = make_instr(tmp_path)
+    Instrument.init_dirs(instr, True)
+    open(get_watch_manifest_file(instr.dirs['stage'], instr.instr), 'w').close()
+
+    Instrument.init_dirs(instr, True, resume=True)
+    assert instr.isResume
+
+    #stopped after locate: not resumable
+    open(get_locate_manifest_file(instr.dirs['stage'], instr.instr), 'w').close()
+    with pytest.raises(Exception):
+        Instrument.init_dirs(instr, True, resume=True)